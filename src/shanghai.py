@@ -4,12 +4,51 @@
 """shanghai语言执行器
 
 用法：
-    python shanghai.py 源程序文件名...
+    python shanghai.py [-o 输出文件名] [-j 进程数] [--flush-threshold 字数]
+                       [--no-optimize] [--memoize] [--memoize-size 个数]
+                       [--memoize-only 套路名] [--no-memoize 套路名]
+                       [--stats] [--stream] [--connect 套接字]
+                       [--max-seconds 秒] [--max-cpu-seconds 秒]
+                       [--max-steps 步数] [--max-call-depth 层数]
+                       [--max-memory 兆字节]
+                       源程序文件名...
+    python shanghai.py -i [源程序文件名...]
+    python shanghai.py --serve 套接字
 """
 
+import argparse
+import array
+import ast
+import asyncio
+import bisect
+import builtins
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import contextvars
+import functools
+import hashlib
+import importlib
+import importlib.abc
+import importlib.util
 import io
+import itertools
+import json
+import marshal
+import operator
+import os
 import re
+import socket
+import socketserver
+import stat
 import sys
+import string
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
 
 KW_BANG = '！'
 KW_BECOME = '毛估估是'
@@ -121,6 +160,8 @@ TK_IDENTIFIER = 'IDENTIFIER'
 TK_STRING_LITERAL = 'STRING'
 TK_INTEGER_LITERAL = 'INTEGER'
 TK_CHAR = 'CHAR'
+# Made by the optimizer only.
+TK_BOOL_LITERAL = 'BOOL'
 
 # Statements.
 STMT_ASSIGN = 'ASSIGN'
@@ -136,8 +177,21 @@ STMT_LOOP = 'LOOP'
 STMT_RETURN = 'RETURN'
 STMT_SAY = 'SAY'
 STMT_VAR_DECL = 'VAR_DECL'
+# Made by LocalizeImports() only.
+STMT_BIND_GLOBALS = 'BIND_GLOBALS'
+STMT_LOCAL_IMPORT = 'LOCAL_IMPORT'
+# Made by the optimizer only.
+STMT_AFFINE_LOOP = 'AFFINE_LOOP'
+# Made by EliminateTailCalls() only.
+STMT_TAIL_CALL = 'TAIL_CALL'
+STMT_TAIL_CALL_LOOP = 'TAIL_CALL_LOOP'
+# Made by InstrumentStatements() only.
+STMT_TICK = 'TICK'
 
 class Token:
+  # There are lots of tokens, so they have no __dict__.
+  __slots__ = ('kind', 'value')
+
   def __init__(self, kind, value):
     self.kind = kind
     self.value = value
@@ -149,9 +203,9 @@ class Token:
     return self.__str__()
 
   def __eq__(self, other):
-    return (isinstance(other, Token) and
-            self.kind == other.kind and
-            self.value == other.value)
+    return self is other or (isinstance(other, Token) and
+                             self.kind == other.kind and
+                             self.value == other.value)
 
   def __ne__(self, other):
     return not (self == other)
@@ -160,6 +214,9 @@ def IdentifierToken(name):
   return Token(TK_IDENTIFIER, name)
 
 class Expr:
+  # Subclasses list their fields in __slots__, which WalkAst() relies on.
+  __slots__ = ()
+
   def __init__(self):
     pass
 
@@ -176,10 +233,49 @@ class Expr:
   def __ne__(self, other):
     return not (self == other)
 
-  def ToPython(self):
+  def ToPython(self, symbols):
     """Translates this expression to Python."""
     raise Exception('%s must implement ToPython().' % (type(self),))
 
+  def ToPythonAst(self, symbols):
+    """Translates this expression to a Python ast.expr node."""
+    raise Exception('%s must implement ToPythonAst().' % (type(self),))
+
+def PythonNameAst(name, ctx):
+  """Returns the ast node referring to a (possibly dotted) Python name."""
+  parts = name.split('.')
+  if len(parts) == 1:
+    return ast.Name(id=name, ctx=ctx)
+  node = ast.Name(id=parts[0], ctx=ast.Load())
+  for part in parts[1:-1]:
+    node = ast.Attribute(value=node, attr=part, ctx=ast.Load())
+  return ast.Attribute(value=node, attr=parts[-1], ctx=ctx)
+
+def PythonCallAst(func_name, args):
+  return ast.Call(func=PythonNameAst(func_name, ast.Load()),
+                  args=args, keywords=[])
+
+def PythonSubscriptAst(value, key):
+  """Returns the ast node for value[key], key being a constant."""
+  index = ast.Constant(value=key)
+  if sys.version_info < (3, 9):
+    index = ast.Index(value=index)
+  return ast.Subscript(value=value, slice=index, ctx=ast.Load())
+
+def PythonBindingsAst(bindings):
+  """Returns the ast nodes of BindingsToPython(bindings)."""
+  return [
+      ast.If(
+          test=ast.Compare(
+              left=ast.Constant(value=key), ops=[ast.In()],
+              comparators=[ast.Name(id='_db_values', ctx=ast.Load())]),
+          body=[ast.Assign(
+              targets=[PythonNameAst(py_name, ast.Store())],
+              value=PythonSubscriptAst(
+                  ast.Name(id='_db_values', ctx=ast.Load()), key))],
+          orelse=[])
+      for key, py_name in bindings]
+
 def _shanghai_str(value):
   """Converts a value to its shanghai string."""
   if value is None:
@@ -188,7 +284,57 @@ def _shanghai_str(value):
     return '对额' if value else '勿对'
   return str(value)
 
+def _shanghai_affine_sums(loop_range, accumulators):
+  """Returns the values of the accumulators after an affine 搞七捻三 over
+  loop_range, followed by that of its loop variable, or None if they have
+  to be worked out by actually looping.
+
+  accumulators is a sequence of (value before the loop, terms).  Every time
+  round, the loop adds sign * factor * (loop variable if linear else 1) to
+  the accumulator for each (sign, linear, factor) in its terms.  Only ints
+  are summed in closed form: anything else might not add up the same way.
+  """
+  n = loop_range.stop - loop_range.start
+  if n <= 0:
+    return None
+  sum_of_loop_var = (loop_range.start + loop_range.stop - 1) * n // 2
+  sums = []
+  for value, terms in accumulators:
+    if not isinstance(value, int):
+      return None
+    for sign, linear, factor in terms:
+      if not isinstance(factor, int):
+        return None
+      value += sign * factor * (sum_of_loop_var if linear else n)
+    sums.append(value)
+  sums.append(loop_range.stop - 1)
+  return sums
+
+def _shanghai_memoize(maxsize):
+  """Returns a decorator that memoizes a pure 套路.
+
+  At most maxsize results are kept; the least recently used goes first.
+  Calls with unhashable arguments aren't memoized.
+  """
+  def Decorator(func):
+    # typed, so that e.g. 1 and 对额 (True) don't share a result.
+    cached_func = functools.lru_cache(maxsize, typed=True)(func)
+
+    @functools.wraps(func)
+    def Memoized(*args):
+      try:
+        hash(args)
+      except TypeError:
+        return func(*args)
+      return cached_func(*args)
+
+    Memoized.cache_info = cached_func.cache_info
+    return Memoized
+  return Decorator
+
 class ConcatExpr(Expr):
+  __slots__ = ('exprs',)
+
   def __init__(self, exprs):
     self.exprs = exprs
 
@@ -198,9 +344,25 @@ class ConcatExpr(Expr):
   def Equals(self, other):
     return self.exprs == other.exprs
 
-  def ToPython(self):
-    return ' + '.join('_shanghai_str(%s)' % (
-        expr.ToPython(),) for expr in self.exprs)
+  def ToPython(self, symbols):
+    return ' + '.join(
+        expr.ToPython(symbols) if IsStringLiteral(expr) else
+        '_shanghai_str(%s)' % (expr.ToPython(symbols),)
+        for expr in self.exprs)
+
+  def ToPythonAst(self, symbols):
+    node = None
+    for expr in self.exprs:
+      if IsStringLiteral(expr):
+        str_node = expr.ToPythonAst(symbols)
+      else:
+        str_node = PythonCallAst('_shanghai_str',
+                                 [expr.ToPythonAst(symbols)])
+      if node is None:
+        node = str_node
+      else:
+        node = ast.BinOp(left=node, op=ast.Add(), right=str_node)
+    return node
 
 ARITHMETIC_OPERATION_TO_PYTHON = {
     KW_PLUS: '+',
@@ -210,7 +372,17 @@ ARITHMETIC_OPERATION_TO_PYTHON = {
     KW_INTEGER_DIVIDE_BY: '//'
     }
 
+ARITHMETIC_OPERATION_TO_PYTHON_AST = {
+    KW_PLUS: ast.Add,
+    KW_MINUS: ast.Sub,
+    KW_TIMES: ast.Mult,
+    KW_DIVIDE_BY: ast.Div,
+    KW_INTEGER_DIVIDE_BY: ast.FloorDiv,
+    }
+
 class ArithmeticExpr(Expr):
+  __slots__ = ('op1', 'operation', 'op2')
+
   def __init__(self, op1, operation, op2):
     self.op1 = op1
     self.operation = operation
@@ -225,13 +397,21 @@ class ArithmeticExpr(Expr):
             self.operation == other.operation and
             self.op2 == other.op2)
 
-  def ToPython(self):
-    return '%s %s %s' % (self.op1.ToPython(),
+  def ToPython(self, symbols):
+    return '%s %s %s' % (self.op1.ToPython(symbols),
                          ARITHMETIC_OPERATION_TO_PYTHON[
                              self.operation.value],
-                         self.op2.ToPython())
+                         self.op2.ToPython(symbols))
+
+  def ToPythonAst(self, symbols):
+    return ast.BinOp(
+        left=self.op1.ToPythonAst(symbols),
+        op=ARITHMETIC_OPERATION_TO_PYTHON_AST[self.operation.value](),
+        right=self.op2.ToPythonAst(symbols))
 
 class LiteralExpr(Expr):
+  __slots__ = ('token',)
+
   def __init__(self, token):
     self.token = token
 
@@ -241,13 +421,25 @@ class LiteralExpr(Expr):
   def Equals(self, other):
     return self.token == other.token
 
-  def ToPython(self):
-    if self.token.kind == TK_INTEGER_LITERAL:
+  def ToPython(self, symbols):
+    if self.token.kind in (TK_INTEGER_LITERAL, TK_BOOL_LITERAL):
       return str(self.token.value)
     if self.token.kind == TK_STRING_LITERAL:
       return 'u"%s"' % (self.token.value,)
     raise Exception('Unexpected token kind %s' % (self.token.kind,))
 
+  def ToPythonAst(self, symbols):
+    if self.token.kind in (TK_INTEGER_LITERAL, TK_STRING_LITERAL,
+                           TK_BOOL_LITERAL):
+      return ast.Constant(value=self.token.value)
+    raise Exception('Unexpected token kind %s' % (self.token.kind,))
+
+def IsStringLiteral(expr):
+  """Returns true if expr is a string literal, which _shanghai_str() leaves
+  as is."""
+  return (isinstance(expr, LiteralExpr) and
+          expr.token.kind == TK_STRING_LITERAL)
+
 def IntegerLiteralExpr(value):
   return LiteralExpr(Token(TK_INTEGER_LITERAL, value))
 
@@ -255,6 +447,8 @@ def StringLiteralExpr(value):
   return LiteralExpr(Token(TK_STRING_LITERAL, value))
 
 class VariableExpr(Expr):
+  __slots__ = ('var',)
+
   def __init__(self, var):
     self.var = var
 
@@ -264,10 +458,15 @@ class VariableExpr(Expr):
   def Equals(self, other):
     return self.var == other.var
 
-  def ToPython(self):
-    return GetPythonVarName(self.var)
+  def ToPython(self, symbols):
+    return symbols.GetPythonVarName(self.var)
+
+  def ToPythonAst(self, symbols):
+    return PythonNameAst(symbols.GetPythonVarName(self.var), ast.Load())
 
 class ParenExpr(Expr):
+  __slots__ = ('expr',)
+
   def __init__(self, expr):
     self.expr = expr
 
@@ -277,10 +476,15 @@ class ParenExpr(Expr):
   def Equals(self, other):
     return self.expr == other.expr
 
-  def ToPython(self):
-    return '(%s)' % (self.expr.ToPython(),)
+  def ToPython(self, symbols):
+    return '(%s)' % (self.expr.ToPython(symbols),)
+
+  def ToPythonAst(self, symbols):
+    return self.expr.ToPythonAst(symbols)
 
 class CallExpr(Expr):
+  __slots__ = ('func', 'args')
+
   def __init__(self, func, args):
     self.func = func
     self.args = args
@@ -293,10 +497,14 @@ class CallExpr(Expr):
     return (self.func == other.func and
             self.args == other.args)
 
-  def ToPython(self):
+  def ToPython(self, symbols):
     return '%s(%s)' % (
-        GetPythonVarName(self.func),
-        ', '.join(arg.ToPython() for arg in self.args))
+        symbols.GetPythonVarName(self.func),
+        ', '.join(arg.ToPython(symbols) for arg in self.args))
+
+  def ToPythonAst(self, symbols):
+    return PythonCallAst(symbols.GetPythonVarName(self.func),
+                         [arg.ToPythonAst(symbols) for arg in self.args])
 
 # Maps a shanghai comparison keyword to the Python version.
 COMPARISON_KEYWORD_TO_PYTHON = {
@@ -306,7 +514,16 @@ COMPARISON_KEYWORD_TO_PYTHON = {
     KW_NOT_EQUAL: '!=',
     }
 
+COMPARISON_KEYWORD_TO_PYTHON_AST = {
+    KW_GREATER: ast.Gt,
+    KW_LESS: ast.Lt,
+    KW_EQUAL: ast.Eq,
+    KW_NOT_EQUAL: ast.NotEq,
+    }
+
 class ComparisonExpr(Expr):
+  __slots__ = ('op1', 'relation', 'op2')
+
   def __init__(self, op1, relation, op2):
     self.op1 = op1
     self.relation = relation
@@ -321,17 +538,34 @@ class ComparisonExpr(Expr):
             self.relation == other.relation and
             self.op2 == other.op2)
 
-  def ToPython(self):
+  def ToPython(self, symbols):
     if self.relation.value == KW_IS_NONE:
-      return f'({self.op1.ToPython()}) is None'
-    return '%s %s %s' % (self.op1.ToPython(),
+      return f'({self.op1.ToPython(symbols)}) is None'
+    return '%s %s %s' % (self.op1.ToPython(symbols),
                          COMPARISON_KEYWORD_TO_PYTHON[self.relation.value],
-                         self.op2.ToPython())
+                         self.op2.ToPython(symbols))
+
+  def ToPythonAst(self, symbols):
+    if self.relation.value == KW_IS_NONE:
+      return ast.Compare(left=self.op1.ToPythonAst(symbols),
+                         ops=[ast.Is()],
+                         comparators=[ast.Constant(value=None)])
+    return ast.Compare(
+        left=self.op1.ToPythonAst(symbols),
+        ops=[COMPARISON_KEYWORD_TO_PYTHON_AST[self.relation.value]()],
+        comparators=[self.op2.ToPythonAst(symbols)])
 
 class Statement:
-  def __init__(self, kind, value):
+  # line and column are where the statement starts in the source code:
+  # line counts from 1, column counts chars from 0 like Python's col_offset.
+  # They are None for statements not parsed from source.
+  __slots__ = ('kind', 'value', 'line', 'column')
+
+  def __init__(self, kind, value, line=None, column=None):
     self.kind = kind
     self.value = value
+    self.line = line
+    self.column = column
 
   def __str__(self):
     value_str = str(self.value)
@@ -348,72 +582,151 @@ class Statement:
   def __ne__(self, other):
     return not (self == other)
 
+def CopyLocation(stmt, old_stmt):
+  """Gives stmt the source location of old_stmt, which it replaces.  Returns
+  stmt."""
+  stmt.line = old_stmt.line
+  stmt.column = old_stmt.column
+  return stmt
+
+# The one token for each keyword, so that the tokenizer and the parser don't
+# make a new one every time.  They are shared, so never change them.
+KEYWORD_TOKENS = {keyword: Token(TK_KEYWORD, keyword) for keyword in KEYWORDS}
+
 def Keyword(str):
   """Returns a keyword token whose value is the given string."""
-  return Token(TK_KEYWORD, str)
+  token = KEYWORD_TOKENS.get(str)
+  return token if token is not None else Token(TK_KEYWORD, str)
 
-def TokenizeStringLiteralAndRest(code):
-  close_quote_pos = code.find(KW_CLOSE_QUOTE)
-  if close_quote_pos < 0:
-    yield Token(TK_STRING_LITERAL, code)
-    return
+# Whitespace and comments (which run to the end of the line).
+WHITESPACE_AND_COMMENT_RE = re.compile(r'(?:\s+|#[^\n]*)*')
+
+# 【标识符】, which must be closed on the same line.
+BRACKETED_IDENTIFIER_RE = re.compile(r'【(.*?)】')
 
-  yield Token(TK_STRING_LITERAL, code[:close_quote_pos])
-  yield Keyword(KW_CLOSE_QUOTE)
-  for tk in BasicTokenize(code[close_quote_pos + len(KW_CLOSE_QUOTE):]):
-    yield tk
+def SkipWhitespaceAndCommentAt(code, pos):
+  """Returns the position of the first char at or after pos that is not part
+  of whitespace or a comment."""
+  return WHITESPACE_AND_COMMENT_RE.match(code, pos).end()
 
 def SkipWhitespaceAndComment(code):
-  while True:
-    old_len = len(code)
-    code = code.lstrip()
-    if code.startswith('#'):  # comment
-      code = re.sub(r'^.*', '', code)  # Ignore the comment line.
-    if len(code) == old_len:  # cannot skip any further.
-      return code
+  return code[SkipWhitespaceAndCommentAt(code, 0):]
 
-def TryParseKeyword(keyword, code):
-  """Returns (parsed keyword string, remaining code)."""
-  orig_code = code
+def MatchKeywordAt(keyword, code, pos):
+  """Returns the position right after keyword if it starts at pos, or None.
+
+  Whitespace and comments are allowed between the chars of the keyword.
+  """
   for char in keyword:
-    code = SkipWhitespaceAndComment(code)
-    if not code.startswith(char):
-      return None, orig_code
-    code = code[1:]
-  return keyword, code
-
-def BasicTokenize(code):
-  code = SkipWhitespaceAndComment(code)
-  if not code:
-    return
+    pos = SkipWhitespaceAndCommentAt(code, pos)
+    if not code.startswith(char, pos):
+      return None
+    pos += 1
+  return pos
 
-  # Parse 【标识符】.
-  m = re.match('^(【(.*?)】)', code)
-  if m:
-    id = re.sub(r'\s+', '', m.group(2))  # Ignore whitespace.
-    yield IdentifierToken(id)
-    for tk in BasicTokenize(code[len(m.group(1)):]):
-      yield tk
-    return
+def TryParseKeyword(keyword, code):
+  """Returns (parsed keyword string, remaining code)."""
+  pos = MatchKeywordAt(keyword, code, 0)
+  if pos is None:
+    return None, code
+  return keyword, code[pos:]
 
-  # Try to parse a keyword at the beginning of the code.
-  for keyword in KEYWORDS:
-    kw, remaining_code = TryParseKeyword(keyword, code)
-    if kw:
-      keyword = KEYWORD_TO_NORMALIZED_KEYWORD.get(keyword, keyword)
-      last_token = Keyword(keyword)
-      yield last_token
-      if last_token == Keyword(KW_OPEN_QUOTE):
-        for tk in TokenizeStringLiteralAndRest(remaining_code):
-          yield tk
-      else:
-        for tk in BasicTokenize(remaining_code.lstrip()):
-          yield tk
+class KeywordTrieNode:
+  def __init__(self):
+    self.children = {}  # Maps a char to the child node.
+    self.keyword = None  # The keyword ending at this node, if any.
+    self.rank = None  # Index of self.keyword in KEYWORDS.
+
+def BuildKeywordTrie(keywords):
+  """Returns the root of a trie holding the given keywords."""
+  root = KeywordTrieNode()
+  for rank, keyword in enumerate(keywords):
+    node = root
+    for char in keyword:
+      node = node.children.setdefault(char, KeywordTrieNode())
+    if node.keyword is None:
+      node.keyword = keyword
+      node.rank = rank
+  return root
+
+KEYWORD_TRIE = BuildKeywordTrie(KEYWORDS)
+
+def ParseKeywordAt(code, pos):
+  """Returns (normalized keyword, position after it) for the keyword that
+  starts at pos, or (None, pos) if there isn't one.
+
+  This walks KEYWORD_TRIE once instead of trying each keyword in turn.  When
+  several keywords match, the one listed first in KEYWORDS wins, just like
+  trying them in order would.  Whitespace and comments are allowed between
+  the chars of a keyword.
+  """
+  node = KEYWORD_TRIE
+  keyword, rank, keyword_end = None, None, pos
+  while True:
+    char = code[pos:pos + 1]
+    if char.isspace() or char == '#':
+      pos = SkipWhitespaceAndCommentAt(code, pos)
+      char = code[pos:pos + 1]
+    node = node.children.get(char)
+    if node is None:
+      break
+    pos += 1
+    if node.keyword is not None and (rank is None or node.rank < rank):
+      keyword, rank, keyword_end = node.keyword, node.rank, pos
+  if keyword is None:
+    return None, keyword_end
+  return KEYWORD_TO_NORMALIZED_KEYWORD.get(keyword, keyword), keyword_end
+
+def TokenizeStringLiteralAndRest(code, pos=0):
+  """Tokenizes code, starting from position pos inside a string literal."""
+  return BasicTokenize(code, pos, in_string_literal=True)
+
+def BasicTokenize(code, pos=0, in_string_literal=False, positions=None):
+  """Yields the basic tokens of code, starting from position pos.
+
+  If positions (a list) is given, the position in code where each token
+  starts is appended to it as the token is yielded.  The code is walked once
+  with a cursor, so this takes linear time and doesn't recurse no matter how
+  long the code is.
+  """
+  while True:
+    if in_string_literal:
+      in_string_literal = False
+      close_quote_pos = code.find(KW_CLOSE_QUOTE, pos)
+      if positions is not None:
+        positions.append(pos)
+      if close_quote_pos < 0:
+        yield Token(TK_STRING_LITERAL, code[pos:])
+        return
+      yield Token(TK_STRING_LITERAL, code[pos:close_quote_pos])
+      if positions is not None:
+        positions.append(close_quote_pos)
+      yield Keyword(KW_CLOSE_QUOTE)
+      pos = close_quote_pos + len(KW_CLOSE_QUOTE)
+
+    pos = SkipWhitespaceAndCommentAt(code, pos)
+    if pos >= len(code):
       return
-
-  yield Token(TK_CHAR, code[0])
-  for tk in BasicTokenize(code[1:]):
-    yield tk
+    if positions is not None:
+      positions.append(pos)
+
+    # Parse 【标识符】.
+    m = BRACKETED_IDENTIFIER_RE.match(code, pos)
+    if m:
+      id = re.sub(r'\s+', '', m.group(1))  # Ignore whitespace.
+      yield IdentifierToken(id)
+      pos = m.end()
+      continue
+
+    # Try to parse a keyword at the current position.
+    keyword, keyword_end = ParseKeywordAt(code, pos)
+    if keyword:
+      yield Keyword(keyword)
+      pos = keyword_end
+      in_string_literal = keyword == KW_OPEN_QUOTE
+    else:
+      yield Token(TK_CHAR, code[pos])
+      pos += 1
 
 
 CHINESE_DIGITS = {
@@ -459,77 +772,207 @@ def ParseChars(chars):
   if rest:
     yield IdentifierToken(rest)
 
-def Tokenize(code):
+def LocateCharsTokens(chars, char_positions, positions):
+  """Yields the tokens of ParseChars(chars), appending where each starts to
+  positions, given where each of chars is in char_positions."""
+  for token in ParseChars(chars):
+    if token.kind == TK_INTEGER_LITERAL:
+      positions.append(char_positions[0])
+    else:
+      positions.append(char_positions[len(chars) - len(token.value)])
+    yield token
+
+def Tokenize(code, positions=None):
+  """Yields the tokens of code.
+
+  If positions (a list or an array) is given, the position in code where
+  each token starts is appended to it as the token is yielded.
+  """
+  if positions is None:
+    basic_positions = None
+  else:
+    basic_positions = []  # Holds the position of the last basic token.
+    take_position = basic_positions.pop
+    char_positions = []  # Where the chars in chars are.
   last_token = Token(None, None)
   chars = ''
-  for token in BasicTokenize(code):
+  for token in BasicTokenize(code, positions=basic_positions):
     last_last_token = last_token
     last_token = token
     if token.kind == TK_CHAR:
       if last_last_token.kind == TK_CHAR:
         chars += token.value
+        if positions is not None:
+          char_positions.append(take_position())
         continue
       else:
         chars = token.value
+        if positions is not None:
+          char_positions = [take_position()]
         continue
     else:
       if last_last_token.kind == TK_CHAR:
         # A sequence of consecutive TK_CHARs ended.
-        for tk in ParseChars(chars):
-          yield tk
+        if positions is None:
+          yield from ParseChars(chars)
+        else:
+          yield from LocateCharsTokens(chars, char_positions, positions)
+      if positions is not None:
+        positions.append(take_position())
       yield token
       chars = ''
-  for tk in ParseChars(chars):
-    yield tk
+  if positions is None:
+    yield from ParseChars(chars)
+  elif chars:
+    yield from LocateCharsTokens(chars, char_positions, positions)
+
+# Identifiers starting with one of these are used in Python as they are.
+PYTHON_NAME_START_CHARS = frozenset(string.ascii_letters + '_')
+
+class SymbolTable:
+  """Maps identifiers to Python names for one compilation.
+
+  Chinese identifiers get the names _db_var0, _db_var1, ... in the order they
+  are first seen, so the same program always compiles to the same code,
+  whatever was compiled before it.
+  """
 
-vars = {}  # Maps Chinese identifier to generated identifier.
-def GetPythonVarName(var):
-  if re.match(r'[_a-zA-Z]', var):
-    # var starts with a letter or _.  Don't translate it.
-    return var
+  def __init__(self):
+    self.names = {}  # Maps identifier to Python name.
+    self.num_generated_names = 0
+
+  def GetPythonVarName(self, var):
+    name = self.names.get(var)
+    if name is None:
+      if var[:1] in PYTHON_NAME_START_CHARS:
+        # var starts with a letter or _.  Don't translate it.
+        name = var
+      else:
+        # var is a Chinese identifier.
+        name = '_db_var%d' % (self.num_generated_names,)
+        self.num_generated_names += 1
+      self.names[var] = name
+    return name
+
+class SourceLines:
+  """Turns positions in a piece of source code into lines and columns.
+
+  The piece starts at first_line and first_column of the whole source, so
+  a sentence of a file can be located on its own.
+  """
+
+  def __init__(self, code, first_line=1, first_column=0):
+    self.line_starts = array.array('q', [0])
+    self.line_starts.extend(m.end() for m in NEWLINE_RE.finditer(code))
+    self.first_line = first_line
+    self.first_column = first_column
+
+  def GetLocation(self, pos):
+    """Returns (line, column) of the char at pos."""
+    index = bisect.bisect_right(self.line_starts, pos) - 1
+    column = pos - self.line_starts[index]
+    if index == 0:
+      column += self.first_column
+    return self.first_line + index, column
+
+  def GetEnd(self, code):
+    """Returns (line, column) right after code, the piece these are the
+    lines of, so the next piece can be located from there."""
+    return self.GetLocation(len(code))
+
+NEWLINE_RE = re.compile('\n')
+
+def TokenizeWithPositions(code):
+  """Returns the tokens of code as a list, and where they start in code as
+  an array."""
+  positions = array.array('q')
+  return list(Tokenize(code, positions)), positions
+
+class TokenStream:
+  """A cursor over a list of tokens.
+
+  Consuming a token just moves the cursor forward, so the parser never copies
+  the remaining tokens.  Backtracking restores a position returned by Save().
+
+  If the positions in the source code where the tokens start are given,
+  with the SourceLines of the code, the statements parsed from the stream
+  are given their line and column.
+  """
+
+  def __init__(self, tokens, positions=None, lines=None):
+    self.tokens = tokens if isinstance(tokens, list) else list(tokens)
+    self.pos = 0
+    self.positions = positions
+    self.lines = lines
+
+  def __len__(self):
+    return len(self.tokens) - self.pos
+
+  def __str__(self):
+    return str(self.tokens[self.pos:])
+
+  def __repr__(self):
+    return self.__str__()
 
-  # var is a Chinese identifier.
+  def Peek(self):
+    """Returns the next token, or None if there isn't any."""
+    if self.pos < len(self.tokens):
+      return self.tokens[self.pos]
+    return None
 
-  if var in vars:
-    return vars[var]
+  def Advance(self):
+    """Consumes and returns the next token."""
+    token = self.tokens[self.pos]
+    self.pos += 1
+    return token
 
-  generated_var = '_db_var%d' % (len(vars),)
-  vars[var] = generated_var
-  return generated_var
+  def Save(self):
+    """Returns the current position, to be passed to Restore()."""
+    return self.pos
+
+  def Restore(self, pos):
+    self.pos = pos
 
 def TryConsumeTokenType(tk_type, tokens):
-  if not tokens:
-    return (None, tokens)
-  if tokens[0].kind == tk_type:
-    return (tokens[0], tokens[1:])
+  token = tokens.Peek()
+  if token is not None and token.kind == tk_type:
+    return (tokens.Advance(), tokens)
   return (None, tokens)
 
 def ConsumeTokenType(tk_type, tokens):
   tk, tokens = TryConsumeTokenType(tk_type, tokens)
   if tk is None:
-    sys.exit('期望 %s，实际是 %s' % (tk_type, tokens[0]))
+    sys.exit('期望 %s，实际是 %s' % (tk_type, tokens.Peek()))
   return tk, tokens
 
 def TryConsumeToken(token, tokens):
-  if not tokens:
+  if token != tokens.Peek():
     return (None, tokens)
-  if token != tokens[0]:
-    return (None, tokens)
-  return (token, tokens[1:])
+  tokens.Advance()
+  return (token, tokens)
 
 def TryConsumeKeyword(keyword, tokens):
-  return TryConsumeToken(Keyword(keyword), tokens)
+  # Keyword tokens are unique, so they can be compared by identity.
+  token = KEYWORD_TOKENS[keyword]
+  if tokens.Peek() is not token:
+    return (None, tokens)
+  tokens.Advance()
+  return (token, tokens)
 
 def ConsumeToken(token, tokens):
   if not tokens:
     sys.exit('语句结束太早。')
-  if token != tokens[0]:
+  if token != tokens.Peek():
     sys.exit('期望符号 %s，实际却是 %s。' %
-             (token, tokens[0]))
-  return token, tokens[1:]
+             (token, tokens.Peek()))
+  tokens.Advance()
+  return token, tokens
 
 def ConsumeKeyword(keyword, tokens):
-  return ConsumeToken(Keyword(keyword), tokens)
+  token, tokens = TryConsumeKeyword(keyword, tokens)
+  if token is None:
+    return ConsumeToken(KEYWORD_TOKENS[keyword], tokens)  # Reports the error.
+  return token, tokens
 
 # Expression grammar:
 #
@@ -616,7 +1059,7 @@ def ParseTermExpr(tokens):
   operators = []  # Operators between the factors. The len of this is len(factors) - 1.
 
   while True:
-    pre_operator_tokens = tokens
+    pre_operator_pos = tokens.Save()
     operator, tokens = TryConsumeKeyword(KW_TIMES, tokens)
     if not operator:
       operator, tokens = TryConsumeKeyword(KW_DIVIDE_BY, tokens)
@@ -631,7 +1074,7 @@ def ParseTermExpr(tokens):
       factors.append(factor)
     else:
       # We have a trailing operator without a factor to follow it.
-      tokens = pre_operator_tokens
+      tokens.Restore(pre_operator_pos)
       break
 
   assert len(factors) == len(operators) + 1
@@ -649,7 +1092,7 @@ def ParseArithmeticExpr(tokens):
   operators = []  # Operators between the terms. The len of this is len(terms) - 1.
 
   while True:
-    pre_operator_tokens = tokens
+    pre_operator_pos = tokens.Save()
     operator, tokens = TryConsumeKeyword(KW_PLUS, tokens)
     if not operator:
       operator, tokens = TryConsumeKeyword(KW_MINUS, tokens)
@@ -662,7 +1105,7 @@ def ParseArithmeticExpr(tokens):
       terms.append(term)
     else:
       # We have a trailing operator without a term to follow it.
-      tokens = pre_operator_tokens
+      tokens.Restore(pre_operator_pos)
       break
 
   assert len(terms) == len(operators) + 1
@@ -705,7 +1148,7 @@ def ParseExpr(tokens):
 
   nc_exprs = [nc_expr]
   while True:
-    pre_operator_tokens = tokens
+    pre_operator_pos = tokens.Save()
     concat, tokens = TryConsumeKeyword(KW_CONCAT, tokens)
     if not concat:
       break
@@ -715,7 +1158,7 @@ def ParseExpr(tokens):
       nc_exprs.append(nc_expr)
     else:
       # We have a trailing concat operator without an expression to follow it.
-      tokens = pre_operator_tokens
+      tokens.Restore(pre_operator_pos)
       break
 
   if len(nc_exprs) == 1:
@@ -724,12 +1167,18 @@ def ParseExpr(tokens):
   return ConcatExpr(nc_exprs), tokens
 
 def ParseExprFromStr(str):
-  return ParseExpr(list(Tokenize(str)))
+  return ParseExpr(TokenStream(Tokenize(str)))
 
 def ParseStmt(tokens):
   """Returns (statement, remainding_tokens)."""
+  start = tokens.pos
+  stmt, tokens = _ParseStmt(tokens)
+  if stmt is not None and tokens.lines is not None:
+    stmt.line, stmt.column = tokens.lines.GetLocation(tokens.positions[start])
+  return stmt, tokens
 
-  orig_tokens = tokens
+def _ParseStmt(tokens):
+  orig_pos = tokens.Save()
 
   # Parse 阿庆，上
   imp, tokens = TryConsumeKeyword(KW_IMPORT, tokens)
@@ -793,7 +1242,8 @@ def ParseStmt(tokens):
   # Parse an identifier name.
   id, tokens = TryConsumeTokenType(TK_IDENTIFIER, tokens)
   if not id:
-    return (None, orig_tokens)
+    tokens.Restore(orig_pos)
+    return (None, tokens)
 
   # Code below is for statements that start with an identifier.
 
@@ -866,9 +1316,9 @@ def ParseStmt(tokens):
         break
       _, tokens = ConsumeKeyword(KW_COMMA, tokens)
 
-    func_def, tokens = ConsumeToken(
-        Keyword(KW_FUNC_DEF), tokens)
+    func_def, tokens = ConsumeKeyword(KW_FUNC_DEF, tokens)
     stmts, tokens = ParseStmts(tokens)
+    stmts = LocalizeImports(params, stmts)
     _, tokens = ConsumeKeyword(KW_END, tokens)
     _, tokens = ConsumeKeyword(KW_PERIOD, tokens)
     return (Statement(STMT_FUNC_DEF, (id, params, stmts)), tokens)
@@ -876,14 +1326,16 @@ def ParseStmt(tokens):
   func_def, tokens = TryConsumeKeyword(KW_FUNC_DEF, tokens)
   if func_def:
     stmts, tokens = ParseStmts(tokens)
+    stmts = LocalizeImports([], stmts)
     _, tokens = ConsumeKeyword(KW_END, tokens)
     _, tokens = ConsumeKeyword(KW_PERIOD, tokens)
     return (Statement(STMT_FUNC_DEF, (id, [], stmts)), tokens)
 
-  return (None, orig_tokens)
+  tokens.Restore(orig_pos)
+  return (None, tokens)
 
 def ParseStmtFromStr(tokens):
-  return ParseStmt(list(Tokenize(tokens)))
+  return ParseStmt(TokenStream(Tokenize(tokens)))
 
 def ParseStmts(tokens):
   """Returns (statement list, remaining tokens)."""
@@ -895,53 +1347,97 @@ def ParseStmts(tokens):
       return stmts, tokens
     stmts.append(stmt)
 
-def TranslateStatementToPython(stmt, indent = ''):
+def AffineFactorsToPython(factors, symbols):
+  """Translates the product of the factors to Python code."""
+  if not factors:
+    return '1'
+  return ' * '.join(
+      '(%s)' % (f.ToPython(symbols),) if isinstance(f, ArithmeticExpr)
+      else f.ToPython(symbols) for f in factors)
+
+def TranslateStatementToPython(stmt, symbols, indent = ''):
   """Translates the statements to Python code, without trailing newline."""
 
   if stmt.kind == STMT_VAR_DECL:
     var_token = stmt.value
-    var = GetPythonVarName(var_token.value)
+    var = symbols.GetPythonVarName(var_token.value)
     return indent + '%s = None' % (var,)
 
   if stmt.kind == STMT_ASSIGN:
     var_token, expr = stmt.value
-    var = GetPythonVarName(var_token.value)
-    return indent + '%s = %s' % (var, expr.ToPython())
+    var = symbols.GetPythonVarName(var_token.value)
+    return indent + '%s = %s' % (var, expr.ToPython(symbols))
 
   if stmt.kind == STMT_SAY:
     expr = stmt.value
+    if IsStringLiteral(expr):
+      return indent + '_db_append_output(u"%s\\n")' % (expr.token.value,)
     return indent + '_db_append_output("%%s\\n" %% (_shanghai_str(%s),))' % (
-        expr.ToPython(),)
+        expr.ToPython(symbols),)
 
   if stmt.kind == STMT_INC_BY:
     var_token, expr = stmt.value
-    var = GetPythonVarName(var_token.value)
-    return indent + f'{var} += {expr.ToPython()}'
+    var = symbols.GetPythonVarName(var_token.value)
+    return indent + f'{var} += {expr.ToPython(symbols)}'
 
   if stmt.kind == STMT_DEC_BY:
     var_token, expr = stmt.value
-    var = GetPythonVarName(var_token.value)
-    return indent + '%s -= %s' % (var, expr.ToPython())
+    var = symbols.GetPythonVarName(var_token.value)
+    return indent + '%s -= %s' % (var, expr.ToPython(symbols))
 
   if stmt.kind == STMT_LOOP:
     var_token, from_val, to_val, stmts = stmt.value
-    var = GetPythonVarName(var_token.value)
-    loop = indent + 'for %s in range(%s, %s + 1):' % (
-        var, from_val.ToPython(),
-        to_val.ToPython())
+    target, loop_range, stmts = TickingLoopToPython(
+        symbols.GetPythonVarName(var_token.value),
+        'range(%s, %s + 1)' % (from_val.ToPython(symbols),
+                               to_val.ToPython(symbols)), stmts)
+    loop = indent + 'for %s in %s:' % (target, loop_range)
     for s in stmts:
-      loop += '\n' + TranslateStatementToPython(s, indent + '  ')
+      loop += '\n' + TranslateStatementToPython(s, symbols, indent + '  ')
     if not stmts:
       loop += '\n' + indent + '  pass'
     return loop
 
+  if stmt.kind == STMT_AFFINE_LOOP:
+    # Sum in closed form if possible, else loop.  See _shanghai_affine_sums().
+    var_token, from_val, to_val, stmts = stmt.value
+    var = symbols.GetPythonVarName(var_token.value)
+    acc_names = []
+    accumulators = []
+    for acc_token, terms in GetAffineLoopTerms(stmt.value):
+      acc_names.append(symbols.GetPythonVarName(acc_token.value))
+      accumulators.append('(%s, (%s,))' % (acc_names[-1], ', '.join(
+          '(%d, %s, %s)' % (sign, linear,
+                            AffineFactorsToPython(factors, symbols))
+          for sign, linear, factors in terms)))
+    target, loop_range, stmts = TickingLoopToPython(var, '_db_loop_range',
+                                                    stmts)
+    code = '\n'.join([
+        '_db_loop_range = range(%s, %s + 1)' % (
+            from_val.ToPython(symbols), to_val.ToPython(symbols)),
+        'try:',
+        '  _db_loop_sums = _shanghai_affine_sums(_db_loop_range, (%s,))' % (
+            ', '.join(accumulators),),
+        'except Exception:',
+        '  _db_loop_sums = None',
+        'if _db_loop_sums is None:',
+        '  for %s in %s:' % (target, loop_range)])
+    code = '\n'.join(indent + line for line in code.split('\n'))
+    for s in stmts:
+      code += '\n' + TranslateStatementToPython(s, symbols, indent + '    ')
+    code += '\n' + indent + 'else:'
+    code += '\n' + indent + '  %s = _db_loop_sums' % (
+        ', '.join(acc_names + [var]),)
+    return code
+
   if stmt.kind == STMT_FUNC_DEF:
     func_token, params, stmts = stmt.value
-    func_name = GetPythonVarName(func_token.value)
-    param_names = map(lambda tk: GetPythonVarName(tk.value), params)
+    func_name = symbols.GetPythonVarName(func_token.value)
+    param_names = map(lambda tk: symbols.GetPythonVarName(tk.value),
+                      params)
     code = indent + 'def %s(%s):' % (func_name, ', '.join(param_names))
     for s in stmts:
-      code += '\n' + TranslateStatementToPython(s, indent + '  ')
+      code += '\n' + TranslateStatementToPython(s, symbols, indent + '  ')
     if not stmts:
       code += '\n' + indent + '  pass'
     return code
@@ -949,82 +1445,3068 @@ def TranslateStatementToPython(stmt, indent = ''):
   if stmt.kind == STMT_CALL:
     func = stmt.value.func
     args = stmt.value.args
-    func_name = GetPythonVarName(func)
-    code = indent + '%s(%s)' % (func_name,
-                                ', '.join(arg.ToPython() for arg in args))
+    func_name = symbols.GetPythonVarName(func)
+    code = indent + '%s(%s)' % (
+        func_name, ', '.join(arg.ToPython(symbols) for arg in args))
     return code
 
   if stmt.kind == STMT_RETURN:
-    return indent + 'return ' + stmt.value.ToPython()
+    return indent + 'return ' + stmt.value.ToPython(symbols)
+
+  if stmt.kind == STMT_TAIL_CALL:
+    params, args = stmt.value
+    code = ''
+    if params:
+      code = indent + '%s = %s\n' % (
+          ', '.join(symbols.GetPythonVarName(tk.value) for tk in params),
+          ', '.join(arg.ToPython(symbols) for arg in args))
+    return code + indent + 'continue'
+
+  if stmt.kind == STMT_TAIL_CALL_LOOP:
+    stmts = stmt.value
+    if stmts and stmts[0] is TICK_STATEMENT:
+      code = indent + 'for _db_step in _db_fuel:'
+      stmts = stmts[1:]
+    else:
+      code = indent + 'while True:'
+    for s in stmts:
+      code += '\n' + TranslateStatementToPython(s, symbols, indent + '  ')
+    if FallsThrough(stmts[-1]):
+      code += '\n' + indent + '  return None'
+    return code
+
+  if stmt.kind == STMT_TICK:
+    return indent + 'next(_db_fuel)'
 
   if stmt.kind == STMT_COMPOUND:
     code = indent + 'if True:'
     stmts = stmt.value
     if stmts:
       for s in stmts:
-        code += '\n' + TranslateStatementToPython(s, indent + '  ')
+        code += '\n' + TranslateStatementToPython(s, symbols, indent + '  ')
     else:
       code += '\n' + indent + '  pass'
     return code
 
   if stmt.kind == STMT_CONDITIONAL:
     condition, then_stmt, else_stmt = stmt.value
-    code = indent + 'if %s:\n' % (condition.ToPython(),)
-    code += TranslateStatementToPython(then_stmt, indent + '  ')
+    code = indent + 'if %s:\n' % (condition.ToPython(symbols),)
+    code += TranslateStatementToPython(then_stmt, symbols, indent + '  ')
     if else_stmt:
       code += '\n' + indent + 'else:\n'
-      code += TranslateStatementToPython(else_stmt, indent + '  ')
+      code += TranslateStatementToPython(else_stmt, symbols, indent + '  ')
     return code
 
   if stmt.kind == STMT_DELETE:
-    return indent + GetPythonVarName(stmt.value.value) + ' = None'
+    return indent + symbols.GetPythonVarName(stmt.value.value) + ' = None'
 
   if stmt.kind == STMT_IMPORT:
-    return indent + f'import {stmt.value.value}'
+    module = stmt.value.value
+    symbols.GetPythonVarName(module.partition('.')[0])
+    return indent + '_shanghai_import(%s, globals())' % (repr(module),)
+
+  if stmt.kind == STMT_LOCAL_IMPORT:
+    module, names = stmt.value
+    module = module.value
+    top = module.partition('.')[0]
+    code = indent + '_db_values = _shanghai_import(%r, globals(), %r)\n' % (
+        module, names)
+    code += indent + '%s = _db_values[%r]' % (symbols.GetPythonVarName(top),
+                                              top)
+    return code + BindingsToPython(
+        [(var, symbols.GetPythonVarName(var)) for var in names], indent)
+
+  if stmt.kind == STMT_BIND_GLOBALS:
+    py_names = tuple(symbols.GetPythonVarName(var) for var in stmt.value)
+    code = indent + '_db_values = _shanghai_globals(globals(), %r)' % (
+        py_names,)
+    return code + BindingsToPython(zip(py_names, py_names), indent)
+
+  sys.exit('我不懂 %s 语句哪能执行。' % (stmt.kind))
+
+def BindingsToPython(bindings, indent):
+  """Returns the Python code that, for each (key, Python name) in bindings,
+  assigns _db_values[key] to the name if _db_values has key."""
+  return ''.join(
+      '\n%sif %r in _db_values:\n%s  %s = _db_values[%r]' % (
+          indent, key, indent, py_name, key)
+      for key, py_name in bindings)
+
+def PythonFunctionDefAst(name, param_names, body, decorator_list=()):
+  args = ast.arguments(
+      args=[ast.arg(arg=param, annotation=None) for param in param_names],
+      vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+  if 'posonlyargs' in ast.arguments._fields:  # Python 3.8+
+    args.posonlyargs = []
+  func_def = ast.FunctionDef(name=name, args=args, body=body,
+                             decorator_list=list(decorator_list),
+                             returns=None)
+  if 'type_params' in ast.FunctionDef._fields:  # Python 3.12+
+    func_def.type_params = []
+  return func_def
+
+def TickingLoopToPython(var, iterable, stmts):
+  """Returns the target, iterable and body of a Python for loop over the
+  iterable (Python code) that sets var.
+
+  If the body starts with a STMT_TICK, the loop takes its steps from
+  _db_fuel instead: zip() does that without a call into Python each time
+  round.
+  """
+  if stmts and stmts[0] is TICK_STATEMENT:
+    return ('%s, _db_step' % (var,), 'zip(%s, _db_fuel)' % (iterable,),
+            stmts[1:])
+  return var, iterable, stmts
+
+def TickingLoopToPythonAst(target, iterable, stmts):
+  """Like TickingLoopToPython(), with target and iterable as Python ast
+  nodes."""
+  if stmts and stmts[0] is TICK_STATEMENT:
+    return (ast.Tuple(elts=[target, PythonNameAst('_db_step', ast.Store())],
+                      ctx=ast.Store()),
+            PythonCallAst('zip', [iterable,
+                                  PythonNameAst('_db_fuel', ast.Load())]),
+            stmts[1:])
+  return target, iterable, stmts
+
+def AffineFactorsToPythonAst(factors, symbols):
+  """Translates the product of the factors to a Python ast.expr node."""
+  if not factors:
+    return ast.Constant(value=1)
+  product = factors[0].ToPythonAst(symbols)
+  for f in factors[1:]:
+    product = ast.BinOp(left=product, op=ast.Mult(),
+                        right=f.ToPythonAst(symbols))
+  return product
+
+def TranslateStatementsToPythonAst(stmts, symbols):
+  """Translates the statements to a list of Python ast.stmt nodes, which is
+  never empty."""
+  body = []
+  for s in stmts:
+    body.extend(TranslateStatementToPythonAst(s, symbols))
+  return body or [ast.Pass()]
+
+def TranslateStatementToPythonAst(stmt, symbols):
+  """Translates the statement to a list of Python ast.stmt nodes.
+
+  They're given the line of the statement, so that tracebacks and profilers
+  point at the shanghai source.  Nodes of nested statements that were
+  inlined (e.g. from a 一道组特) keep their own lines.  Nodes that don't get
+  a line here are given that of the node they're in by
+  ast.fix_missing_locations().  The columns are left unknown (-1): Python
+  counts them in UTF-8 bytes, and would put ^^^ in the wrong place.
+  """
+  nodes = _TranslateStatementToPythonAst(stmt, symbols)
+  if stmt.line is not None:
+    for node in nodes:
+      if not hasattr(node, 'lineno'):
+        node.lineno = node.end_lineno = stmt.line
+        node.col_offset = node.end_col_offset = -1
+  return nodes
+
+def _TranslateStatementToPythonAst(stmt, symbols):
+
+  if stmt.kind == STMT_VAR_DECL:
+    var_token = stmt.value
+    var = symbols.GetPythonVarName(var_token.value)
+    return [ast.Assign(targets=[PythonNameAst(var, ast.Store())],
+                       value=ast.Constant(value=None))]
+
+  if stmt.kind == STMT_ASSIGN:
+    var_token, expr = stmt.value
+    var = symbols.GetPythonVarName(var_token.value)
+    return [ast.Assign(targets=[PythonNameAst(var, ast.Store())],
+                       value=expr.ToPythonAst(symbols))]
+
+  if stmt.kind == STMT_SAY:
+    expr = stmt.value
+    if IsStringLiteral(expr):
+      return [ast.Expr(value=PythonCallAst(
+          '_db_append_output', [ast.Constant(value=expr.token.value + '\n')]))]
+    line = ast.BinOp(
+        left=ast.Constant(value='%s\n'), op=ast.Mod(),
+        right=ast.Tuple(
+            elts=[PythonCallAst('_shanghai_str',
+                                [expr.ToPythonAst(symbols)])],
+            ctx=ast.Load()))
+    return [ast.Expr(value=PythonCallAst('_db_append_output', [line]))]
+
+  if stmt.kind in (STMT_INC_BY, STMT_DEC_BY):
+    var_token, expr = stmt.value
+    var = symbols.GetPythonVarName(var_token.value)
+    op = ast.Add() if stmt.kind == STMT_INC_BY else ast.Sub()
+    return [ast.AugAssign(target=PythonNameAst(var, ast.Store()), op=op,
+                          value=expr.ToPythonAst(symbols))]
+
+  if stmt.kind == STMT_LOOP:
+    var_token, from_val, to_val, stmts = stmt.value
+    var = symbols.GetPythonVarName(var_token.value)
+    to_plus_one = ast.BinOp(left=to_val.ToPythonAst(symbols),
+                            op=ast.Add(), right=ast.Constant(value=1))
+    target, loop_range, stmts = TickingLoopToPythonAst(
+        PythonNameAst(var, ast.Store()),
+        PythonCallAst('range', [from_val.ToPythonAst(symbols), to_plus_one]),
+        stmts)
+    return [ast.For(
+        target=target, iter=loop_range,
+        body=TranslateStatementsToPythonAst(stmts, symbols), orelse=[])]
+
+  if stmt.kind == STMT_AFFINE_LOOP:
+    var_token, from_val, to_val, stmts = stmt.value
+    var = symbols.GetPythonVarName(var_token.value)
+    acc_names = []
+    accumulators = []
+    for acc_token, terms in GetAffineLoopTerms(stmt.value):
+      acc_names.append(symbols.GetPythonVarName(acc_token.value))
+      accumulators.append(ast.Tuple(elts=[
+          PythonNameAst(acc_names[-1], ast.Load()),
+          ast.Tuple(elts=[
+              ast.Tuple(elts=[ast.Constant(value=sign),
+                              ast.Constant(value=linear),
+                              AffineFactorsToPythonAst(factors, symbols)],
+                        ctx=ast.Load())
+              for sign, linear, factors in terms], ctx=ast.Load())],
+                                    ctx=ast.Load()))
+    to_plus_one = ast.BinOp(left=to_val.ToPythonAst(symbols),
+                            op=ast.Add(), right=ast.Constant(value=1))
+    loop_range = PythonNameAst('_db_loop_range', ast.Load())
+    sums = PythonNameAst('_db_loop_sums', ast.Load())
+    target, fallback_range, stmts = TickingLoopToPythonAst(
+        PythonNameAst(var, ast.Store()), loop_range, stmts)
+    return [
+        ast.Assign(
+            targets=[PythonNameAst('_db_loop_range', ast.Store())],
+            value=PythonCallAst('range', [from_val.ToPythonAst(symbols),
+                                          to_plus_one])),
+        ast.Try(
+            body=[ast.Assign(
+                targets=[PythonNameAst('_db_loop_sums', ast.Store())],
+                value=PythonCallAst('_shanghai_affine_sums', [
+                    loop_range,
+                    ast.Tuple(elts=accumulators, ctx=ast.Load())]))],
+            handlers=[ast.ExceptHandler(
+                type=PythonNameAst('Exception', ast.Load()), name=None,
+                body=[ast.Assign(
+                    targets=[PythonNameAst('_db_loop_sums', ast.Store())],
+                    value=ast.Constant(value=None))])],
+            orelse=[], finalbody=[]),
+        ast.If(
+            test=ast.Compare(left=sums, ops=[ast.Is()],
+                             comparators=[ast.Constant(value=None)]),
+            body=[ast.For(
+                target=target, iter=fallback_range,
+                body=TranslateStatementsToPythonAst(stmts, symbols),
+                orelse=[])],
+            orelse=[ast.Assign(
+                targets=[ast.Tuple(
+                    elts=[PythonNameAst(name, ast.Store())
+                          for name in acc_names + [var]],
+                    ctx=ast.Store())],
+                value=sums)]),
+        ]
+
+  if stmt.kind == STMT_FUNC_DEF:
+    func_token, params, stmts = stmt.value
+    func_name = symbols.GetPythonVarName(func_token.value)
+    param_names = [symbols.GetPythonVarName(tk.value) for tk in params]
+    return [PythonFunctionDefAst(
+        func_name, param_names,
+        TranslateStatementsToPythonAst(stmts, symbols))]
+
+  if stmt.kind == STMT_CALL:
+    return [ast.Expr(value=stmt.value.ToPythonAst(symbols))]
+
+  if stmt.kind == STMT_RETURN:
+    return [ast.Return(value=stmt.value.ToPythonAst(symbols))]
+
+  if stmt.kind == STMT_TAIL_CALL:
+    params, args = stmt.value
+    body = []
+    if params:
+      # All the arguments are evaluated before any parameter is rebound.
+      body.append(ast.Assign(
+          targets=[ast.Tuple(
+              elts=[PythonNameAst(symbols.GetPythonVarName(tk.value),
+                                  ast.Store()) for tk in params],
+              ctx=ast.Store())],
+          value=ast.Tuple(elts=[arg.ToPythonAst(symbols) for arg in args],
+                          ctx=ast.Load())))
+    return body + [ast.Continue()]
+
+  if stmt.kind == STMT_TAIL_CALL_LOOP:
+    stmts = stmt.value
+    ticking = stmts and stmts[0] is TICK_STATEMENT
+    body = TranslateStatementsToPythonAst(stmts[1:] if ticking else stmts,
+                                          symbols)
+    if FallsThrough(stmts[-1]):
+      body.append(ast.Return(value=ast.Constant(value=None)))
+    if ticking:
+      return [ast.For(target=PythonNameAst('_db_step', ast.Store()),
+                      iter=PythonNameAst('_db_fuel', ast.Load()),
+                      body=body, orelse=[])]
+    return [ast.While(test=ast.Constant(value=True), body=body, orelse=[])]
+
+  if stmt.kind == STMT_TICK:
+    return [ast.Expr(value=PythonCallAst(
+        'next', [PythonNameAst('_db_fuel', ast.Load())]))]
+
+  if stmt.kind == STMT_COMPOUND:
+    # Python has no block scope, so the statements are simply inlined.
+    body = []
+    for s in stmt.value:
+      body.extend(TranslateStatementToPythonAst(s, symbols))
+    return body
+
+  if stmt.kind == STMT_CONDITIONAL:
+    condition, then_stmt, else_stmt = stmt.value
+    return [ast.If(
+        test=condition.ToPythonAst(symbols),
+        body=TranslateStatementsToPythonAst([then_stmt], symbols),
+        orelse=(TranslateStatementsToPythonAst([else_stmt], symbols)
+                if else_stmt else []))]
+
+  if stmt.kind == STMT_DELETE:
+    var = symbols.GetPythonVarName(stmt.value.value)
+    return [ast.Assign(targets=[PythonNameAst(var, ast.Store())],
+                       value=ast.Constant(value=None))]
+
+  if stmt.kind == STMT_IMPORT:
+    module = stmt.value.value
+    symbols.GetPythonVarName(module.partition('.')[0])
+    return [ast.Expr(value=PythonCallAst('_shanghai_import', [
+        ast.Constant(value=module), PythonCallAst('globals', [])]))]
+
+  if stmt.kind == STMT_LOCAL_IMPORT:
+    module, names = stmt.value
+    module = module.value
+    top = module.partition('.')[0]
+    return [
+        ast.Assign(
+            targets=[ast.Name(id='_db_values', ctx=ast.Store())],
+            value=PythonCallAst('_shanghai_import', [
+                ast.Constant(value=module), PythonCallAst('globals', []),
+                ast.Constant(value=names)])),
+        ast.Assign(
+            targets=[PythonNameAst(symbols.GetPythonVarName(top),
+                                   ast.Store())],
+            value=PythonSubscriptAst(
+                ast.Name(id='_db_values', ctx=ast.Load()), top)),
+        ] + PythonBindingsAst(
+            [(var, symbols.GetPythonVarName(var)) for var in names])
+
+  if stmt.kind == STMT_BIND_GLOBALS:
+    py_names = tuple(symbols.GetPythonVarName(var) for var in stmt.value)
+    return [ast.Assign(
+        targets=[ast.Name(id='_db_values', ctx=ast.Store())],
+        value=PythonCallAst('_shanghai_globals', [
+            PythonCallAst('globals', []), ast.Constant(value=py_names)]))
+            ] + PythonBindingsAst(zip(py_names, py_names))
 
   sys.exit('我不懂 %s 语句哪能执行。' % (stmt.kind))
 
 def TranslateTokensToPython(tokens):
-  statements, tokens = ParseStmts(tokens)
+  statements, tokens = ParseStmts(TokenStream(tokens))
   assert not tokens, ('多余符号：%s' % (tokens,))
+  symbols = SymbolTable()
   py_code = []
   for s in statements:
-    py_code.append(TranslateStatementToPython(s))
+    py_code.append(TranslateStatementToPython(s, symbols))
   return '\n'.join(py_code)
 
 def ParseToAst(code):
-  tokens = list(Tokenize(code))
-  statements, tokens = ParseStmts(tokens)
+  tokens, positions = TokenizeWithPositions(code)
+  statements, tokens = ParseStmts(
+      TokenStream(tokens, positions, SourceLines(code)))
   assert not tokens, ('多余符号：%s' % (tokens,))
   return statements
 
-_db_output = ''
-def _db_append_output(s):
-  global _db_output
-  _db_output += s
+# Chars the tokenizer treats specially when looking for the end of a
+# sentence.
+SENTENCE_SCAN_RE = re.compile('[“#【。！]')
 
-def Run(code):
-  tokens = list(Tokenize(code))
-  py_code = TranslateTokensToPython(tokens)
+def FindSentenceEnds(code, pos=0):
+  """Yields where the sentences of code from pos on end.
+
+  A sentence ends right after a 。 or ！ that isn't in a string literal, a
+  comment or a 【标识符】, and the last one at the end of code.  No token
+  spans two sentences, so tokenizing code a sentence at a time gives the
+  same tokens as tokenizing it all at once.
+  """
+  while True:
+    m = SENTENCE_SCAN_RE.search(code, pos)
+    if not m:
+      break
+    char = m.group()
+    pos = m.end()
+    if char == KW_OPEN_QUOTE:
+      pos = code.find(KW_CLOSE_QUOTE, pos)
+      if pos < 0:
+        break
+      pos += len(KW_CLOSE_QUOTE)
+    elif char == '#':
+      pos = code.find('\n', pos)
+      if pos < 0:
+        break
+    elif char == '【':
+      m = BRACKETED_IDENTIFIER_RE.match(code, m.start())
+      if m:
+        pos = m.end()
+    else:
+      yield pos
+      if pos == len(code):
+        return
+  yield len(code)
+
+class ParsedSource:
+  """The tokens and top-level statements of a program's source code.
+
+  char_ends[i] and token_ends[i] are the position in code and the index in
+  tokens right after the i-th statement.  ReparseIncremental() uses them to
+  only redo the statements an edit touches.  positions[i] is where the i-th
+  token starts in code.
+  """
+
+  def __init__(self, code, tokens, statements, char_ends, token_ends,
+               positions):
+    self.code = code
+    self.tokens = tokens
+    self.statements = statements
+    self.char_ends = char_ends
+    self.token_ends = token_ends
+    self.positions = positions
+
+def TokenizeSentence(code, start, end, tokens, positions):
+  """Appends the tokens of the sentence code[start:end] to tokens, and where
+  they start in code to positions."""
+  sentence_positions = array.array('q')
+  tokens.extend(Tokenize(code[start:end], sentence_positions))
+  positions.extend(map(start.__add__, sentence_positions))
+
+def ParseSource(code):
+  """Returns a ParsedSource for code, parsing all of it."""
+  tokens = []
+  positions = array.array('q')
+  sentence_ends = {}  # Maps index in tokens to position in code.
+  char_start = 0
+  for sentence_end in FindSentenceEnds(code):
+    TokenizeSentence(code, char_start, sentence_end, tokens, positions)
+    char_start = sentence_end
+    sentence_ends.setdefault(len(tokens), sentence_end)
+
+  stream = TokenStream(tokens, positions, SourceLines(code))
+  statements = []
+  char_ends = []
+  token_ends = []
+  while True:
+    stmt, stream = ParseStmt(stream)
+    if not stmt:
+      break
+    statements.append(stmt)
+    # Every statement ends with 。, so one ending inside a sentence is
+    # followed by tokens that don't parse, and fails below.
+    char_ends.append(sentence_ends[stream.pos] if stream.pos in sentence_ends
+                     else positions[stream.pos])
+    token_ends.append(stream.pos)
+  assert not stream, ('多余符号：%s' % (stream,))
+  return ParsedSource(code, tokens, statements, char_ends, token_ends,
+                      positions)
+
+def MoveStatements(node, line, line_delta, column_delta):
+  """Returns a copy of node (as for WalkAst()) with the statements in it
+  moved down line_delta lines, and those starting on line also moved right
+  column_delta columns."""
+  if isinstance(node, Statement):
+    moved = Statement(node.kind,
+                      MoveStatements(node.value, line, line_delta,
+                                     column_delta))
+    if node.line is not None:
+      moved.line = node.line + line_delta
+      moved.column = node.column + (column_delta if node.line == line else 0)
+    return moved
+  if isinstance(node, list):
+    return [MoveStatements(n, line, line_delta, column_delta) for n in node]
+  if isinstance(node, tuple):
+    return tuple(MoveStatements(n, line, line_delta, column_delta)
+                 for n in node)
+  return node  # Exprs have no statements in them.
+
+def ReparseIncremental(parsed, start, end, new_text):
+  """Returns a ParsedSource for parsed.code with code[start:end] replaced
+  by new_text.
+
+  Only the sentences from the statement before the first one the edit
+  touches up to the first statement end after the edit are tokenized
+  again, and only the statements among them parsed again.  All other
+  tokens and Statements are reused.  parsed itself isn't changed.
+  """
+  code = parsed.code[:start] + new_text + parsed.code[end:]
+  delta = len(new_text) - (end - start)
+  old_char_ends = parsed.char_ends
+  old_token_ends = parsed.token_ends
+  num_old = len(old_char_ends)
+
+  # The statement before the one the edit starts in is parsed again too, as
+  # a 轧苗头 looks at the token after it for 勿来赛就.
+  first = max(bisect.bisect_right(old_char_ends, start) - 1, 0)
+  char_start = old_char_ends[first - 1] if first else 0
+  token_start = old_token_ends[first - 1] if first else 0
+
+  # Tokenize sentences until one ends where an old statement did, after
+  # the edit.  old_index is then that statement.
+  new_tokens = []
+  new_positions = array.array('q')
+  sentence_ends = {}  # Maps index in tokens to position in code.
+  old_index = first
+  for sentence_end in FindSentenceEnds(code, char_start):
+    TokenizeSentence(code, char_start, sentence_end, new_tokens,
+                     new_positions)
+    char_start = sentence_end
+    sentence_ends.setdefault(token_start + len(new_tokens), sentence_end)
+    if sentence_end < start + len(new_text):
+      continue
+    old_index = bisect.bisect_left(old_char_ends, sentence_end - delta,
+                                   old_index)
+    if (old_index < num_old and
+        old_char_ends[old_index] == sentence_end - delta):
+      break
+  else:
+    old_index = num_old
+
+  # The tokens after that statement are reused.
+  reused_start = (old_token_ends[old_index] if old_index < num_old
+                  else len(parsed.tokens))
+  token_delta = token_start + len(new_tokens) - reused_start
+  tokens = parsed.tokens[:token_start] + new_tokens
+  tokens.extend(parsed.tokens[reused_start:])
+  positions = parsed.positions[:token_start] + new_positions
+  positions.extend(map(delta.__add__, parsed.positions[reused_start:]))
+
+  # Parse until a statement ends where an old one did.
+  lines = SourceLines(code)
+  stream = TokenStream(tokens, positions, lines)
+  stream.Restore(token_start)
+  statements = parsed.statements[:first]
+  char_ends = old_char_ends[:first]
+  token_ends = old_token_ends[:first]
+  while True:
+    if (old_index < num_old and
+        stream.pos == old_token_ends[old_index] + token_delta):
+      reused = parsed.statements[old_index + 1:]
+      if reused:
+        # Lines added or removed by the edit move the statements after it,
+        # and chars added or removed move those on its last line too.
+        line, column = lines.GetLocation(positions[stream.pos])
+        old_line, old_column = reused[0].line, reused[0].column
+        if (line, column) != (old_line, old_column):
+          reused = MoveStatements(reused, old_line, line - old_line,
+                                  column - old_column)
+      statements.extend(reused)
+      char_ends.extend(map(delta.__add__, old_char_ends[old_index + 1:]))
+      token_ends.extend(map(token_delta.__add__,
+                            old_token_ends[old_index + 1:]))
+      return ParsedSource(code, tokens, statements, char_ends, token_ends,
+                          positions)
+    stmt, stream = ParseStmt(stream)
+    if not stmt:
+      break
+    statements.append(stmt)
+    while (old_index < num_old and
+           old_token_ends[old_index] + token_delta < stream.pos):
+      old_index += 1
+    # Every statement ends with 。, i.e. at the end of a sentence.
+    if stream.pos in sentence_ends:
+      char_ends.append(sentence_ends[stream.pos])
+    elif (old_index < num_old and
+          old_token_ends[old_index] + token_delta == stream.pos):
+      char_ends.append(old_char_ends[old_index] + delta)
+    else:
+      # The edit made a statement end inside an old one, whose sentences
+      # weren't recorded.
+      return ParseSource(code)
+    token_ends.append(stream.pos)
+  assert not stream, ('多余符号：%s' % (stream,))
+  return ParsedSource(code, tokens, statements, char_ends, token_ends,
+                      positions)
+
+# How many chars of a source file ReadSentences() reads at a time.
+STREAM_CHUNK_SIZE = 1 << 16
+
+def ReadSentences(src_file, chunk_size=STREAM_CHUNK_SIZE):
+  """Yields the sentences (see FindSentenceEnds()) of the code read from
+  src_file, chunk_size chars at a time.
+
+  Only the last sentence read so far and the chunk it's in are kept, so
+  memory use doesn't grow with the size of the file.
+  """
+  buffer = ''
+  while True:
+    chunk = src_file.read(chunk_size)
+    buffer += chunk
+    if chunk:
+      # Where a sentence ends doesn't depend on what comes after it, except
+      # for a 【 that the next chunk could still close on the same line, and
+      # the last sentence, which could still go on.
+      limit = buffer.find('【', buffer.rfind('\n') + 1)
+      if limit < 0:
+        limit = len(buffer) - 1
+    else:
+      limit = len(buffer)
+    start = 0
+    for end in FindSentenceEnds(buffer):
+      if end > limit:
+        break
+      yield buffer[start:end]
+      start = end
+    buffer = buffer[start:]
+    if not chunk:
+      return
+
+# Keywords opening and closing blocks.
+BLOCK_BEGIN_KEYWORDS = frozenset([KW_BEGIN, KW_FUNC_DEF, KW_LOOP])
+BLOCK_END_KEYWORDS = frozenset([KW_END, KW_END_LOOP])
+
+def GetBlockDepthChange(tokens):
+  """Returns how many more blocks tokens open than they close."""
+  depth = 0
+  for token in tokens:
+    if token.kind == TK_KEYWORD:
+      if token.value in BLOCK_BEGIN_KEYWORDS:
+        depth += 1
+      elif token.value in BLOCK_END_KEYWORDS:
+        depth -= 1
+  return depth
+
+def ParseStatementsStreaming(sentences):
+  """Yields the top-level statements of the code made of sentences (an
+  iterable of str), parsing each as soon as its sentences are there.
+
+  A statement is parsed once its blocks are all closed and the next sentence
+  has been seen not to start with a 勿来赛就 going with it.
+  """
+  else_token = KEYWORD_TOKENS[KW_ELSE]
+  tokens = []
+  positions = array.array('q')  # Where tokens start in ''.join(parts).
+  parts = []  # The sentences the tokens are from.
+  size = 0  # Chars in parts.
+  line, column = 1, 0  # Where parts start.
+  depth = 0
+  for sentence in sentences:
+    sentence_positions = array.array('q')
+    sentence_tokens = list(Tokenize(sentence, sentence_positions))
+    if (sentence_tokens and tokens and depth <= 0 and
+        sentence_tokens[0] is not else_token):
+      code = ''.join(parts)
+      lines = SourceLines(code, line, column)
+      yield from ParseAllStmts(tokens, positions, lines)
+      line, column = lines.GetEnd(code)
+      tokens = []
+      positions = array.array('q')
+      parts = []
+      size = 0
+    tokens.extend(sentence_tokens)
+    positions.extend(map(size.__add__, sentence_positions))
+    parts.append(sentence)
+    size += len(sentence)
+    depth += GetBlockDepthChange(sentence_tokens)
+  if tokens:
+    yield from ParseAllStmts(tokens, positions,
+                             SourceLines(''.join(parts), line, column))
+
+def ParseAllStmts(tokens, positions=None, lines=None):
+  """Returns the statements parsed from a list of tokens, all of which must
+  be used.  See TokenStream for positions and lines."""
+  statements, remaining_tokens = ParseStmts(
+      TokenStream(tokens, positions, lines))
+  assert not remaining_tokens, ('多余符号：%s' % (remaining_tokens,))
+  return statements
+
+# Folded constants bigger than these are left to be computed at run time, so
+# that folding can't blow up the size of the code.
+MAX_FOLDED_STR_LEN = 4096
+MAX_FOLDED_INT_BITS = 4096
+
+# 除以 is left out: it makes floats, which aren't folded.
+ARITHMETIC_OPERATION_TO_FUNCTION = {
+    KW_PLUS: operator.add,
+    KW_MINUS: operator.sub,
+    KW_TIMES: operator.mul,
+    KW_INTEGER_DIVIDE_BY: operator.floordiv,
+    }
+
+COMPARISON_KEYWORD_TO_FUNCTION = {
+    KW_GREATER: operator.gt,
+    KW_LESS: operator.lt,
+    KW_EQUAL: operator.eq,
+    KW_NOT_EQUAL: operator.ne,
+    }
+
+def ConstantExpr(value):
+  """Returns a LiteralExpr of value, or None if it can't be folded."""
+  if type(value) == bool:
+    return LiteralExpr(Token(TK_BOOL_LITERAL, value))
+  if type(value) == int and value.bit_length() <= MAX_FOLDED_INT_BITS:
+    return LiteralExpr(Token(TK_INTEGER_LITERAL, value))
+  if type(value) == str and len(value) <= MAX_FOLDED_STR_LEN:
+    return LiteralExpr(Token(TK_STRING_LITERAL, value))
+  return None
+
+def FoldArithmetic(operation, value1, value2):
+  """Returns a LiteralExpr of value1 <operation> value2, or None if it must
+  be computed at run time (e.g. because it raises)."""
+  function = ARITHMETIC_OPERATION_TO_FUNCTION.get(operation)
+  if function is None:
+    return None
+  if operation == KW_TIMES:
+    # Don't even build a huge string.
+    for s, n in ((value1, value2), (value2, value1)):
+      if (type(s) == str and type(n) in (int, bool) and
+          len(s) * n > MAX_FOLDED_STR_LEN):
+        return None
+  try:
+    return ConstantExpr(function(value1, value2))
+  except (TypeError, ZeroDivisionError):
+    return None
+
+def OptimizeExpr(expr):
+  """Returns expr with literal arithmetic, concatenation and comparison
+  folded.  expr itself isn't changed."""
+  if isinstance(expr, ArithmeticExpr):
+    op1 = OptimizeExpr(expr.op1)
+    op2 = OptimizeExpr(expr.op2)
+    if isinstance(op1, LiteralExpr) and isinstance(op2, LiteralExpr):
+      folded = FoldArithmetic(expr.operation.value, op1.token.value,
+                              op2.token.value)
+      if folded is not None:
+        return folded
+    return ArithmeticExpr(op1, expr.operation, op2)
+
+  if isinstance(expr, ConcatExpr):
+    # Merge adjacent literals into one string.
+    exprs = []
+    for e in expr.exprs:
+      e = OptimizeExpr(e)
+      if isinstance(e, LiteralExpr):
+        e = StringLiteralExpr(_shanghai_str(e.token.value))
+        if (exprs and isinstance(exprs[-1], LiteralExpr) and
+            len(exprs[-1].token.value) + len(e.token.value) <=
+            MAX_FOLDED_STR_LEN):
+          e = StringLiteralExpr(exprs.pop().token.value + e.token.value)
+      exprs.append(e)
+    if len(exprs) == 1 and isinstance(exprs[0], LiteralExpr):
+      return exprs[0]
+    return ConcatExpr(exprs)
+
+  if isinstance(expr, ComparisonExpr):
+    op1 = OptimizeExpr(expr.op1)
+    op2 = None if expr.op2 is None else OptimizeExpr(expr.op2)
+    if isinstance(op1, LiteralExpr):
+      if expr.relation.value == KW_IS_NONE:
+        return ConstantExpr(False)  # A literal is never None.
+      if isinstance(op2, LiteralExpr):
+        function = COMPARISON_KEYWORD_TO_FUNCTION[expr.relation.value]
+        try:
+          return ConstantExpr(function(op1.token.value, op2.token.value))
+        except TypeError:
+          pass
+    return ComparisonExpr(op1, expr.relation, op2)
+
+  if isinstance(expr, ParenExpr):
+    inner = OptimizeExpr(expr.expr)
+    if isinstance(inner, LiteralExpr):
+      return inner
+    return ParenExpr(inner)
+
+  if isinstance(expr, CallExpr):
+    return CallExpr(expr.func, [OptimizeExpr(arg) for arg in expr.args])
+
+  return expr
+
+def OptimizeStatements(stmts):
+  """Returns the statements optimized by OptimizeStatement()."""
+  optimized = []
+  for stmt in stmts:
+    stmt = OptimizeStatement(stmt)
+    if stmt is not None:
+      optimized.append(stmt)
+  return optimized
+
+def OptimizeStatement(stmt):
+  """Returns an optimized version of stmt, or None if it does nothing.
+
+  Constants in its expressions are folded, 轧苗头 whose condition is a
+  literal are replaced by the branch taken, and empty 一道组特 blocks are
+  dropped.  stmt itself isn't changed.
+  """
+  if stmt.kind in (STMT_ASSIGN, STMT_INC_BY, STMT_DEC_BY):
+    var_token, expr = stmt.value
+    return CopyLocation(
+        Statement(stmt.kind, (var_token, OptimizeExpr(expr))), stmt)
+
+  if stmt.kind in (STMT_SAY, STMT_CALL, STMT_RETURN):
+    return CopyLocation(Statement(stmt.kind, OptimizeExpr(stmt.value)), stmt)
+
+  if stmt.kind == STMT_LOOP:
+    var_token, from_val, to_val, stmts = stmt.value
+    loop = (var_token, OptimizeExpr(from_val), OptimizeExpr(to_val),
+            OptimizeStatements(stmts))
+    if GetAffineLoopTerms(loop) is not None:
+      return CopyLocation(Statement(STMT_AFFINE_LOOP, loop), stmt)
+    return CopyLocation(Statement(stmt.kind, loop), stmt)
+
+  if stmt.kind == STMT_FUNC_DEF:
+    func_token, params, stmts = stmt.value
+    return CopyLocation(
+        Statement(stmt.kind, (func_token, params, OptimizeStatements(stmts))),
+        stmt)
+
+  if stmt.kind == STMT_COMPOUND:
+    stmts = OptimizeStatements(stmt.value)
+    return CopyLocation(Statement(stmt.kind, stmts), stmt) if stmts else None
+
+  if stmt.kind == STMT_CONDITIONAL:
+    condition, then_stmt, else_stmt = stmt.value
+    condition = OptimizeExpr(condition)
+    then_stmt = OptimizeStatement(then_stmt)
+    else_stmt = OptimizeStatement(else_stmt) if else_stmt else None
+    if isinstance(condition, LiteralExpr):
+      return then_stmt if condition.token.value else else_stmt
+    if then_stmt is None:
+      then_stmt = Statement(STMT_COMPOUND, [])
+    return CopyLocation(
+        Statement(stmt.kind, (condition, then_stmt, else_stmt)), stmt)
+
+  return stmt
+
+# Multiplying out brackets in the body of a 搞七捻三 may give at most this
+# many terms, so that the code summing them can't blow up.
+MAX_AFFINE_TERMS = 16
+
+def IsLoopInvariant(expr, loop_vars):
+  """Returns True if expr is arithmetic on literals and variables not in
+  loop_vars, which gives the same value every time round a loop that only
+  changes loop_vars."""
+  if isinstance(expr, LiteralExpr):
+    return True
+  if isinstance(expr, VariableExpr):
+    return expr.var not in loop_vars
+  if isinstance(expr, ParenExpr):
+    return IsLoopInvariant(expr.expr, loop_vars)
+  if isinstance(expr, ArithmeticExpr):
+    return (IsLoopInvariant(expr.op1, loop_vars) and
+            IsLoopInvariant(expr.op2, loop_vars))
+  return False
+
+def GetAffineTerms(expr, loop_var, accumulators):
+  """Returns expr as a sum of terms, or None if it isn't affine in loop_var.
+
+  Each term is (sign, linear, factors), meaning sign times the product of
+  the loop-invariant factors (Exprs), times loop_var if linear.
+  """
+  loop_vars = accumulators | set([loop_var])
+  if IsLoopInvariant(expr, loop_vars):
+    return [(1, False, [expr])]
+  if isinstance(expr, VariableExpr):
+    return [(1, True, [])] if expr.var == loop_var else None
+  if isinstance(expr, ParenExpr):
+    return GetAffineTerms(expr.expr, loop_var, accumulators)
+  if not isinstance(expr, ArithmeticExpr):
+    return None
+  terms1 = GetAffineTerms(expr.op1, loop_var, accumulators)
+  terms2 = GetAffineTerms(expr.op2, loop_var, accumulators)
+  if terms1 is None or terms2 is None:
+    return None
+  operation = expr.operation.value
+  if operation == KW_PLUS:
+    terms = terms1 + terms2
+  elif operation == KW_MINUS:
+    terms = terms1 + [(-sign, linear, factors)
+                      for sign, linear, factors in terms2]
+  elif operation == KW_TIMES:
+    terms = []
+    for sign1, linear1, factors1 in terms1:
+      for sign2, linear2, factors2 in terms2:
+        if linear1 and linear2:
+          return None  # Quadratic.
+        terms.append((sign1 * sign2, linear1 or linear2,
+                      factors1 + factors2))
+  else:
+    # Division isn't affine.
+    return None
+  return terms if len(terms) <= MAX_AFFINE_TERMS else None
+
+def GetAffineLoopTerms(loop):
+  """Returns [(accumulator token, terms)] if the 搞七捻三 loop only adds
+  terms affine in its variable to accumulators, else None.
+
+  loop is the value of a STMT_LOOP.  See GetAffineTerms() for the terms.
+  """
+  var_token, _, _, stmts = loop
+  # Summing in closed form goes round the loop no times at all.
+  stmts = [s for s in stmts if s.kind != STMT_TICK]
+  if not stmts or not all(s.kind in (STMT_INC_BY, STMT_DEC_BY)
+                          for s in stmts):
+    return None
+  accumulators = set(s.value[0].value for s in stmts)
+  if var_token.value in accumulators:
+    return None
+  accumulator_terms = collections.OrderedDict()
+  for s in stmts:
+    acc_token, expr = s.value
+    terms = GetAffineTerms(expr, var_token.value, accumulators)
+    if terms is None:
+      return None
+    if s.kind == STMT_DEC_BY:
+      terms = [(-sign, linear, factors) for sign, linear, factors in terms]
+    _, acc_terms = accumulator_terms.setdefault(acc_token.value,
+                                                (acc_token, []))
+    acc_terms.extend(terms)
+    if len(acc_terms) > MAX_AFFINE_TERMS:
+      return None
+  return list(accumulator_terms.values())
+
+# Python functions that a pure 套路 may call.
+PURE_PYTHON_FUNCTIONS = frozenset([
+    'abs', 'bool', 'int', 'len', 'max', 'min', 'round', 'str'])
+
+def GetAssignedVar(stmt):
+  """Returns the identifier stmt assigns to, or None."""
+  if stmt.kind in (STMT_VAR_DECL, STMT_DELETE):
+    return stmt.value.value
+  if stmt.kind in (STMT_ASSIGN, STMT_INC_BY, STMT_DEC_BY, STMT_LOOP,
+                   STMT_AFFINE_LOOP, STMT_FUNC_DEF):
+    return stmt.value[0].value
+  return None
+
+def GetAssignedVars(stmts):
+  """Returns the identifiers that the statements assign to, i.e. the local
+  variables if they are the body of a 套路."""
+  assigned = set()
+  for stmt in WalkAst(stmts):
+    if isinstance(stmt, Statement):
+      var = GetAssignedVar(stmt)
+      if var is not None:
+        assigned.add(var)
+  return assigned
+
+def GetFreeVars(params, stmts):
+  """Returns the identifiers that the body of a 套路 reads but doesn't bind,
+  i.e. those it gets from the program or from the 套路 it's defined in."""
+  bound = set(param.value for param in params)
+  read = set()
+  for node in WalkScope(stmts):
+    if isinstance(node, Statement):
+      var = GetAssignedVar(node)
+      if var is not None:
+        bound.add(var)
+      if node.kind == STMT_FUNC_DEF:
+        _, func_params, func_stmts = node.value
+        read |= GetFreeVars(func_params, func_stmts)
+      elif node.kind == STMT_IMPORT:
+        bound.add(node.value.value.partition('.')[0])
+      elif node.kind == STMT_LOCAL_IMPORT:
+        module, names = node.value
+        bound.add(module.value.partition('.')[0])
+        bound.update(names)
+      elif node.kind == STMT_BIND_GLOBALS:
+        bound.update(node.value)
+    elif isinstance(node, VariableExpr):
+      read.add(node.var.partition('.')[0])
+    elif isinstance(node, CallExpr):
+      read.add(node.func.partition('.')[0])
+  return read - bound
+
+def LocalizeImports(params, stmts):
+  """Returns stmts, the body of a 套路 just parsed, with its imports binding
+  locals of the 套路 rather than globals of the program.
+
+  Such an import (a STMT_LOCAL_IMPORT) binds the top-level package, and
+  those of the names the 套路 reads from outside that a shanghai module
+  defines.  Python then takes those names as local all through the 套路, so
+  it starts with a STMT_BIND_GLOBALS giving them their values in the
+  program first.  A 套路 defined inside reads the locals of this one from
+  here rather than from the program or its own imports.
+  """
+  local_vars = set(param.value for param in params)
+  imports = []
+  for node in WalkScope(stmts):
+    if isinstance(node, Statement):
+      var = GetAssignedVar(node)
+      if var is not None:
+        local_vars.add(var)
+      if node.kind == STMT_IMPORT:
+        local_vars.add(node.value.value.partition('.')[0])
+        imports.append(node)
+  for node in WalkAst(stmts):
+    if not isinstance(node, Statement):
+      continue
+    if node.kind == STMT_FUNC_DEF:
+      func_stmts = node.value[2]
+      if func_stmts and func_stmts[0].kind == STMT_BIND_GLOBALS:
+        func_stmts[0].value = tuple(
+            var for var in func_stmts[0].value if var not in local_vars)
+        if not func_stmts[0].value:
+          del func_stmts[0]
+    elif node.kind == STMT_LOCAL_IMPORT:
+      module, names = node.value
+      node.value = (module,
+                    tuple(var for var in names if var not in local_vars))
+  if not imports:
+    return stmts
+  free_vars = tuple(sorted(GetFreeVars(params, stmts)))
+  for node in imports:
+    node.kind = STMT_LOCAL_IMPORT
+    node.value = (node.value, free_vars)
+  if not free_vars:
+    return stmts
+  return [Statement(STMT_BIND_GLOBALS, free_vars)] + stmts
+
+def GetCallees(func_def):
+  """Returns the names of the functions a 套路 calls, or None if it can't be
+  pure no matter what it calls.
+
+  It can't if it 嘎讪胡s, imports, defines a 套路, reads a variable that is
+  neither a parameter nor local, or calls a function held in a local.
+  """
+  _, params, stmts = func_def.value
+  local_vars = set(param.value for param in params) | GetAssignedVars(stmts)
+  callees = set()
+  for node in WalkAst(stmts):
+    if isinstance(node, Statement):
+      if node.kind in (STMT_SAY, STMT_IMPORT, STMT_LOCAL_IMPORT,
+                       STMT_FUNC_DEF):
+        return None
+    elif isinstance(node, VariableExpr):
+      if node.var not in local_vars:
+        return None
+    elif isinstance(node, CallExpr):
+      if node.func in local_vars:
+        return None
+      callees.add(node.func)
+  return callees
+
+def GetTopLevelBindings(statements):
+  """Returns ({name: last FUNC_DEF statement} for the 套路 defined at the top
+  of a program, set of other global names the program binds).
+
+  A 套路 defined more than once is in both.  So is every 套路 of a program
+  that imports anything: a shanghai module binds all the names it defines
+  that the program uses (see _shanghai_import()), and which those are is
+  only known once it's imported.
+  """
+  func_defs = {}
+  rebound = set()
+  imports = False
+  for stmt in statements:
+    if stmt.kind == STMT_FUNC_DEF:
+      name = stmt.value[0].value
+      if name in func_defs:
+        rebound.add(name)
+      func_defs[name] = stmt
+      continue
+    # Anything defined or assigned at the top level, or inside blocks there,
+    # is global.
+    for node in WalkAst(stmt):
+      if isinstance(node, Statement) and node.kind == STMT_IMPORT:
+        rebound.add(node.value.value.partition('.')[0])
+        imports = True
+    rebound |= GetAssignedVars([stmt])
+  if imports:
+    rebound.update(func_defs)
+  return func_defs, rebound
+
+def FindPureFunctions(statements):
+  """Returns the names of the pure 套路 defined at the top of a program.
+
+  Calling a pure 套路 with the same arguments always gives the same result
+  and does nothing else, so it can be memoized.  Only 套路 defined once at
+  the top level, and never assigned to, are considered.
+  """
+  func_defs, rebound = GetTopLevelBindings(statements)
+  callees = {}
+  for name, func_def in func_defs.items():
+    if name not in rebound:
+      func_callees = GetCallees(func_def)
+      if func_callees is not None:
+        callees[name] = func_callees
+
+  # A 套路 is only pure if everything it calls is.
+  pure = set(callees)
+  changed = True
+  while changed:
+    changed = False
+    for name in list(pure):
+      for callee in callees[name]:
+        if callee in pure:
+          continue
+        if (callee in PURE_PYTHON_FUNCTIONS and callee not in func_defs and
+            callee not in rebound):
+          continue
+        pure.remove(name)
+        changed = True
+        break
+  return pure
+
+def FindMemoizedFunctions(statements, options):
+  """Returns the names of the top-level 套路 to memoize with options."""
+  if not options.memoize and not options.memoize_include:
+    return set()
+  return set(
+      name for name in FindPureFunctions(statements)
+      if name not in options.memoize_exclude and
+      (options.memoize or name in options.memoize_include))
+
+def GetReadVars(nodes):
+  """Returns the identifiers that the expressions in nodes read."""
+  read = set()
+  for node in WalkAst(nodes):
+    if isinstance(node, VariableExpr):
+      read.add(node.var.partition('.')[0])
+    elif isinstance(node, CallExpr):
+      read.add(node.func.partition('.')[0])
+  return read
+
+def GetReadsBeforeAssignment(stmts, assigned):
+  """Returns the identifiers that the statements may read before assigning
+  them, assigned being the ones assigned already.  Those the statements
+  assign on every path are added to assigned."""
+  reads = set()
+  for stmt in stmts:
+    reads |= GetStatementReadsBeforeAssignment(stmt, assigned)
+  return reads
+
+def GetStatementReadsBeforeAssignment(stmt, assigned):
+  if stmt.kind == STMT_COMPOUND:
+    return GetReadsBeforeAssignment(stmt.value, assigned)
+  if stmt.kind == STMT_CONDITIONAL:
+    condition, then_stmt, else_stmt = stmt.value
+    reads = GetReadVars(condition) - assigned
+    then_assigned = set(assigned)
+    reads |= GetStatementReadsBeforeAssignment(then_stmt, then_assigned)
+    else_assigned = set(assigned)
+    if else_stmt:
+      reads |= GetStatementReadsBeforeAssignment(else_stmt, else_assigned)
+    assigned |= then_assigned & else_assigned
+    return reads
+  if stmt.kind in (STMT_LOOP, STMT_AFFINE_LOOP):
+    # The body may not run at all, so what it assigns doesn't count after.
+    var_token, from_val, to_val, stmts = stmt.value
+    reads = GetReadVars([from_val, to_val]) - assigned
+    return reads | GetReadsBeforeAssignment(
+        stmts, assigned | set([var_token.value]))
+  if stmt.kind == STMT_FUNC_DEF:
+    _, params, stmts = stmt.value
+    reads = GetFreeVars(params, stmts) - assigned
+  else:
+    reads = GetReadVars(stmt.value) - assigned
+  if stmt.kind in (STMT_INC_BY, STMT_DEC_BY) and (
+      stmt.value[0].value not in assigned):
+    reads.add(stmt.value[0].value)
+  var = GetAssignedVar(stmt)
+  if var is not None:
+    assigned.add(var)
+  return reads
+
+def FallsThrough(stmt):
+  """Returns False if stmt always ends with 再会 (or a tail call)."""
+  if stmt.kind in (STMT_RETURN, STMT_TAIL_CALL):
+    return False
+  if stmt.kind == STMT_COMPOUND:
+    return not stmt.value or FallsThrough(stmt.value[-1])
+  if stmt.kind == STMT_CONDITIONAL:
+    _, then_stmt, else_stmt = stmt.value
+    return (else_stmt is None or FallsThrough(then_stmt) or
+            FallsThrough(else_stmt))
+  return True
+
+def IsSelfTailCall(stmt, func_name, params, local_vars):
+  """Returns True if stmt is 再会白相 of the 套路 func_name, with one
+  argument per parameter, where func_name isn't shadowed by a local."""
+  return (stmt.kind == STMT_RETURN and isinstance(stmt.value, CallExpr) and
+          stmt.value.func == func_name and
+          len(stmt.value.args) == len(params) and
+          func_name not in local_vars)
+
+def ReplaceTailCalls(stmt, func_name, params, local_vars):
+  """Returns (stmt with self tail calls replaced, whether any were)."""
+  if IsSelfTailCall(stmt, func_name, params, local_vars):
+    return CopyLocation(Statement(STMT_TAIL_CALL, (params, stmt.value.args)),
+                        stmt), True
+  if stmt.kind == STMT_COMPOUND:
+    stmts, replaced = ReplaceTailCallsInStatements(
+        stmt.value, func_name, params, local_vars)
+    return CopyLocation(Statement(stmt.kind, stmts), stmt), replaced
+  if stmt.kind == STMT_CONDITIONAL:
+    condition, then_stmt, else_stmt = stmt.value
+    then_stmt, then_replaced = ReplaceTailCalls(
+        then_stmt, func_name, params, local_vars)
+    else_replaced = False
+    if else_stmt:
+      else_stmt, else_replaced = ReplaceTailCalls(
+          else_stmt, func_name, params, local_vars)
+    stmt = CopyLocation(
+        Statement(stmt.kind, (condition, then_stmt, else_stmt)), stmt)
+    return stmt, then_replaced or else_replaced
+  # A 再会 inside a 搞七捻三 is left alone: it would continue the 搞七捻三
+  # instead of the loop around the 套路.
+  return stmt, False
+
+def ReplaceTailCallsInStatements(stmts, func_name, params, local_vars):
+  new_stmts = []
+  replaced = False
+  for stmt in stmts:
+    stmt, stmt_replaced = ReplaceTailCalls(stmt, func_name, params,
+                                           local_vars)
+    new_stmts.append(stmt)
+    replaced = replaced or stmt_replaced
+  return new_stmts, replaced
+
+def EliminateTailCalls(statements):
+  """Returns statements with self-recursive tail calls turned into loops.
+
+  In a top-level 套路 that is defined once and never assigned to,
+  再会白相 of the 套路 itself becomes rebinding the parameters and going
+  round a loop, so deep recursion runs in constant stack.  statements itself
+  isn't changed.
+  """
+  func_defs, rebound = GetTopLevelBindings(statements)
+  new_statements = []
+  for stmt in statements:
+    if stmt.kind == STMT_FUNC_DEF:
+      func_token, params, stmts = stmt.value
+      name = func_token.value
+      # A 套路 defining others might let them see its parameters, which
+      # rebinding would change, and one importing might bind its own name.
+      # Locals keep their values from one pass round the loop to the next,
+      # where a call would start without them, so nor may a 套路 read one
+      # before assigning it.
+      param_vars = set(param.value for param in params)
+      local_vars = param_vars | GetAssignedVars(stmts)
+      if (func_defs.get(name) is stmt and name not in rebound and
+          not any(isinstance(node, Statement) and
+                  node.kind in (STMT_FUNC_DEF, STMT_LOCAL_IMPORT)
+                  for node in WalkAst(stmts)) and
+          not (GetReadsBeforeAssignment(stmts, set(param_vars)) &
+               local_vars)):
+        new_stmts, replaced = ReplaceTailCallsInStatements(
+            stmts, name, params, local_vars)
+        if replaced:
+          stmt = CopyLocation(Statement(STMT_FUNC_DEF, (
+              func_token, params,
+              [Statement(STMT_TAIL_CALL_LOOP, new_stmts)])), stmt)
+    new_statements.append(stmt)
+  return new_statements
+
+TICK_STATEMENT = Statement(STMT_TICK, None)
+
+def InstrumentStatements(statements):
+  """Returns statements with the counting for the ResourceGovernor put in.
+
+  Every loop body and the body of every 套路 starts with a STMT_TICK, so
+  that no program can run long or call deep without the governor getting a
+  look in.  statements itself isn't changed.
+  """
+  return [InstrumentStatement(stmt) for stmt in statements]
+
+def InstrumentStatement(stmt):
+  if stmt.kind in (STMT_LOOP, STMT_AFFINE_LOOP):
+    var_token, from_val, to_val, stmts = stmt.value
+    return CopyLocation(Statement(stmt.kind, (
+        var_token, from_val, to_val,
+        [TICK_STATEMENT] + InstrumentStatements(stmts))), stmt)
+  if stmt.kind == STMT_TAIL_CALL_LOOP:
+    return Statement(STMT_TAIL_CALL_LOOP,
+                     [TICK_STATEMENT] + InstrumentStatements(stmt.value))
+  if stmt.kind == STMT_FUNC_DEF:
+    func_token, params, stmts = stmt.value
+    return CopyLocation(Statement(STMT_FUNC_DEF, (
+        func_token, params,
+        [TICK_STATEMENT] + InstrumentStatements(stmts))), stmt)
+  if stmt.kind == STMT_COMPOUND:
+    return CopyLocation(
+        Statement(STMT_COMPOUND, InstrumentStatements(stmt.value)), stmt)
+  if stmt.kind == STMT_CONDITIONAL:
+    condition, then_stmt, else_stmt = stmt.value
+    return CopyLocation(Statement(STMT_CONDITIONAL, (
+        condition, InstrumentStatement(then_stmt),
+        InstrumentStatement(else_stmt) if else_stmt else else_stmt)), stmt)
+  return stmt
+
+def WalkAst(nodes):
+  """Yields every Statement and Expr in nodes.
+
+  nodes is a Statement, an Expr, or a list or tuple of them (and of tokens
+  and other values, which are skipped).
+  """
+  stack = [nodes]
+  while stack:
+    node = stack.pop()
+    if isinstance(node, (list, tuple)):
+      stack.extend(reversed(node))
+    elif isinstance(node, Statement):
+      yield node
+      stack.append(node.value)
+    elif isinstance(node, Expr):
+      yield node
+      stack.extend(getattr(node, field)
+                   for field in reversed(node.__slots__))
+
+def WalkScope(nodes):
+  """Like WalkAst(), but doesn't go into the bodies of 套路, which have
+  scopes of their own."""
+  stack = [nodes]
+  while stack:
+    node = stack.pop()
+    if isinstance(node, (list, tuple)):
+      stack.extend(reversed(node))
+    elif isinstance(node, Statement):
+      yield node
+      if node.kind == STMT_FUNC_DEF:
+        stack.append(node.value[0])
+      else:
+        stack.append(node.value)
+    elif isinstance(node, Expr):
+      yield node
+      stack.extend(getattr(node, field)
+                   for field in reversed(node.__slots__))
+
+# By default, this many chars of program output are buffered before they are
+# written out.
+DEFAULT_FLUSH_THRESHOLD = 8192
+
+class OutputSink:
+  """Buffers program output and writes it to a file-like object in chunks."""
+
+  def __init__(self, file, flush_threshold=DEFAULT_FLUSH_THRESHOLD):
+    self.file = file
+    self.flush_threshold = flush_threshold
+    self.chunks = []
+    self.size = 0  # Number of buffered chars.
+    self.num_bytes = 0  # Number of bytes written so far, in UTF-8.
+
+  def Write(self, s):
+    self.chunks.append(s)
+    self.size += len(s)
+    if self.size >= self.flush_threshold:
+      self.Flush()
+
+  def Flush(self):
+    if self.chunks:
+      data = ''.join(self.chunks)
+      self.file.write(data)
+      self.num_bytes += len(data.encode('utf-8'))
+      self.chunks = []
+      self.size = 0
+    if hasattr(self.file, 'flush'):
+      self.file.flush()
+
+PHASE_NAMES = {
+    'tokenize': '分词',
+    'parse': '语法分析',
+    'optimize': '优化',
+    'translate': '翻译',
+    'compile': '编译',
+    'load': '读缓存',
+    'exec': '运行',
+    }
+
+class RunStats:
+  """Where the time of compiling and running a program went.
+
+  wall_seconds and cpu_seconds map each phase that ran (see PHASE_NAMES) to
+  its time, in the order the phases ran.  A program loaded from the disk
+  cache has no tokenize, parse, translate or compile phase, and no token or
+  AST node count.
+  """
+
+  def __init__(self):
+    self.wall_seconds = {}
+    self.cpu_seconds = {}
+    self.cache_hit = False
+    self.num_tokens = None
+    self.num_ast_nodes = None
+    self.py_code_size = None  # Number of bytes of Python bytecode.
+    self.output_bytes = 0  # Number of bytes of output, in UTF-8.
+
+  @contextlib.contextmanager
+  def Timing(self, phase):
+    """Adds the time spent in the with block to phase."""
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+      yield
+    finally:
+      self.wall_seconds[phase] = (self.wall_seconds.get(phase, 0.0) +
+                                  time.perf_counter() - wall_start)
+      self.cpu_seconds[phase] = (self.cpu_seconds.get(phase, 0.0) +
+                                 time.process_time() - cpu_start)
+
+  def ToDict(self):
+    """Returns the stats as a JSON-serializable dict."""
+    return {
+        'wall_seconds': dict(self.wall_seconds),
+        'cpu_seconds': dict(self.cpu_seconds),
+        'cache_hit': self.cache_hit,
+        'num_tokens': self.num_tokens,
+        'num_ast_nodes': self.num_ast_nodes,
+        'py_code_size': self.py_code_size,
+        'output_bytes': self.output_bytes,
+        }
+
+  def __str__(self):
+    def Line(name, wall_seconds, cpu_seconds):
+      # A Chinese char is as wide as two spaces.
+      width = sum(2 if ord(c) > 0x2e80 else 1 for c in name)
+      return '  %s%s%10.4f 秒  CPU %10.4f 秒' % (
+          name, ' ' * max(0, 8 - width), wall_seconds, cpu_seconds)
+
+    lines = ['统计：']
+    for phase, wall_seconds in self.wall_seconds.items():
+      lines.append(Line(PHASE_NAMES.get(phase, phase), wall_seconds,
+                        self.cpu_seconds[phase]))
+    lines.append(Line('总共', sum(self.wall_seconds.values()),
+                      sum(self.cpu_seconds.values())))
+    if self.cache_hit:
+      lines.append('  翻译好的代码是从缓存里拿的')
+    elif self.num_tokens is not None:  # Not counted when streaming.
+      lines.append('  符号 %s 只，语法树节点 %s 只' % (
+          self.num_tokens, self.num_ast_nodes))
+    lines.append('  Python 字节码 %s 字节，输出 %d 字节' % (
+        self.py_code_size, self.output_bytes))
+    return '\n'.join(lines)
+
+class ResourceLimits:
+  """Budgets for one run of a program.  None means no limit.
+
+  Only programs compiled with CompileOptions.instrument are held to them,
+  and only at the top of loops and 套路: a single huge multiplication, or a
+  shanghai module the program imports, isn't stopped halfway.
+  """
+
+  def __init__(self, wall_seconds=None, cpu_seconds=None, max_steps=None,
+               max_call_depth=None, max_memory=None):
+    self.wall_seconds = wall_seconds
+    # CPU time of the thread running the program.
+    self.cpu_seconds = cpu_seconds
+    # Times round any loop plus 套路 calls.  A loop summed in closed form
+    # (see _shanghai_affine_sums()) doesn't go round at all.
+    self.max_steps = max_steps
+    self.max_call_depth = max_call_depth
+    # Bytes allocated since the run started and not freed yet, as traced by
+    # tracemalloc, which makes the program a few times slower.  Other
+    # threads of the process are counted too.
+    self.max_memory = max_memory
+
+  def ToDict(self):
+    return dict(vars(self))
+
+RESOURCE_NAMES = {
+    'wall_seconds': '运行辰光（秒）',
+    'cpu_seconds': 'CPU 辰光（秒）',
+    'max_steps': '步数',
+    'max_call_depth': '套路调用深度',
+    'max_memory': '内存（字节）',
+    }
+
+class ResourceLimitExceeded(Exception):
+  """Raised in a program that went over one of its ResourceLimits."""
+
+  def __init__(self, resource, limit):
+    # Keeping the arguments in args lets it be pickled, e.g. by a worker
+    # process.
+    Exception.__init__(self, resource, limit)
+    self.resource = resource  # The name of the ResourceLimits attribute.
+    self.limit = limit
+
+  def __str__(self):
+    return '程序超出了资源限制：%s 最多 %s。' % (
+        RESOURCE_NAMES[self.resource], self.limit)
+
+class RunCancelled(Exception):
+  """Raised in a program whose ResourceGovernor was cancelled."""
+
+  def __init__(self, message='程序被取消了。'):
+    # Taking the message from args lets it be copied by RaiseAgain(), and
+    # pickled.
+    Exception.__init__(self, message)
+
+# How many steps a program may take between two looks at its clocks.
+RESOURCE_CHECK_INTERVAL = 1024
+
+class ResourceGovernor:
+  """Holds one run of an instrumented program to its ResourceLimits.
+
+  The instrumented code takes a step's worth of fuel from _db_fuel every
+  step: 套路 with next() as they start, loops by zipping their range with
+  it.  Refuel() hands the fuel out a few steps at a time, after
+  checking the program is within its limits.  Taking it is done in C, so
+  counting steps costs little, and the depth of 套路 calls is only worked
+  out at those checks.
+  """
+
+  def __init__(self, limits):
+    self.limits = limits
+    self.namespace = None
+    self.fuel = None  # The itertools.repeat() being used up.
+    self.fuel_given = 0
+    # Memory can double every step, so it's looked at every time.
+    self.check_interval = (1 if limits.max_memory is not None
+                           else RESOURCE_CHECK_INTERVAL)
+    self.wall_start = None
+    self.cpu_start = None
+    self.memory_start = None
+    self.started_tracing = False
+    self.cancelled = False
+    self.all_fuel = itertools.chain.from_iterable(self.Refuel())
+
+  def Attach(self, namespace):
+    """Puts _db_fuel in a program's namespace."""
+    self.namespace = namespace
+    namespace['_db_fuel'] = self.all_fuel
+
+  def Start(self):
+    """Starts the clocks, just before the program starts running."""
+    if self.limits.max_memory is not None:
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        self.started_tracing = True
+      self.memory_start = tracemalloc.get_traced_memory()[0]
+    self.wall_start = time.perf_counter()
+    self.cpu_start = time.thread_time()
+
+  def Stop(self):
+    if self.started_tracing:
+      tracemalloc.stop()
+      self.started_tracing = False
+
+  def Cancel(self):
+    """Makes the program stop with RunCancelled at its next check.  May be
+    called from any thread."""
+    self.cancelled = True
+
+  def GetSteps(self):
+    """Returns how many steps the program has taken."""
+    if self.fuel is None:
+      return 0
+    return self.fuel_given - operator.length_hint(self.fuel)
+
+  def GetCallDepth(self, frame):
+    """Returns how many 套路 calls of the program frame is in."""
+    depth = -1  # Not counting the program itself.
+    while frame is not None:
+      if frame.f_globals is self.namespace:
+        depth += 1
+      frame = frame.f_back
+    return depth
+
+  def Refuel(self):
+    """Yields the fuel for the steps until the next check, each time the
+    last has run out.
+
+    Once the program is over a limit, the fuel it yields raises
+    ResourceLimitExceeded (or RunCancelled) at every step, which ends the
+    run.  A chain.from_iterable() that a generator raised out of would only
+    stop, and a loop taking its steps from it would quietly end.
+    """
+    while True:
+      try:
+        # The frame that took the step is the one that resumed this.
+        fuel = self.CheckLimits(sys._getframe(1))
+      except (ResourceLimitExceeded, RunCancelled) as e:
+        error = e
+        break
+      self.fuel = itertools.repeat(None, fuel)
+      self.fuel_given += fuel
+      yield self.fuel
+    yield map(RaiseAgain, itertools.repeat(error))
+
+  def CheckLimits(self, frame):
+    """Raises ResourceLimitExceeded if the program, taking a step in frame,
+    is over a limit, else returns how many steps it may take until the next
+    check."""
+    limits = self.limits
+    if self.cancelled:
+      raise RunCancelled()
+    steps = self.fuel_given + 1  # With the step being taken.
+    depth = 0
+    if limits.max_call_depth is not None:
+      depth = self.GetCallDepth(frame)
+      if depth > limits.max_call_depth:
+        raise ResourceLimitExceeded('max_call_depth', limits.max_call_depth)
+    if limits.max_steps is not None and steps > limits.max_steps:
+      raise ResourceLimitExceeded('max_steps', limits.max_steps)
+    if (limits.wall_seconds is not None and
+        time.perf_counter() - self.wall_start > limits.wall_seconds):
+      raise ResourceLimitExceeded('wall_seconds', limits.wall_seconds)
+    if (limits.cpu_seconds is not None and
+        time.thread_time() - self.cpu_start > limits.cpu_seconds):
+      raise ResourceLimitExceeded('cpu_seconds', limits.cpu_seconds)
+    if (limits.max_memory is not None and
+        tracemalloc.get_traced_memory()[0] - self.memory_start >
+        limits.max_memory):
+      raise ResourceLimitExceeded('max_memory', limits.max_memory)
+    fuel = self.check_interval
+    if limits.max_steps is not None:
+      fuel = min(fuel, limits.max_steps - steps + 1)
+    # The depth goes up by at most one a step.
+    if limits.max_call_depth is not None:
+      fuel = min(fuel, limits.max_call_depth - depth + 1)
+    return fuel
+
+def RaiseAgain(error):
+  """Raises a copy of error (without its traceback)."""
+  raise type(error)(*error.args)
+
+NO_RESOURCE_LIMITS = ResourceLimits()
+
+def NewRuntimeNamespace(output, governor=None):
+  """Returns a fresh namespace to run a compiled program in.
+
+  It holds nothing but the runtime helpers that generated code calls, with
+  _db_append_output writing to the given OutputSink, and the instrumentation
+  calling governor (a ResourceGovernor without limits by default).  Each run
+  gets its own namespace, so concurrent programs can't see each other's
+  variables or output, and everything a program defines is freed once it's
+  done.
+  """
+  namespace = {
+      '_shanghai_str': _shanghai_str,
+      '_db_append_output': output.Write,
+      '_shanghai_import': _shanghai_import,
+      '_shanghai_globals': _shanghai_globals,
+      '_shanghai_affine_sums': _shanghai_affine_sums,
+      '_shanghai_memoize': _shanghai_memoize,
+      }
+  if governor is None:
+    governor = ResourceGovernor(NO_RESOURCE_LIMITS)
+  governor.Attach(namespace)
+  return namespace
+
+DEFAULT_MEMOIZE_SIZE = 4096
+
+class CompileOptions:
+  """Options that change what a program compiles to.
+
+  They're part of the cache key, so a program compiled with other options
+  doesn't come out of the cache.
+  """
+
+  def __init__(self, optimize=True, memoize=False,
+               memoize_size=DEFAULT_MEMOIZE_SIZE, memoize_include=(),
+               memoize_exclude=(), instrument=False):
+    self.optimize = optimize  # Run OptimizeStatements() before translating.
+    # Memoize all pure 套路 (see FindPureFunctions()) ...
+    self.memoize = memoize
+    # ... keeping the last memoize_size results of each.
+    self.memoize_size = memoize_size
+    # Names of pure 套路 to memoize even if memoize is false.
+    self.memoize_include = tuple(sorted(memoize_include))
+    # Names of 套路 never to memoize.
+    self.memoize_exclude = tuple(sorted(memoize_exclude))
+    # Count the steps and the 套路 calls for the ResourceGovernor (see
+    # InstrumentStatements()), so that ResourceLimits can be enforced.
+    self.instrument = instrument
+
+  def CacheKey(self):
+    """Returns bytes that identify these options."""
+    return repr(sorted(vars(self).items())).encode('utf-8')
+
+  def Instrumented(self):
+    """Returns these options with instrument set."""
+    if self.instrument:
+      return self
+    return CompileOptions(**dict(vars(self), instrument=True))
+
+DEFAULT_COMPILE_OPTIONS = CompileOptions()
+
+# The file name of code that isn't from a file, like exec() gives it.
+DEFAULT_FILENAME = '<string>'
+
+def CompileToPython(code, stats=None, options=None, symbols=None,
+                    continuing=True, filename=DEFAULT_FILENAME):
+  """Returns (Python code, Python code object) translated from code.
+
+  The code object is compiled straight from a Python AST.  The Python code is
+  only there to be shown to the user, and is a PythonCode that isn't
+  translated until it's used.  If stats (a RunStats) is given, the
+  time of each phase and the sizes are recorded in it.  options is a
+  CompileOptions (DEFAULT_COMPILE_OPTIONS by default).
+
+  The line numbers of the code object are those of the statements in code,
+  and its file name is filename, so tracebacks and profilers point at the
+  shanghai source.
+
+  If symbols (a SymbolTable) is given, the identifiers get their Python
+  names from it.  Unless continuing is false, code then continues code
+  compiled with it before, into the same namespace.  Optimizations that need
+  to see the whole program, i.e. tail calls and memoizing, are left out of
+  such code.
+  """
+  if options is None:
+    options = DEFAULT_COMPILE_OPTIONS
+  # Counting the nodes takes a few percent of the compile time, so it's only
+  # done when asked.
+  count_nodes = stats is not None
+  if stats is None:
+    stats = RunStats()
+  with stats.Timing('tokenize'):
+    tokens, positions = TokenizeWithPositions(code)
+    lines = SourceLines(code)
+  with stats.Timing('parse'):
+    statements, remaining_tokens = ParseStmts(
+        TokenStream(tokens, positions, lines))
+  assert not remaining_tokens, ('多余符号：%s' % (remaining_tokens,))
+  stats.num_tokens = len(tokens)
+  return CompileStatementsToPython(statements, stats, options, symbols,
+                                   count_nodes, continuing, filename)
+
+def CompileStatementsToPython(statements, stats, options, symbols=None,
+                              count_nodes=False, continuing=True,
+                              filename=DEFAULT_FILENAME):
+  """Like CompileToPython(), for already parsed statements."""
+  if options is None:
+    options = DEFAULT_COMPILE_OPTIONS
+  continuing = continuing and symbols is not None
+  if options.optimize:
+    with stats.Timing('optimize'):
+      statements = OptimizeStatements(statements)
+      if not continuing:
+        statements = EliminateTailCalls(statements)
+  with stats.Timing('translate'):
+    py_code, module = TranslateToPython(statements, options, symbols,
+                                        continuing)
+  with stats.Timing('compile'):
+    code_object = compile(module, filename, 'exec')
+  if count_nodes:
+    stats.num_ast_nodes = sum(1 for _ in WalkAst(statements))
+  stats.py_code_size = GetCodeSize(code_object)
+  return py_code, code_object
+
+class PythonCode(collections.UserString):
+  """The Python code of a compiled program, for showing.
+
+  Most programs are compiled without being shown, and translating them to
+  Python code again costs about as much as compiling them, so it's only done
+  by calling translate the first time the code is used.  Otherwise it acts
+  like a str, and str() gives the real thing.
+  """
+
+  def __init__(self, translate):
+    if isinstance(translate, str):  # E.g. made by a UserString method.
+      self.code = translate
+      self.translate = None
+    else:
+      self.code = None
+      self.translate = translate
+
+  @property
+  def data(self):
+    if self.translate is not None:
+      self.code = self.translate()
+      self.translate = None
+    return self.code
+
+  def __reduce__(self):
+    # The translate function may not pickle.
+    return PythonCode, (self.data,)
+
+def GetCodeSize(code_object):
+  """Returns the number of bytes of bytecode in code_object, that of the
+  functions it defines included."""
+  return len(code_object.co_code) + sum(
+      GetCodeSize(const) for const in code_object.co_consts
+      if isinstance(const, type(code_object)))
+
+def TranslateToPython(statements, options=None, symbols=None,
+                      continuing=True):
+  """Returns (PythonCode, Python ast.Module) for the parsed statements.
+
+  See CompileToPython() for symbols and continuing.
+  """
+  if options is None:
+    options = DEFAULT_COMPILE_OPTIONS
+  continuing = continuing and symbols is not None
+  if continuing:
+    memoized = set()
+  else:
+    memoized = FindMemoizedFunctions(statements, options)
+    if symbols is None:
+      symbols = SymbolTable()
+  if options.instrument:
+    statements = InstrumentStatements(statements)
+
+  def TranslateForShowing():
+    # The statements were translated to ast nodes first, so the identifiers
+    # all have their Python names already.
+    py_code = []
+    for s in statements:
+      code = TranslateStatementToPython(s, symbols)
+      if s.kind == STMT_FUNC_DEF and s.value[0].value in memoized:
+        code = '@_shanghai_memoize(%d)\n%s' % (options.memoize_size, code)
+      py_code.append(code)
+    return '\n'.join(py_code)
+
+  py_code = PythonCode(TranslateForShowing)
+  module = ast.Module(body=[], type_ignores=[])
+  for s in statements:
+    nodes = TranslateStatementToPythonAst(s, symbols)
+    if s.kind == STMT_FUNC_DEF and s.value[0].value in memoized:
+      nodes[0].decorator_list.append(PythonCallAst(
+          '_shanghai_memoize', [ast.Constant(value=options.memoize_size)]))
+    module.body.extend(nodes)
+  if continuing:
+    # The Session's namespace has _db_symbols already, and it's the
+    # SymbolTable's own dict, so it's up to date.
+    ast.fix_missing_locations(module)
+    return py_code, module
+  # Tell _shanghai_import() which Python name each identifier got, both for
+  # binding what this program imports and for exporting what it defines.
+  # It's not shown in the Python code.
+  module.body.insert(0, ast.Assign(
+      targets=[ast.Name(id='_db_symbols', ctx=ast.Store())],
+      value=ast.Dict(
+          keys=[ast.Constant(value=var) for var in symbols.names],
+          values=[ast.Constant(value=name)
+                  for name in symbols.names.values()])))
+  ast.fix_missing_locations(module)
+  return py_code, module
+
+# Compiled programs are cached in this directory next to the source file.
+CACHE_DIR_NAME = '__pycache__'
+
+_translator_fingerprint = None
+def GetTranslatorFingerprint():
+  """Returns a digest of this translator's own source.
+
+  It's part of every cache key, so editing the translator invalidates all
+  cached programs.  Returns None if the source can't be read.
+  """
+  global _translator_fingerprint
+  if _translator_fingerprint is None:
+    try:
+      with open(__file__, 'rb') as translator_file:
+        _translator_fingerprint = hashlib.sha256(
+            translator_file.read()).digest()
+    except OSError:
+      return None
+  return _translator_fingerprint
+
+def GetCacheKey(code, options=None, filename=DEFAULT_FILENAME):
+  """Returns the cache key of code compiled with options under filename, or
+  None if it can't be cached."""
+  fingerprint = GetTranslatorFingerprint()
+  if fingerprint is None:
+    return None
+  if options is None:
+    options = DEFAULT_COMPILE_OPTIONS
+  return (importlib.util.MAGIC_NUMBER +
+          hashlib.sha256(fingerprint + options.CacheKey() +
+                         filename.encode('utf-8') + b'\0' +
+                         code.encode('utf-8')).digest())
+
+def GetCachePath(filepath):
+  """Returns the path of the cache file for a source file, or None."""
+  if sys.implementation.cache_tag is None:
+    return None
+  dirname, basename = os.path.split(os.path.abspath(filepath))
+  return os.path.join(dirname, CACHE_DIR_NAME, '%s.%s.pyc' % (
+      basename, sys.implementation.cache_tag))
+
+def LoadCachedPython(cache_path, key):
+  """Returns the cached (Python code, code object), or None on a miss."""
+  try:
+    with open(cache_path, 'rb') as cache_file:
+      data = cache_file.read()
+  except OSError:
+    return None
+  if not data.startswith(key):
+    return None  # Stale: the source or the translator has changed.
+  try:
+    py_code, code_object = marshal.loads(data[len(key):])
+  except (EOFError, ValueError, TypeError):
+    return None  # Corrupted.
+  return py_code, code_object
+
+def StoreCachedPython(cache_path, key, py_code, code_object):
+  """Writes the cache file atomically.  Errors are ignored."""
+  if sys.dont_write_bytecode:
+    return
+  try:
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+    try:
+      with os.fdopen(fd, 'wb') as tmp_file:
+        tmp_file.write(key + marshal.dumps((str(py_code), code_object)))
+      os.replace(tmp_path, cache_path)
+    except BaseException:
+      os.unlink(tmp_path)
+      raise
+  except OSError:
+    pass
+
+def CompileFileToPython(filepath, stats=None, options=None):
+  """Returns (Python code, Python code object) for a source file.
+
+  Like Python's __pycache__, the result is cached on disk, keyed by the hash
+  of the source and of the translator.  On a hit the source is not even
+  tokenized.
+  """
+  with io.open(filepath, 'r', encoding='utf-8') as src_file:
+    code = src_file.read()
+  return CompileSourceFileToPython(code, filepath, stats, options)
+
+def CompileSourceFileToPython(code, filepath, stats=None, options=None):
+  """Like CompileFileToPython, for the already read content of filepath."""
+  # Like Python's for modules, the file name of the code is absolute, so the
+  # cached code is right wherever it's run from.
+  filename = os.path.abspath(filepath)
+  key = GetCacheKey(code, options, filename)
+  cache_path = GetCachePath(filepath)
+  if key is not None and cache_path is not None:
+    if stats is None:
+      cached = LoadCachedPython(cache_path, key)
+    else:
+      with stats.Timing('load'):
+        cached = LoadCachedPython(cache_path, key)
+    if cached is not None:
+      if stats is not None:
+        stats.cache_hit = True
+        stats.py_code_size = GetCodeSize(cached[1])
+      return cached
+  py_code, code_object = CompileToPython(code, stats, options,
+                                         filename=filename)
+  if key is not None and cache_path is not None:
+    # A hit is shown without even tokenizing, so the Python code is cached
+    # too.
+    StoreCachedPython(cache_path, key, py_code, code_object)
+  return py_code, code_object
+
+# Where 阿庆，上 looks for .shanghai modules before sys.path.  Like
+# PYTHONPATH, it starts with the directories in $SHANGHAIPATH; running a
+# source file adds its directory.
+SHANGHAI_PATH = [d for d in os.environ.get('SHANGHAIPATH', '').split(
+    os.pathsep) if d]
+
+SOURCE_SUFFIX = '.shanghai'
+
+def AddToSearchPath(filepath):
+  """Lets the programs import the .shanghai modules next to filepath."""
+  dirname = os.path.dirname(os.path.abspath(filepath))
+  if dirname not in SHANGHAI_PATH:
+    SHANGHAI_PATH.append(dirname)
+
+class ShanghaiFinder(importlib.abc.MetaPathFinder):
+  """Finds shanghai modules, i.e. .shanghai files, for the import system."""
+
+  def find_spec(self, fullname, path, target=None):
+    dirs = SHANGHAI_PATH + sys.path if path is None else path
+    basename = fullname.rpartition('.')[2] + SOURCE_SUFFIX
+    for dirname in dirs:
+      filepath = os.path.join(dirname or os.curdir, basename)
+      if os.path.isfile(filepath):
+        return importlib.util.spec_from_file_location(
+            fullname, filepath, loader=ShanghaiLoader(filepath))
+    return None
+
+class ShanghaiLoader(importlib.abc.Loader):
+  """Runs a .shanghai file as a module.
+
+  The file is compiled through the disk cache, so a module that hasn't
+  changed loads straight from its .pyc.  Like any module, it's run once per
+  process.
+  """
+
+  def __init__(self, filepath):
+    self.filepath = filepath
+
+  def exec_module(self, module):
+    _, code_object = CompileFileToPython(self.filepath)
+    namespace = vars(module)
+    namespace.update(
+        _shanghai_str=_shanghai_str,
+        _db_append_output=_WriteToCurrentOutput,
+        _shanghai_import=_shanghai_import,
+        _shanghai_globals=_shanghai_globals,
+        _shanghai_memoize=_shanghai_memoize,
+        _shanghai_affine_sums=_shanghai_affine_sums)
+    exec(code_object, namespace)
+
+def InstallImportHook():
+  """Lets the import system find shanghai modules.  It's done the first
+  time a program imports something."""
+  if not any(isinstance(finder, ShanghaiFinder) for finder in sys.meta_path):
+    # Last, so that Python modules come first.
+    sys.meta_path.append(ShanghaiFinder())
+
+# The OutputSink of the program running in this thread (or task).
+_current_output = contextvars.ContextVar('_current_output', default=None)
+
+def _WriteToCurrentOutput(s):
+  """The _db_append_output of shanghai modules.
+
+  A module is shared by all the programs importing it, so it writes to
+  whichever is running.
+  """
+  output = _current_output.get()
+  if output is None:
+    sys.stdout.write(s)
+  else:
+    output.Write(s)
+
+def _shanghai_import(name, namespace, names=None):
+  """Runs 阿庆，上 name。 in the namespace of a program.
+
+  Like Python's import statement, it binds the top-level package of name.
+  If name is a shanghai module, the identifiers it defines are bound too,
+  under the Python names the program uses for them.
+
+  In a 套路, names are the identifiers it reads from outside, and nothing
+  is bound: the top-level package, and those of names that the module
+  defines, are returned in a dict for the 套路 to bind as locals.
+  """
+  InstallImportHook()
+  module = importlib.import_module(name)
+  top = name.partition('.')[0]
+  exports = getattr(module, '_db_symbols', None)
+  if not isinstance(exports, dict):
+    exports = {}  # A Python module.
+  module_namespace = vars(module)
+  if names is not None:
+    values = {top: sys.modules[top]}
+    for var in names:
+      module_name = exports.get(var)
+      if module_name in module_namespace:
+        values[var] = module_namespace[module_name]
+    return values
+  symbols = namespace.get('_db_symbols', {})
+  namespace[symbols.get(top, top)] = sys.modules[top]
+  for var, module_name in exports.items():
+    py_name = symbols.get(var)
+    if py_name is not None and var != top and module_name in module_namespace:
+      namespace[py_name] = module_namespace[module_name]
+
+def _shanghai_globals(namespace, py_names):
+  """Returns {Python name: value} for those of py_names that namespace, the
+  globals of a program, or the builtins have."""
+  values = {}
+  for py_name in py_names:
+    if py_name in namespace:
+      values[py_name] = namespace[py_name]
+    elif hasattr(builtins, py_name):
+      values[py_name] = getattr(builtins, py_name)
+  return values
+
+def ExecuteInNamespace(code_object, namespace, output, stats, flush=True):
+  """Runs a compiled program in namespace, whose _db_append_output writes to
+  output (an OutputSink), and flushes output unless flush is false."""
+  # Imported shanghai modules write to the output of the program running.
+  token = _current_output.set(output)
+  with stats.Timing('exec'):
+    try:
+      # See https://stackoverflow.com/questions/871887/using-exec-with-recursive-functions
+      # Use the same dictionary for local and global definitions.
+      # Needed for defining recursive shanghai functions.
+      exec(code_object, namespace, namespace)
+    finally:
+      _current_output.reset(token)
+      if flush:
+        output.Flush()
+
+def ExecutePython(code_object, sink, flush_threshold=DEFAULT_FLUSH_THRESHOLD,
+                  stats=None, limits=None, governor=None, env=None):
+  """Runs a compiled program in a fresh namespace, writing its output to
+  sink.  Unlike RunPython, this doesn't print anything else.
+
+  env maps Python names to the values they have when the program starts.
+
+  If the program was compiled with CompileOptions.instrument, it's stopped
+  with ResourceLimitExceeded once it goes over limits (a ResourceLimits).
+  To cancel it from another thread, pass in the governor for the limits.
+  """
+  if stats is None:
+    stats = RunStats()
+  output = OutputSink(sink, flush_threshold)
+  if governor is None:
+    governor = ResourceGovernor(
+        NO_RESOURCE_LIMITS if limits is None else limits)
+  namespace = NewRuntimeNamespace(output, governor)
+  if env is not None:
+    namespace.update(env)
+  governor.Start()
+  try:
+    ExecuteInNamespace(code_object, namespace, output, stats)
+  finally:
+    governor.Stop()
+    stats.output_bytes = output.num_bytes
+
+def RunPython(py_code, code_object, sink=None, capture=False,
+              flush_threshold=DEFAULT_FLUSH_THRESHOLD, stats=None,
+              show_stats=False, on_stats=None, limits=None):
+  """Runs a compiled program.
+
+  The program's output is written to sink (sys.stdout by default) while the
+  program runs, flush_threshold chars at a time.  If capture is true, the
+  output is collected and returned as a string instead.
+
+  The run is recorded in stats (a new RunStats by default), which is printed
+  afterwards if show_stats is true, and passed to on_stats if given.  See
+  ExecutePython() for limits.
+  """
+  if stats is None:
+    stats = RunStats()
   print('Python 代码：')
   print('%s' % (py_code,))
-  global _db_output
-  _db_output = ''
-  # See https://stackoverflow.com/questions/871887/using-exec-with-recursive-functions
-  # Use the same dictionary for local and global definitions.
-  # Needed for defining recursive shanghai functions.
-  exec(py_code, globals(), globals())
   print('运行结果：')
-  print('%s' % (_db_output,))
-  return _db_output
-
+  if capture:
+    sink = io.StringIO()
+  elif sink is None:
+    sink = sys.stdout
+  ExecutePython(code_object, sink, flush_threshold, stats, limits)
+  output = None
+  if capture:
+    output = sink.getvalue()
+    print('%s' % (output,))
+  else:
+    print()
+  if show_stats:
+    print(stats)
+  if on_stats is not None:
+    on_stats(stats)
+  return output
+
+def GetRunOptions(options, limits):
+  """Returns the CompileOptions to compile a program run with limits."""
+  if limits is None:
+    return options
+  return (DEFAULT_COMPILE_OPTIONS if options is None
+          else options).Instrumented()
+
+def Run(code, sink=None, capture=False,
+        flush_threshold=DEFAULT_FLUSH_THRESHOLD, show_stats=False,
+        on_stats=None, options=None, limits=None):
+  stats = RunStats() if show_stats or on_stats is not None else None
+  return RunPython(*CompileToPython(code, stats,
+                                    GetRunOptions(options, limits)),
+                   sink=sink, capture=capture,
+                   flush_threshold=flush_threshold, stats=stats,
+                   show_stats=show_stats, on_stats=on_stats, limits=limits)
+
+def RunFile(filepath, sink=None, capture=False,
+            flush_threshold=DEFAULT_FLUSH_THRESHOLD, show_stats=False,
+            on_stats=None, options=None, limits=None):
+  AddToSearchPath(filepath)
+  stats = RunStats() if show_stats or on_stats is not None else None
+  return RunPython(*CompileFileToPython(filepath, stats,
+                                        GetRunOptions(options, limits)),
+                   sink=sink, capture=capture,
+                   flush_threshold=flush_threshold, stats=stats,
+                   show_stats=show_stats, on_stats=on_stats, limits=limits)
+
+class CompileError(Exception):
+  """Raised by Compile() for code that doesn't compile.
+
+  Unlike the SystemExit the parser raises, it's caught by except Exception,
+  and doesn't stop an event loop.
+  """
+
+class Program:
+  """A compiled program, returned by Compile().
+
+  It can be run any number of times, without compiling it again.  Each run
+  gets a fresh namespace, so runs can't see each other's variables.
+  """
+
+  def __init__(self, code, py_code, code_object, symbols, options, stats):
+    self.code = code  # The source code.
+    self.py_code = py_code  # The Python code, for showing.
+    self.code_object = code_object
+    self.symbols = symbols  # Maps identifiers to Python names.
+    self.options = options
+    self.stats = stats  # A RunStats of the compilation.
+
+  def Run(self, sink=None, env=None, flush_threshold=DEFAULT_FLUSH_THRESHOLD,
+          stats=None, limits=None):
+    """Runs the program quietly, writing its output to sink.  If sink is
+    None, the output is returned as a string instead.
+
+    env maps identifiers to the values they have when the program starts,
+    e.g. {'种子': 42} for a program that reads 种子 without setting it.
+    limits (a ResourceLimits) needs the program compiled with
+    CompileOptions.instrument.  The run is recorded in stats if given.
+    """
+    if limits is not None and not self.options.instrument:
+      raise ValueError('程序翻译的辰光呒没插计数，勿好限制资源。')
+    if env is not None:
+      env = {self.symbols.get(var, var): value for var, value in env.items()}
+    capture = sink is None
+    if capture:
+      sink = io.StringIO()
+    ExecutePython(self.code_object, sink, flush_threshold, stats, limits,
+                  env=env)
+    return sink.getvalue() if capture else None
+
+def Compile(code, options=None, stats=None, filename=DEFAULT_FILENAME):
+  """Compiles code into a Program, with options (a CompileOptions).
+
+  The time of each phase and the sizes are recorded in stats (a new
+  RunStats by default), which the Program keeps.  Tracebacks show filename
+  as the file of the code.  Raises CompileError if code doesn't compile.
+  """
+  if options is None:
+    options = DEFAULT_COMPILE_OPTIONS
+  if stats is None:
+    stats = RunStats()
+  symbols = SymbolTable()
+  try:
+    py_code, code_object = CompileToPython(code, stats, options, symbols,
+                                           continuing=False, filename=filename)
+  except (SystemExit, AssertionError) as e:
+    raise CompileError(str(e)) from None
+  return Program(code, py_code, code_object, symbols.names, options, stats)
+
+class Session:
+  """Runs code piece by piece in one namespace, e.g. at the interactive
+  prompt.
+
+  Each piece is compiled on its own, with the identifiers keeping the Python
+  names earlier pieces gave them, so what those defined stays defined and is
+  never compiled again.
+  """
+
+  def __init__(self, sink=None, flush_threshold=DEFAULT_FLUSH_THRESHOLD,
+               options=None, limits=None, filename=DEFAULT_FILENAME):
+    self.output = OutputSink(sink if sink is not None else sys.stdout,
+                             flush_threshold)
+    self.filename = filename  # Of the code run, for tracebacks.
+    # With limits, everything run in the session counts towards them, from
+    # when it's created until governor.Stop() is called.
+    self.governor = ResourceGovernor(
+        NO_RESOURCE_LIMITS if limits is None else limits)
+    self.namespace = NewRuntimeNamespace(self.output, self.governor)
+    self.symbols = SymbolTable()
+    self.namespace['_db_symbols'] = self.symbols.names
+    self.options = GetRunOptions(options, limits)
+    if limits is not None:
+      self.governor.Start()
+
+  def Compile(self, code, stats=None):
+    """Returns the Python code object for code."""
+    _, code_object = CompileToPython(code, stats, self.options, self.symbols,
+                                     filename=self.filename)
+    return code_object
+
+  def CompileStatements(self, statements, stats=None):
+    """Returns the Python code object for parsed statements."""
+    if stats is None:
+      stats = RunStats()
+    _, code_object = CompileStatementsToPython(
+        statements, stats, self.options, self.symbols,
+        filename=self.filename)
+    return code_object
+
+  def Execute(self, code_object, stats=None, flush=True):
+    """Runs a code object returned by Compile(), flushing its output unless
+    flush is false."""
+    if stats is None:
+      stats = RunStats()
+    num_bytes = self.output.num_bytes
+    try:
+      ExecuteInNamespace(code_object, self.namespace, self.output, stats,
+                         flush)
+    finally:
+      stats.output_bytes = self.output.num_bytes - num_bytes
+
+  def Run(self, code):
+    """Compiles and runs code.  Returns its RunStats."""
+    stats = RunStats()
+    self.Execute(self.Compile(code, stats), stats)
+    return stats
+
+# How many top-level statements RunFileStreaming() compiles at a time.
+# Compiling them one by one would make compile() and exec() cost more than
+# the statements themselves.
+STREAM_BATCH_SIZE = 64
+
+def RunFileStreaming(filepath, sink=None,
+                     flush_threshold=DEFAULT_FLUSH_THRESHOLD, stats=None,
+                     options=None, limits=None):
+  """Runs a source file while reading it, a few top-level statements at a
+  time, in one Session.
+
+  Neither the whole source nor all its tokens, statements or Python code are
+  ever in memory at once, so memory use grows with the number of variables,
+  not with the size of the file, and the output starts before the file has
+  been read to the end.  Reading and tokenizing are timed as part of parsing
+  in stats.  See ExecutePython() for limits.
+
+  Unlike RunFile(), only the program's output is printed, and nothing is
+  cached.  Like at the interactive prompt, tail calls aren't turned into
+  loops, no 套路 is memoized, and the statements before one that doesn't
+  parse have run by the time it's found.
+  """
+  AddToSearchPath(filepath)
+  if stats is None:
+    stats = RunStats()
+  session = Session(sink, flush_threshold, options, limits,
+                    os.path.abspath(filepath))
+  py_code_size = 0
+  try:
+    with io.open(filepath, 'r', encoding='utf-8') as src_file:
+      statements = ParseStatementsStreaming(ReadSentences(src_file))
+      while True:
+        batch = []
+        parse_error = None
+        try:
+          with stats.Timing('parse'):
+            batch.extend(itertools.islice(statements, STREAM_BATCH_SIZE))
+        except (SystemExit, AssertionError) as e:
+          # The statements before the one that didn't parse still run.
+          parse_error = e
+        if batch:
+          code_object = session.CompileStatements(batch, stats)
+          py_code_size += stats.py_code_size
+          session.Execute(code_object, stats, flush=False)
+        if parse_error is not None:
+          raise parse_error
+        if not batch:
+          break
+  finally:
+    session.governor.Stop()
+    session.output.Flush()
+    stats.py_code_size = py_code_size
+    stats.output_bytes = session.output.num_bytes
+
+def NeedsMoreInput(code):
+  """Returns True if code typed at the prompt isn't finished yet.
+
+  It isn't if it doesn't end with 。, has a block that isn't closed, or ends
+  with a 轧苗头 that a 勿来赛就 could still follow.
+  """
+  tokens = list(Tokenize(code))
+  if not tokens:
+    return False
+  if tokens[-1] is not KEYWORD_TOKENS[KW_PERIOD]:
+    return True
+  if GetBlockDepthChange(tokens) > 0:
+    return True
+  try:
+    statements = ParseToAst(code)
+  except (SystemExit, AssertionError):
+    return False  # Let running it report the error.
+  return (bool(statements) and statements[-1].kind == STMT_CONDITIONAL and
+          statements[-1].value[2] is None)
+
+REPL_PROMPT = '上海> '
+REPL_CONTINUATION_PROMPT = '  ... '
+
+def Repl(session, show_time=False, input_func=input):
+  """Reads code from input_func and runs it in session until the end of
+  input.
+
+  Lines are read until the code is finished (see NeedsMoreInput()) or an
+  empty line is entered.  Lines starting with : are commands.
+  """
+  print('shanghai 交互模式。打 :time 开关用时报告，:quit 退出。')
+  code = ''
+  while True:
+    try:
+      line = input_func(REPL_CONTINUATION_PROMPT if code else REPL_PROMPT)
+    except EOFError:
+      print()
+      return
+    except KeyboardInterrupt:
+      print('\n勿算了。')
+      code = ''
+      continue
+
+    if not code and line.strip().startswith(':'):
+      command = line.strip()
+      if command == ':time':
+        show_time = not show_time
+        print('报告用时。' if show_time else '勿报告用时。')
+      elif command in (':quit', ':q'):
+        return
+      else:
+        print('我勿晓得 %s 是啥命令。' % (command,))
+      continue
+
+    code += line + '\n'
+    if line.strip() and NeedsMoreInput(code):
+      continue
+    if not code.strip():
+      code = ''
+      continue
+    stats = RunStats()
+    try:
+      code_object = session.Compile(code, stats)
+    except (SystemExit, AssertionError) as e:
+      print(e)
+      code = ''
+      continue
+    code = ''
+    try:
+      session.Execute(code_object, stats)
+    except KeyboardInterrupt:
+      print('\n勿跑了。')
+    except Exception:
+      # Only the frame where it went wrong, not the REPL's own.
+      traceback.print_exc(limit=-1)
+    if show_time:
+      print('（编译 %.3f 毫秒，运行 %.3f 毫秒）' % (
+          sum(seconds for phase, seconds in stats.wall_seconds.items()
+              if phase != 'exec') * 1000,
+          stats.wall_seconds.get('exec', 0.0) * 1000))
+
+class BatchResult:
+  """The result of running one source file in batch mode."""
+
+  def __init__(self, filepath, py_code, output, error, seconds, stats):
+    self.filepath = filepath
+    self.py_code = py_code  # None if the file didn't compile.
+    self.output = output
+    self.error = error  # None if the program ran fine.
+    self.seconds = seconds
+    self.stats = stats  # A RunStats, or None if not collected.
+
+  def ExitStatus(self):
+    return 0 if self.error is None else 1
+
+def RunFileForBatch(filepath, collect_stats=False, options=None,
+                    limits=None):
+  """Compiles and runs a source file quietly.  Returns a BatchResult.
+
+  This runs in a worker process of RunBatch().
+  """
+  start = time.perf_counter()
+  py_code = None
+  sink = io.StringIO()
+  error = None
+  stats = RunStats() if collect_stats else None
+  try:
+    AddToSearchPath(filepath)
+    py_code, code_object = CompileFileToPython(
+        filepath, stats, GetRunOptions(options, limits))
+    ExecutePython(code_object, sink, stats=stats, limits=limits)
+  except SystemExit as e:
+    if e.code not in (None, 0):
+      error = str(e.code)
+  except ResourceLimitExceeded as e:
+    error = str(e)
+  except Exception:
+    error = traceback.format_exc()
+  return BatchResult(filepath, py_code, sink.getvalue(), error,
+                     time.perf_counter() - start, stats)
+
+def RunBatch(filepaths, jobs, sink=None, show_stats=False, options=None,
+             limits=None):
+  """Runs the source files in a pool of jobs worker processes.
+
+  The results are printed in the order of filepaths, followed by the timing
+  of each file.  Returns 0 if all programs ran fine, or 1 otherwise.
+  """
+  if sink is None:
+    sink = sys.stdout
+  start = time.perf_counter()
+  results = []
+  with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+    futures = []
+    for filepath in filepaths:
+      try:
+        future = executor.submit(RunFileForBatch, filepath, show_stats,
+                                 options, limits)
+      except concurrent.futures.process.BrokenProcessPool as e:
+        future = concurrent.futures.Future()
+        future.set_exception(e)
+      futures.append(future)
+    for filepath, future in zip(filepaths, futures):
+      try:
+        result = future.result()
+      except concurrent.futures.process.BrokenProcessPool as e:
+        # A worker died, e.g. killed for running out of memory, and took
+        # the files still to run with it.  They fail, and the rest are
+        # still reported.
+        result = BatchResult(filepath, None, '', '工作进程死脱了：%s' % (e,),
+                             time.perf_counter() - start, None)
+      results.append(result)
+      print('执行 %s ...' % (result.filepath,))
+      if result.py_code is not None:
+        print('Python 代码：')
+        print('%s' % (result.py_code,))
+        print('运行结果：')
+        sys.stdout.flush()
+        sink.write(result.output)
+        sink.flush()
+        print()
+      if result.error is not None:
+        print('出错了：%s' % (result.error,))
+      if show_stats and result.stats is not None:
+        print(result.stats)
+  wall_seconds = time.perf_counter() - start
+
+  print('用了 %d 个进程执行 %d 只文件，总共 %.3f 秒：' % (
+      jobs, len(results), wall_seconds))
+  for result in results:
+    print('  %8.3f 秒  %s  %s' % (
+        result.seconds, '好' if result.error is None else '坏',
+        result.filepath))
+  return max((result.ExitStatus() for result in results), default=0)
+
+DEFAULT_COMPILE_CACHE_SIZE = 256
+
+class CompileCache:
+  """An in-memory LRU cache of compiled programs, in front of the disk cache.
+
+  The server keeps one across requests, so a program it has seen before is
+  neither parsed nor read back from __pycache__.  It's thread-safe.
+  """
+
+  def __init__(self, max_entries=DEFAULT_COMPILE_CACHE_SIZE):
+    self.max_entries = max_entries
+    self.entries = collections.OrderedDict()  # key -> (py_code, code_object)
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def Compile(self, code, filepath=None, options=None):
+    """Returns (Python code, Python code object) for code compiled with
+    options.
+
+    If filepath is given, code is its content and the disk cache is used on
+    a miss.
+    """
+    key = GetCacheKey(code, options, DEFAULT_FILENAME if filepath is None
+                      else os.path.abspath(filepath))
+    if key is not None:
+      with self.lock:
+        compiled = self.entries.get(key)
+        if compiled is not None:
+          self.entries.move_to_end(key)
+          self.hits += 1
+          return compiled
+        self.misses += 1
+    if filepath is None:
+      compiled = CompileToPython(code, options=options)
+    else:
+      compiled = CompileSourceFileToPython(code, filepath, options=options)
+    if key is not None:
+      with self.lock:
+        self.entries[key] = compiled
+        while len(self.entries) > self.max_entries:
+          self.entries.popitem(last=False)
+    return compiled
+
+# The server and the client talk in lines of JSON.  A request is
+#   {"path": 源程序文件的绝对路径} or {"code": 源程序}
+# optionally with "flush_threshold", "options" (of CompileOptions) and
+# "limits" (of ResourceLimits).  The server answers with any number of
+#   {"log": 要印到屏幕上的字} and {"output": 程序嘎讪胡的字}
+# followed by one {"status": 0 或者 1, "error": 出错信息或者 null}.
+
+def SendMessage(wfile, message):
+  wfile.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+  wfile.flush()
+
+class MessageWriter:
+  """A file-like object that sends everything written to it as messages of
+  the given kind."""
+
+  def __init__(self, wfile, kind):
+    self.wfile = wfile
+    self.kind = kind
 
-if __name__ == '__main__':
-  if len(sys.argv) == 1:
+  def write(self, s):
+    if s:
+      SendMessage(self.wfile, {self.kind: s})
+
+class ShanghaiRequestHandler(socketserver.StreamRequestHandler):
+  """Handles the requests of one client connection, one at a time."""
+
+  def handle(self):
+    try:
+      for line in self.rfile:
+        if line.strip():
+          self.server.HandleRequest(json.loads(line.decode('utf-8')),
+                                    self.wfile)
+    except (BrokenPipeError, ConnectionResetError):
+      pass  # The client went away, maybe in the middle of a run.
+
+if hasattr(socketserver, 'UnixStreamServer'):
+  class ShanghaiServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """Compiles and runs programs sent over a Unix socket.
+
+    Each request runs in its own thread and its own namespace.  Output the
+    program doesn't send through 嘎讪胡 (e.g. from an imported Python
+    module) ends up on the server's stdout, and it can't read the client's
+    stdin.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, compile_cache=None, verbose=False):
+      RemoveStaleSocket(socket_path)
+      socketserver.UnixStreamServer.__init__(self, socket_path,
+                                             ShanghaiRequestHandler)
+      self.compile_cache = (CompileCache() if compile_cache is None
+                            else compile_cache)
+      self.verbose = verbose
+
+    def HandleRequest(self, request, wfile):
+      start = time.perf_counter()
+      name = request.get('path', '<code>')
+      error = None
+      try:
+        if 'path' in request:
+          filepath = request['path']
+          AddToSearchPath(filepath)
+          with io.open(filepath, 'r', encoding='utf-8') as src_file:
+            code = src_file.read()
+        else:
+          filepath = None
+          code = request['code']
+        options = CompileOptions(**request.get('options', {}))
+        limits = None
+        if 'limits' in request:
+          limits = ResourceLimits(**request['limits'])
+        py_code, code_object = self.compile_cache.Compile(
+            code, filepath, GetRunOptions(options, limits))
+        log = MessageWriter(wfile, 'log')
+        log.write('Python 代码：\n%s\n运行结果：\n' % (py_code,))
+        ExecutePython(code_object, MessageWriter(wfile, 'output'),
+                      request.get('flush_threshold', DEFAULT_FLUSH_THRESHOLD),
+                      limits=limits)
+        log.write('\n')
+      except SystemExit as e:
+        if e.code not in (None, 0):
+          error = str(e.code)
+      except ResourceLimitExceeded as e:
+        error = str(e)
+      except (BrokenPipeError, ConnectionResetError):
+        raise
+      except Exception:
+        error = traceback.format_exc()
+      SendMessage(wfile, {'status': 0 if error is None else 1,
+                          'error': error})
+      if self.verbose:
+        print('  %8.3f 秒  %s  %s' % (time.perf_counter() - start,
+                                     '好' if error is None else '坏', name))
+        sys.stdout.flush()
+
+    def server_close(self):
+      socketserver.UnixStreamServer.server_close(self)
+      try:
+        os.unlink(self.server_address)
+      except OSError:
+        pass
+
+def RemoveStaleSocket(socket_path):
+  """Removes the socket file left behind by a dead server.
+
+  Raises OSError if another server is still listening on it.
+  """
+  try:
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+      return  # Let bind() complain about it.
+  except OSError:
+    return
+  client = ConnectToServer(socket_path)
+  if client is not None:
+    client.close()
+    raise OSError('%s 上已经有服务了' % (socket_path,))
+  os.unlink(socket_path)
+
+def Serve(socket_path):
+  """Serves on socket_path until interrupted."""
+  if not hasattr(socketserver, 'UnixStreamServer'):
+    sys.exit('介只系统勿支持 Unix 套接字。')
+  with ShanghaiServer(socket_path, verbose=True) as server:
+    print('在 %s 上等程序 ...' % (socket_path,))
+    sys.stdout.flush()
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+
+def ConnectToServer(socket_path):
+  """Returns a socket connected to the server, or None if there's none."""
+  if not hasattr(socket, 'AF_UNIX'):
+    return None
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(socket_path)
+  except OSError:
+    client.close()
+    return None
+  return client
+
+def RunOnServer(client, request, sink=None):
+  """Sends one request over a connected socket and prints the answer like
+  RunFile() would, with the program's output going to sink (sys.stdout by
+  default).
+
+  Returns (status, error).
+  """
+  if sink is None:
+    sink = sys.stdout
+  client.sendall(
+      (json.dumps(request, ensure_ascii=False) + '\n').encode('utf-8'))
+  with client.makefile('rb') as rfile:
+    for line in rfile:
+      message = json.loads(line.decode('utf-8'))
+      if 'log' in message:
+        sys.stdout.write(message['log'])
+      elif 'output' in message:
+        sys.stdout.flush()
+        sink.write(message['output'])
+        sink.flush()
+      else:
+        sys.stdout.flush()
+        return message['status'], message['error']
+  raise ConnectionResetError('服务断脱了')
+
+def RunFileOnServer(socket_path, filepath, sink=None,
+                    flush_threshold=DEFAULT_FLUSH_THRESHOLD, options=None,
+                    limits=None):
+  """Like RunFile(), but runs the file on the server listening on
+  socket_path.  If there's no server, runs it here.
+
+  Returns (status, error).
+  """
+  client = ConnectToServer(socket_path)
+  if client is None:
+    try:
+      RunFile(filepath, sink=sink, flush_threshold=flush_threshold,
+              options=options, limits=limits)
+    except ResourceLimitExceeded as e:
+      return 1, str(e)
+    return 0, None
+  if options is None:
+    options = DEFAULT_COMPILE_OPTIONS
+  request = {'path': os.path.abspath(filepath),
+             'flush_threshold': flush_threshold,
+             'options': vars(options)}
+  if limits is not None:
+    request['limits'] = limits.ToDict()
+  with client:
+    return RunOnServer(client, request, sink=sink)
+
+# For asyncio code, e.g. a server: programs are compiled and run in an
+# executor, so they don't hold up the event loop.
+
+def CompileAndExecute(code, sink, flush_threshold, stats, options, governor):
+  """Compiles and runs code quietly, held to governor.
+
+  This runs in a worker thread of an AsyncRunner.
+  """
+  ExecutePython(Compile(code, options, stats).code_object, sink,
+                flush_threshold, stats, governor=governor)
+
+def CompileAndExecuteInProcess(code, options, limits):
+  """Like CompileAndExecute(), in a worker process of an AsyncRunner.
+
+  Returns the output and the RunStats.
+  """
+  sink = io.StringIO()
+  stats = RunStats()
+  CompileAndExecute(code, sink, DEFAULT_FLUSH_THRESHOLD, stats, options,
+                    ResourceGovernor(limits))
+  return sink.getvalue(), stats
+
+DEFAULT_MAX_IN_FLIGHT = 8
+
+class AsyncRunner:
+  """Runs programs for asyncio code, off the event loop.
+
+  Programs are compiled and run in executor, a concurrent.futures executor
+  (a pool of max_in_flight threads by default).  At most max_in_flight of
+  them run at a time, and the rest wait their turn.  Each is compiled with
+  CompileOptions.instrument and held to limits, so a program running in a
+  thread stops soon after it's cancelled or times out.  In a
+  ProcessPoolExecutor, a program that has started can only be stopped by
+  its limits, so its timeout is made a wall_seconds limit too; and its
+  output comes in one chunk, once it's done.
+
+  A runner must only be used in one event loop.
+  """
+
+  def __init__(self, executor=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+               flush_threshold=DEFAULT_FLUSH_THRESHOLD, options=None,
+               limits=None):
+    self.own_executor = executor is None
+    if executor is None:
+      executor = concurrent.futures.ThreadPoolExecutor(max_in_flight)
+    self.executor = executor
+    self.in_process = isinstance(executor,
+                                 concurrent.futures.ProcessPoolExecutor)
+    self.max_in_flight = max_in_flight
+    self.slots = None  # An asyncio.Semaphore, made in the event loop.
+    self.flush_threshold = flush_threshold
+    self.limits = NO_RESOURCE_LIMITS if limits is None else limits
+    self.options = GetRunOptions(options, self.limits)
+
+  def Start(self, code, timeout=None):
+    """Starts running code, and returns its AsyncRun straight away.
+
+    Must be called in the event loop.  If the run isn't over timeout seconds
+    from now, waiting for a slot included, it's cancelled and fails with
+    asyncio.TimeoutError.
+    """
+    if self.slots is None:
+      self.slots = asyncio.Semaphore(self.max_in_flight)
+    return AsyncRun(self, code, timeout)
+
+  def GetProcessLimits(self, timeout):
+    """Returns the limits for a program with timeout in a worker process."""
+    limits = self.limits
+    if timeout is not None and (limits.wall_seconds is None or
+                                timeout < limits.wall_seconds):
+      limits = ResourceLimits(**dict(limits.ToDict(), wall_seconds=timeout))
+    return limits
+
+  def Close(self):
+    """Shuts down the executor if the runner made it.  Programs still
+    running finish in the background."""
+    if self.own_executor:
+      self.executor.shutdown(wait=False)
+
+class AsyncRun:
+  """A program started by AsyncRunner.Start().
+
+  Await it for the program's output.  Or iterate over it once with async for
+  to get the output in chunks while the program runs, then await it to see
+  whether the program failed.  Awaiting raises what the program raised:
+  CompileError, ResourceLimitExceeded, asyncio.TimeoutError and so on.
+  """
+
+  def __init__(self, runner, code, timeout):
+    self.runner = runner
+    self.loop = asyncio.get_running_loop()
+    self.chunks = []  # The output so far.
+    self.new_chunks = asyncio.Queue()  # Ends with None.
+    self.stats = RunStats()
+    self.governor = ResourceGovernor(runner.limits)
+    # The concurrent.futures.Future of the program, once it's submitted to
+    # the executor.  It's what the program really ended with, even after the
+    # run was cancelled.
+    self.future = None
+    run_task = self.loop.create_task(self.Run(code, timeout))
+    run_task.add_done_callback(lambda _: self.new_chunks.put_nowait(None))
+    self.task = self.loop.create_task(asyncio.wait_for(run_task, timeout))
+    # Even if it's cancelled before wait_for() gets going.
+    self.task.add_done_callback(lambda _: run_task.cancel())
+
+  async def Run(self, code, timeout):
+    runner = self.runner
+    await runner.slots.acquire()
+    try:
+      if runner.in_process:
+        limits = runner.GetProcessLimits(timeout)
+        future = runner.executor.submit(
+            CompileAndExecuteInProcess, code, runner.options, limits)
+      else:
+        future = runner.executor.submit(
+            CompileAndExecute, code, self, runner.flush_threshold,
+            self.stats, runner.options, self.governor)
+    except BaseException:
+      runner.slots.release()
+      raise
+    self.future = future
+    # The slot is held until the program has really stopped.
+    future.add_done_callback(lambda _: self.CallInLoop(runner.slots.release))
+    wrapped_future = asyncio.wrap_future(future)
+    try:
+      result = await asyncio.shield(wrapped_future)
+    except asyncio.CancelledError:
+      future.cancel()  # In case it hasn't started.
+      self.governor.Cancel()
+      # Awaiting the run doesn't get the RunCancelled it ends with, which is
+      # left in self.future.
+      wrapped_future.add_done_callback(
+          lambda f: f.cancelled() or f.exception())
+      raise
+    except ResourceLimitExceeded as e:
+      # The worker process may notice the timeout first.
+      if runner.in_process and limits is not runner.limits and (
+          e.resource == 'wall_seconds'):
+        raise asyncio.TimeoutError() from None
+      raise
+    if runner.in_process:
+      output, self.stats = result
+      self.AddChunk(output)
+    return ''.join(self.chunks)
+
+  def CallInLoop(self, func, *args):
+    """Has the event loop call func(*args), unless the loop is gone.  May be
+    called from any thread."""
+    try:
+      self.loop.call_soon_threadsafe(func, *args)
+    except RuntimeError:
+      pass  # The loop was closed, and nobody's waiting any more.
+
+  def write(self, s):
+    """Called by the program's OutputSink, in the worker thread."""
+    self.CallInLoop(self.AddChunk, s)
+
+  def AddChunk(self, s):
+    if s:
+      self.chunks.append(s)
+      self.new_chunks.put_nowait(s)
+
+  def Cancel(self):
+    self.task.cancel()
+
+  def __await__(self):
+    return self.task.__await__()
+
+  async def __aiter__(self):
+    while True:
+      chunk = await self.new_chunks.get()
+      if chunk is None:
+        return
+      yield chunk
+
+async def RunAsync(code, timeout=None, runner=None):
+  """Runs code off the event loop, and returns its output.
+
+  The program is run by runner (an AsyncRunner), which limits how many
+  programs run at once; by default it gets a thread of its own.  See
+  AsyncRunner.Start() for timeout.
+  """
+  if runner is not None:
+    return await runner.Start(code, timeout)
+  runner = AsyncRunner(max_in_flight=1)
+  try:
+    return await runner.Start(code, timeout)
+  finally:
+    runner.Close()
+
+def Main(argv):
+  if len(argv) == 1:
     sys.exit(__doc__)
 
-  for filepath in sys.argv[1:]:
-    with io.open(filepath, 'r', encoding='utf-8') as src_file:
+  parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]))
+  parser.add_argument('filepaths', metavar='源程序文件名', nargs='*')
+  parser.add_argument('-o', '--output', metavar='输出文件名',
+                      help='把运行结果写到这只文件里，勿写到屏幕上')
+  parser.add_argument('-j', '--jobs', type=int, metavar='进程数',
+                      help='用介许多个进程一道执行所有文件，最后报告用时')
+  parser.add_argument('--flush-threshold', type=int,
+                      default=DEFAULT_FLUSH_THRESHOLD, metavar='字数',
+                      help='攒到介许多字再写出去（默认 %(default)s）')
+  parser.add_argument('--no-optimize', dest='optimize',
+                      action='store_false',
+                      help='勿要优化，翻译出来的代码同源程序一句对一句')
+  parser.add_argument('--memoize', action='store_true',
+                      help='记牢所有纯套路的结果，同样的参数勿要再算一遍')
+  parser.add_argument('--memoize-size', type=int,
+                      default=DEFAULT_MEMOIZE_SIZE, metavar='个数',
+                      help='每只套路最多记牢介许多结果（默认 %(default)s）')
+  parser.add_argument('--memoize-only', action='append', default=[],
+                      metavar='套路名',
+                      help='就算没 --memoize 也记牢介只纯套路的结果（好用几趟）')
+  parser.add_argument('--no-memoize', action='append', default=[],
+                      metavar='套路名',
+                      help='勿要记牢介只套路的结果（好用几趟）')
+  parser.add_argument('--stats', action='store_true',
+                      help='跑好以后报告每只阶段用了多少辰光，还有各样物事的大小')
+  parser.add_argument('--max-seconds', type=float, metavar='秒',
+                      help='程序最多跑介许多秒')
+  parser.add_argument('--max-cpu-seconds', type=float, metavar='秒',
+                      help='程序最多用介许多秒 CPU')
+  parser.add_argument('--max-steps', type=int, metavar='步数',
+                      help='循环同套路调用加起来最多介许多趟')
+  parser.add_argument('--max-call-depth', type=int, metavar='层数',
+                      help='套路最多套介许多层')
+  parser.add_argument('--max-memory', type=int, metavar='兆字节',
+                      help='程序最多用介许多兆内存（会慢几倍）')
+  parser.add_argument('--stream', action='store_true',
+                      help='一面读源程序一面一句一句执行，再大的文件也勿会吃光内存')
+  parser.add_argument('-i', '--interactive', action='store_true',
+                      help='跑好源程序以后勿退出，一句一句读进来执行')
+  parser.add_argument('--serve', metavar='套接字',
+                      help='勿退出，一直在介只 Unix 套接字上等程序来执行')
+  parser.add_argument('--connect', metavar='套接字',
+                      help='叫介只套接字上的服务执行；没服务就自家执行')
+  args = parser.parse_args(argv[1:])
+  if args.serve:
+    if args.filepaths:
+      parser.error('--serve 勿要源程序文件名')
+    Serve(args.serve)
+    return
+  if args.interactive and (args.jobs or args.connect):
+    parser.error('-i 勿好同 -j 或者 --connect 一道用')
+  if args.stream and (args.jobs or args.connect or args.interactive):
+    parser.error('--stream 勿好同 -j、--connect 或者 -i 一道用')
+  if not args.filepaths and not args.interactive:
+    parser.error('缺源程序文件名')
+  if args.stats and args.connect:
+    parser.error('--stats 勿好同 --connect 一道用')
+
+  if args.memoize_size <= 0:
+    parser.error('--memoize-size 要比 0 大')
+  if args.jobs is not None and args.jobs <= 0:
+    parser.error('-j 要比 0 大')
+  limits = None
+  limit_args = (args.max_seconds, args.max_cpu_seconds, args.max_steps,
+                args.max_call_depth, args.max_memory)
+  if any(arg is not None for arg in limit_args):
+    if args.interactive:
+      parser.error('-i 勿好限制资源')
+    if any(arg is not None and arg < 0 for arg in limit_args):
+      parser.error('资源限制勿好是负数')
+    limits = ResourceLimits(
+        wall_seconds=args.max_seconds, cpu_seconds=args.max_cpu_seconds,
+        max_steps=args.max_steps, max_call_depth=args.max_call_depth,
+        max_memory=(None if args.max_memory is None
+                    else args.max_memory * 1024 * 1024))
+  options = CompileOptions(optimize=args.optimize, memoize=args.memoize,
+                           memoize_size=args.memoize_size,
+                           memoize_include=args.memoize_only,
+                           memoize_exclude=args.no_memoize)
+  sink = None
+  if args.output:
+    sink = io.open(args.output, 'w', encoding='utf-8')
+  try:
+    if args.interactive:
+      session = Session(sink=sink, flush_threshold=args.flush_threshold,
+                        options=options)
+      for filepath in args.filepaths:
+        AddToSearchPath(filepath)
+        with io.open(filepath, 'r', encoding='utf-8') as src_file:
+          session.Run(src_file.read())
+      Repl(session, show_time=args.stats)
+      return
+    if args.jobs:
+      sys.exit(RunBatch(args.filepaths, args.jobs, sink=sink,
+                        show_stats=args.stats, options=options,
+                        limits=limits))
+    for filepath in args.filepaths:
       print('执行 %s ...' % (filepath,))
-      Run(src_file.read())
+      if args.connect:
+        status, error = RunFileOnServer(args.connect, filepath, sink=sink,
+                                        flush_threshold=args.flush_threshold,
+                                        options=options, limits=limits)
+        if status != 0:
+          sys.exit(error)
+        continue
+      if args.stream:
+        stats = RunStats()
+        RunFileStreaming(filepath, sink=sink,
+                         flush_threshold=args.flush_threshold, stats=stats,
+                         options=options, limits=limits)
+        print()
+        if args.stats:
+          print(stats)
+        continue
+      RunFile(filepath, sink=sink, flush_threshold=args.flush_threshold,
+              show_stats=args.stats, options=options, limits=limits)
       #input('运行成功，按任意键退出。')
+  except ResourceLimitExceeded as e:
+    sys.exit(str(e))
+  finally:
+    if sink is not None:
+      sink.close()
+
+if __name__ == '__main__':
+  Main(sys.argv)
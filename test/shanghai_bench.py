@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""shanghai语言执行器的性能测试
+
+用法：
+    python shanghai_bench.py run [-o 结果.json] [-r 次数] [-k 名字] [--instrument]
+    python shanghai_bench.py compare 老结果.json 新结果.json [-t 比例]
+
+run 把 demo/*.shanghai 同几只人造的程序一只一只分阶段（tokenize、parse、optimize、
+translate、compile、exec）跑几遍，再量一量分词同语法分析用掉多少内存，结果写成 JSON。compare 比较两只结果文件，
+有哪只阶段变慢了就报出来。
+
+run --instrument 量的是插了限制资源用的计数以后的速度。Python 3.11 上 exec 阶段 synthetic/hot_loop
+慢一成半左右，synthetic/recursive 慢七成左右（以前每趟套路调用要加减深度，慢两三倍）。
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+
+# Add the repo root to the Python module path.
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from src import shanghai
+
+DEMO_DIR = os.path.join(os.path.dirname(__file__), '..', 'demo')
+
+STAGES = ['tokenize', 'parse', 'optimize', 'translate', 'compile', 'exec']
+
+def StraightLineProgram(num_stmts=5000):
+  """A long program without any control flow."""
+  lines = ['阿德是则赤佬。阿德毛估估是0。']
+  for i in range(num_stmts):
+    if i % 10 == 9:
+      lines.append('嘎讪胡：“第%d行：”、阿德。' % (i,))
+    else:
+      lines.append('阿德毛估估是阿德加%d。' % (i,))
+  return '\n'.join(lines)
+
+def DeepNestingProgram(depth=40):
+  """Conditionals nested depth levels deep."""
+  return ('阿德是则赤佬。阿德毛估估是100。\n' +
+          '轧苗头：阿德比%d老卵？要来赛就一道组特：\n' * depth % tuple(
+              range(depth)) +
+          '嘎讪胡：阿德。\n' +
+          '组好了。\n' * depth)
+
+def HotLoopProgram(num_iterations=1000000):
+  """A loop doing a little arithmetic and branching many times."""
+  return ('阿庆是则赤佬。阿庆毛估估是0。\n'
+          '阿德从1到%d搞七捻三：\n'
+          '  轧苗头：阿德除以得毕挺3乘3帮阿德一色一样？\n'
+          '  要来赛就阿庆扎两趟。\n'
+          '  勿来赛就阿庆混腔势。\n'
+          '搞好了。\n'
+          '嘎讪胡：阿庆。\n' % (num_iterations,))
+
+def RecursiveProgram(n=25):
+  """A doubly recursive 套路."""
+  return ('【斐波那契】（阿庆）哪能组：\n'
+          '  轧苗头：阿庆比2推板？要来赛就再会阿庆。\n'
+          '  再会白相【斐波那契】（阿庆减1）加白相【斐波那契】（阿庆减2）。\n'
+          '组好了。\n'
+          '嘎讪胡：白相【斐波那契】（%d）。\n' % (n,))
+
+SYNTHETIC_PROGRAMS = [
+    ('synthetic/straight_line', StraightLineProgram),
+    ('synthetic/deep_nesting', DeepNestingProgram),
+    ('synthetic/hot_loop', HotLoopProgram),
+    ('synthetic/recursive', RecursiveProgram),
+    ]
+
+def GetWorkloads(name_filter=None):
+  """Returns a list of (name, source code), demos first."""
+  workloads = []
+  for filepath in sorted(glob.glob(os.path.join(DEMO_DIR, '*.shanghai'))):
+    with open(filepath, 'r', encoding='utf-8') as src_file:
+      workloads.append(('demo/' + os.path.basename(filepath),
+                        src_file.read()))
+  for name, make_program in SYNTHETIC_PROGRAMS:
+    workloads.append((name, make_program()))
+  if name_filter is not None:
+    workloads = [(name, code) for name, code in workloads
+                 if re.search(name_filter, name)]
+  return workloads
+
+def TimeStages(code, options=None):
+  """Runs code through all stages once.  Returns {stage: seconds}."""
+  stats = shanghai.RunStats()
+  _, code_object = shanghai.CompileToPython(code, stats, options)
+  shanghai.ExecutePython(code_object, io.StringIO(), stats=stats)
+  return stats.wall_seconds
+
+def MeasureMemory(code):
+  """Tokenizes and parses code once, tracing memory allocations.
+
+  Returns the most memory in use at any time, and the memory and number of
+  blocks still used by the tokens and statements at the end, in a dict.
+  """
+  tracemalloc.start()
+  try:
+    tokens = list(shanghai.Tokenize(code))
+    statements, _ = shanghai.ParseStmts(shanghai.TokenStream(tokens))
+    retained_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+  finally:
+    tracemalloc.stop()
+  return {
+      'num_tokens': len(tokens),
+      'num_statements': len(statements),
+      'peak_bytes': peak_bytes,
+      'retained_bytes': retained_bytes,
+      'retained_blocks': sum(stat.count
+                             for stat in snapshot.statistics('filename')),
+      }
+
+def Summarize(samples):
+  return {
+      'samples': samples,
+      'min': min(samples),
+      'max': max(samples),
+      'mean': statistics.mean(samples),
+      'median': statistics.median(samples),
+      'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+      }
+
+def RunBenchmarks(workloads, repeat, warmup=1, log=None, options=None):
+  """Times each workload repeat times after warmup runs, compiled with
+  options.
+
+  Returns the results as a JSON-serializable dict.
+  """
+  benchmarks = {}
+  for name, code in workloads:
+    for _ in range(warmup):
+      TimeStages(code, options)
+    samples = {stage: [] for stage in STAGES}
+    for _ in range(repeat):
+      for stage, seconds in TimeStages(code, options).items():
+        samples[stage].append(seconds)
+    benchmarks[name] = {stage: Summarize(samples[stage]) for stage in STAGES}
+    memory = MeasureMemory(code)
+    benchmarks[name]['memory'] = memory
+    if log is not None:
+      log.write('%-32s %s  memory %8.1f KiB\n' % (name, '  '.join(
+          '%s %8.4f' % (stage, benchmarks[name][stage]['median'])
+          for stage in STAGES), memory['retained_bytes'] / 1024))
+      log.flush()
+  fingerprint = shanghai.GetTranslatorFingerprint()
+  return {
+      'python': platform.python_version(),
+      'implementation': platform.python_implementation(),
+      'platform': platform.platform(),
+      'translator': fingerprint.hex() if fingerprint else None,
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+      'repeat': repeat,
+      'warmup': warmup,
+      'options': vars(options) if options is not None else None,
+      'benchmarks': benchmarks,
+      }
+
+def Compare(old, new, threshold):
+  """Compares the medians of two results.
+
+  Returns a list of (name, stage, old median, new median, flag), where flag
+  is '变慢' if the stage got slower than threshold (a ratio) and every new
+  sample is slower than every old one, '变快' for the opposite, or ''.
+  """
+  rows = []
+  for name, old_stages in old['benchmarks'].items():
+    new_stages = new['benchmarks'].get(name)
+    if new_stages is None:
+      continue
+    for stage in STAGES:
+      if stage not in old_stages or stage not in new_stages:
+        continue
+      old_stats = old_stages[stage]
+      new_stats = new_stages[stage]
+      flag = ''
+      if (new_stats['median'] > old_stats['median'] * (1 + threshold) and
+          new_stats['min'] > old_stats['max']):
+        flag = '变慢'
+      elif (new_stats['median'] * (1 + threshold) < old_stats['median'] and
+            new_stats['max'] < old_stats['min']):
+        flag = '变快'
+      rows.append((name, stage, old_stats['median'], new_stats['median'],
+                   flag))
+  return rows
+
+def Main(argv):
+  parser = argparse.ArgumentParser(
+      prog=os.path.basename(argv[0]),
+      description='分阶段测 shanghai 程序跑得多快。')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  run_parser = subparsers.add_parser('run', help='跑性能测试')
+  run_parser.add_argument('-o', '--output', metavar='结果.json',
+                          help='结果写到这只文件里（默认写到屏幕上）')
+  run_parser.add_argument('-r', '--repeat', type=int, default=5,
+                          metavar='次数',
+                          help='每只程序跑几遍（默认 %(default)s）')
+  run_parser.add_argument('-w', '--warmup', type=int, default=1,
+                          metavar='次数',
+                          help='正式计时前先空跑几遍（默认 %(default)s）')
+  run_parser.add_argument('-k', '--filter', metavar='正则表达式',
+                          help='只跑名字对得上的程序')
+  run_parser.add_argument('--instrument', action='store_true',
+                          help='翻译的辰光插进限制资源用的计数，量量伊拉慢多少')
+
+  compare_parser = subparsers.add_parser('compare', help='比较两只结果文件')
+  compare_parser.add_argument('old', metavar='老结果.json')
+  compare_parser.add_argument('new', metavar='新结果.json')
+  compare_parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                              metavar='比例',
+                              help='慢了超过介许多才算变慢（默认 %(default)s）')
+  args = parser.parse_args(argv[1:])
+
+  if args.command == 'run':
+    options = (shanghai.CompileOptions(instrument=True) if args.instrument
+               else None)
+    results = RunBenchmarks(GetWorkloads(args.filter), args.repeat,
+                            warmup=args.warmup, log=sys.stderr,
+                            options=options)
+    if args.output:
+      with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, ensure_ascii=False, indent=2)
+    else:
+      json.dump(results, sys.stdout, ensure_ascii=False, indent=2)
+      print()
+    return 0
+
+  with open(args.old, 'r', encoding='utf-8') as old_file:
+    old = json.load(old_file)
+  with open(args.new, 'r', encoding='utf-8') as new_file:
+    new = json.load(new_file)
+  rows = Compare(old, new, args.threshold)
+  for name, stage, old_median, new_median, flag in rows:
+    print('%-32s %-9s %10.4f -> %10.4f 秒  %+7.1f%%  %s' % (
+        name, stage, old_median, new_median,
+        (new_median / old_median - 1) * 100 if old_median else 0.0, flag))
+  num_regressions = sum(1 for row in rows if row[4] == '变慢')
+  print('%d 只阶段变慢了。' % (num_regressions,))
+  return 1 if num_regressions else 0
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv))
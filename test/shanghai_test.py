@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import math
 import os
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from unittest import mock
 
 # Add the repo root to the Python module path.
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
@@ -24,7 +35,6 @@ from src.shanghai import ParseExprFromStr
 from src.shanghai import ParseInteger
 from src.shanghai import ParseStmtFromStr
 from src.shanghai import ParseToAst
-from src.shanghai import Run
 from src.shanghai import STMT_ASSIGN
 from src.shanghai import STMT_CALL
 from src.shanghai import STMT_CONDITIONAL
@@ -35,6 +45,7 @@ from src.shanghai import STMT_LOOP
 from src.shanghai import STMT_SAY
 from src.shanghai import Statement
 from src.shanghai import StringLiteralExpr
+from src.shanghai import SymbolTable
 from src.shanghai import TK_CHAR
 from src.shanghai import TK_IDENTIFIER
 from src.shanghai import TK_INTEGER_LITERAL
@@ -43,6 +54,36 @@ from src.shanghai import Token
 from src.shanghai import Tokenize
 from src.shanghai import VariableExpr
 
+import shanghai_bench
+
+def Run(code):
+  """Runs code and returns its output."""
+  return shanghai.Run(code, capture=True)
+
+def RunFile(filepath):
+  """Runs the source file and returns its output."""
+  return shanghai.RunFile(filepath, capture=True)
+
+class SourceFileTestCase(unittest.TestCase):
+  """A test case with a temporary directory to write source files in."""
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.dir.cleanup)
+
+  def WriteSource(self, name, code):
+    """Writes code to the file name in the directory.  Returns its path."""
+    path = os.path.join(self.dir.name, name)
+    with open(path, 'w', encoding='utf-8') as src_file:
+      src_file.write(code)
+    return path
+
+def Locations(statements):
+  """Returns (kind, line, column) of every statement in statements."""
+  return [(node.kind, node.line, node.column)
+          for node in shanghai.WalkAst(statements)
+          if isinstance(node, Statement)]
+
 class shanghaiParseExprTest(unittest.TestCase):
   def testParseInteger(self):
     self.assertEqual(ParseExprFromStr('5')[0],
@@ -190,6 +231,20 @@ class shanghaiParseExprTest(unittest.TestCase):
                          StringLiteralExpr('哈')
                      ]))
 
+  def testParseTrailingOperator(self):
+    # A trailing operator is left for the caller to consume.
+    expr, tokens = ParseExprFromStr('阿庆加')
+    self.assertEqual(expr, VariableExpr('阿庆'))
+    self.assertEqual(tokens.Peek(), Keyword('加'))
+    self.assertEqual(len(tokens), 1)
+    expr, tokens = ParseExprFromStr('阿庆乘二、')
+    self.assertEqual(expr,
+                     ArithmeticExpr(
+                         VariableExpr('阿庆'),
+                         Keyword('乘'),
+                         IntegerLiteralExpr(2)))
+    self.assertEqual(tokens.Peek(), Keyword('、'))
+
 class shanghaiParseStatementTest(unittest.TestCase):
   def testParseConditional(self):
     self.assertEqual(
@@ -206,6 +261,14 @@ class shanghaiParseStatementTest(unittest.TestCase):
                    None
                   )))
 
+  def testLocations(self):
+    statements = ParseToAst('嘎讪胡：1。\n'
+                            '轧苗头：1比2老卵？\n'
+                            ' 要来赛就嘎讪胡：2。  阿德是则赤佬。')
+    self.assertEqual(Locations(statements),
+                     [(STMT_SAY, 1, 0), (STMT_CONDITIONAL, 2, 0),
+                      (STMT_SAY, 3, 5), (shanghai.STMT_VAR_DECL, 3, 13)])
+
 class shanghaiTest(unittest.TestCase):
   def testRunEmptyProgram(self):
     self.assertEqual(Run(''), '')
@@ -315,6 +378,21 @@ class shanghaiTest(unittest.TestCase):
          Keyword('”'),
          Keyword('。')])
 
+  def testTokenizeLongProgram(self):
+    # Used to exceed the recursion limit.
+    tokens = list(Tokenize('嘎讪胡：“哈”、阿德。\n' * 3000))
+    self.assertEqual(len(tokens), 8 * 3000)
+    self.assertEqual(
+        tokens[-8:],
+        [Keyword('嘎讪胡'),
+         Keyword('：'),
+         Keyword('“'),
+         Token(TK_STRING_LITERAL, '哈'),
+         Keyword('”'),
+         Keyword('、'),
+         IdentifierToken('阿德'),
+         Keyword('。')])
+
   def testTokenizeArithmetic(self):
     self.assertEqual(
         list(Tokenize('250加13减二乘五除以九')),
@@ -329,6 +407,30 @@ class shanghaiTest(unittest.TestCase):
          Token(TK_INTEGER_LITERAL, 9),
         ])
 
+  def testTokenizeKeywordPrecedence(self):
+    self.assertEqual(
+        list(Tokenize('十除以得毕挺三')),
+        [Token(TK_INTEGER_LITERAL, 10),
+         Keyword('除以得毕挺'),
+         Token(TK_INTEGER_LITERAL, 3),
+        ])
+    self.assertEqual(
+        list(Tokenize('十除以得三')),
+        [Token(TK_INTEGER_LITERAL, 10),
+         Keyword('除以'),
+         IdentifierToken('得三'),
+        ])
+    self.assertEqual(
+        list(Tokenize('十除 以 # 注释\n 得毕\n挺三')),
+        [Token(TK_INTEGER_LITERAL, 10),
+         Keyword('除以得毕挺'),
+         Token(TK_INTEGER_LITERAL, 3),
+        ])
+    self.assertEqual(
+        list(Tokenize('阿庆混 腔势')),
+        [IdentifierToken('阿庆'),
+         Keyword('混腔势'),])
+
   def testTokenizeLoop(self):
     self.assertEqual(
         list(Tokenize('阿庆从1到9搞七捻三：搞好了。')),
@@ -400,6 +502,16 @@ class shanghaiTest(unittest.TestCase):
         [Keyword('白相'),
          IdentifierToken('写九九表'),])
 
+  def testParsingLongProgram(self):
+    statements = ParseToAst('阿德是则赤佬。阿德扎台型。\n' * 3000)
+    self.assertEqual(len(statements), 2 * 3000)
+    self.assertEqual(
+        statements[-1],
+        Statement(
+            STMT_INC_BY,
+            (IdentifierToken('阿德'),
+             IntegerLiteralExpr(1))))
+
   def testParsingIncrements(self):
     self.assertEqual(
         ParseToAst('阿庆扎台型。'),
@@ -616,6 +728,14 @@ class shanghaiTest(unittest.TestCase):
         Run('嘎讪胡：“阿庆”、665加一。'),
         '阿庆666\n')
 
+  def testStringLiteralWithPythonSpecialChars(self):
+    self.assertEqual(
+        Run('嘎讪胡：“伊讲"侬好"\\n”。'),
+        '伊讲"侬好"\\n\n')
+    self.assertEqual(
+        Run('阿庆毛估估是“a\nb\'”。嘎讪胡：阿庆、“"”。'),
+        'a\nb\'"\n')
+
   def testCompound(self):
     self.assertEqual(
         Run('一道组特：组好了。'),
@@ -731,5 +851,1280 @@ class shanghaiTest(unittest.TestCase):
       '''),
       'OK\n')
 
+class RecordingFile:
+  """A file-like object that records each write."""
+
+  def __init__(self):
+    self.writes = []
+
+  def write(self, s):
+    self.writes.append(s)
+
+class shanghaiOutputTest(unittest.TestCase):
+  def testOutputGoesToSink(self):
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+      self.assertIsNone(
+          shanghai.Run('嘎讪胡：1。嘎讪胡：2。', sink=sink))
+    self.assertEqual(sink.getvalue(), '1\n2\n')
+
+  def testOutputGoesToStdoutByDefault(self):
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      shanghai.Run('嘎讪胡：“申花老卵！”。')
+    self.assertIn('运行结果：\n申花老卵！\n', stdout.getvalue())
+
+  def testFlushThreshold(self):
+    sink = RecordingFile()
+    shanghai.Run('阿德从1到4搞七捻三：嘎讪胡：阿德。搞好了。',
+                 sink=sink, flush_threshold=4)
+    self.assertEqual(sink.writes, ['1\n2\n', '3\n4\n'])
+
+    sink = RecordingFile()
+    shanghai.Run('阿德从1到4搞七捻三：嘎讪胡：阿德。搞好了。', sink=sink)
+    self.assertEqual(sink.writes, ['1\n2\n3\n4\n'])
+
+  def testOutputIsFlushedOnError(self):
+    sink = io.StringIO()
+    with self.assertRaises(ValueError):
+      shanghai.Run('嘎讪胡：1。白相 int（“x”）。', sink=sink)
+    self.assertEqual(sink.getvalue(), '1\n')
+
+class shanghaiTokenTest(unittest.TestCase):
+  def testKeywordTokensAreShared(self):
+    self.assertIs(Keyword('加'), Keyword('加'))
+    tokens = list(Tokenize('阿德是则赤佬。阿德毛估估是1加2加3。'))
+    pluses = [tk for tk in tokens if tk == Keyword('加')]
+    self.assertEqual(len(pluses), 2)
+    for tk in pluses:
+      self.assertIs(tk, Keyword('加'))
+
+  def testPositions(self):
+    tokens, positions = shanghai.TokenizeWithPositions('阿德 毛估估是1。')
+    self.assertEqual(tokens, list(shanghai.Tokenize('阿德 毛估估是1。')))
+    self.assertEqual(list(positions), [0, 3, 7, 8])
+
+  def testNodesHaveNoDict(self):
+    for node in (Token(shanghai.TK_IDENTIFIER, '阿德'),
+                 shanghai.Statement(shanghai.STMT_SAY, None),
+                 ParseExprFromStr('阿德加1、2')[0]):
+      self.assertFalse(hasattr(node, '__dict__'))
+
+class shanghaiSymbolTableTest(unittest.TestCase):
+  def testGeneratedNames(self):
+    symbols = SymbolTable()
+    self.assertEqual(symbols.GetPythonVarName('阿德'), '_db_var0')
+    self.assertEqual(symbols.GetPythonVarName('阿庆'), '_db_var1')
+    self.assertEqual(symbols.GetPythonVarName('阿德'), '_db_var0')
+    self.assertEqual(symbols.GetPythonVarName('re.match'), 're.match')
+    self.assertEqual(symbols.GetPythonVarName('_x'), '_x')
+    self.assertEqual(symbols.GetPythonVarName('1号'), '_db_var2')
+
+  def testCompilationIsDeterministic(self):
+    code = '阿德是则赤佬。阿庆毛估估是阿德。嘎讪胡：阿庆。'
+    py_code, _ = shanghai.CompileToPython(code)
+    shanghai.CompileToPython('张三毛估估是李四。')
+    self.assertEqual(shanghai.CompileToPython(code)[0], py_code)
+    self.assertEqual(
+        py_code,
+        '_db_var0 = None\n'
+        '_db_var1 = _db_var0\n'
+        '_db_append_output("%s\\n" % (_shanghai_str(_db_var1),))')
+
+class shanghaiNamespaceTest(unittest.TestCase):
+  def testProgramsDontShareVariables(self):
+    Run('阿德毛估估是250。')
+    with self.assertRaises(NameError):
+      Run('嘎讪胡：阿德。')
+
+  def testProgramsDontLeakIntoInterpreterGlobals(self):
+    Run('阿德毛估估是250。【加一】（那啥）哪能组：再会那啥加一。组好了。')
+    self.assertFalse(
+        [name for name in vars(shanghai) if name.startswith('_db_var')])
+
+  def testConcurrentRuns(self):
+    code = '''
+【阶乘】（那啥）哪能组：
+  轧苗头：那啥比一推板？
+  要来赛就再会一。
+  再会那啥乘白相【阶乘】（那啥减一）。
+组好了。
+阿德从1到200搞七捻三：嘎讪胡：“%s”、白相【阶乘】（%d）。搞好了。
+'''
+    def RunQuietly(i):
+      sink = io.StringIO()
+      shanghai.Run(code % (i, i), sink=sink, flush_threshold=1)
+      return sink.getvalue()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+      with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        outputs = list(executor.map(RunQuietly, range(1, 17)))
+    for i, output in enumerate(outputs, 1):
+      self.assertEqual(output, ('%s%d\n' % (i, math.factorial(i))) * 200)
+
+class shanghaiIncrementalParseTest(unittest.TestCase):
+  CODE = ('阿德是则赤佬。阿德毛估估是1。\n'
+          '轧苗头：阿德比0老卵？要来赛就嘎讪胡：“大。”。\n'
+          '勿来赛就嘎讪胡：“小！”。  # 勿是句号。\n'
+          '【加加】（阿庆）哪能组：\n'
+          '  再会阿庆加1。\n'
+          '组好了。\n'
+          '嘎讪胡：白相【加加】（阿德）。\n')
+
+  def AssertReparses(self, parsed, start, end, new_text):
+    new_parsed = shanghai.ReparseIncremental(parsed, start, end, new_text)
+    full_parsed = shanghai.ParseSource(new_parsed.code)
+    self.assertEqual(new_parsed.code,
+                     parsed.code[:start] + new_text + parsed.code[end:])
+    self.assertEqual(new_parsed.statements, ParseToAst(new_parsed.code))
+    self.assertEqual(new_parsed.tokens, full_parsed.tokens)
+    self.assertEqual(new_parsed.char_ends, full_parsed.char_ends)
+    self.assertEqual(new_parsed.token_ends, full_parsed.token_ends)
+    self.assertEqual(list(new_parsed.positions), list(full_parsed.positions))
+    self.assertEqual(Locations(new_parsed.statements),
+                     Locations(full_parsed.statements))
+    return new_parsed
+
+  def testSentenceEnds(self):
+    self.assertEqual(
+        list(shanghai.FindSentenceEnds('甲。“乙。”丙！#丁。\n【戊。】。  ')),
+        [2, 8, 17, 19])
+
+  def testParseSource(self):
+    parsed = shanghai.ParseSource(self.CODE)
+    self.assertEqual(parsed.statements, ParseToAst(self.CODE))
+    self.assertEqual(parsed.char_ends[-1], len(self.CODE) - 1)
+    self.assertEqual(parsed.token_ends[-1], len(parsed.tokens))
+
+  def testMalformedCode(self):
+    bad = '轧苗头：阿德比0老卵？要来赛就1。'
+    parsed = shanghai.ParseSource(self.CODE)
+    for code, parse in (
+        (bad, shanghai.ParseSource),
+        (bad + self.CODE,
+         lambda code: shanghai.ReparseIncremental(parsed, 0, 0, bad)),
+        ):
+      with self.assertRaises(AssertionError) as expected:
+        ParseToAst(code)
+      with self.assertRaises(AssertionError) as actual:
+        parse(code)
+      self.assertEqual(str(actual.exception), str(expected.exception))
+
+  def testReusesUnchangedStatements(self):
+    parsed = shanghai.ParseSource(self.CODE)
+    pos = self.CODE.index('1。')
+    new_parsed = self.AssertReparses(parsed, pos, pos + 1, '100')
+    # Only the edited statement and the one before it are parsed again.
+    for old, new in zip(parsed.statements[2:], new_parsed.statements[2:]):
+      self.assertIs(old, new)
+
+  def testEdits(self):
+    parsed = shanghai.ParseSource(self.CODE)
+    else_pos = self.CODE.index('勿来赛就')
+    func_pos = self.CODE.index('【加加】')
+    end_pos = self.CODE.index('组好了')
+    for start, end, new_text in (
+        (0, 0, '阿三是则赤佬。'),  # At the start.
+        (len(self.CODE), len(self.CODE), '嘎讪胡：1。'),  # At the end.
+        (else_pos, func_pos, ''),  # Removes the 勿来赛就.
+        (func_pos - 1, func_pos - 1, '勿来赛就嘎讪胡：2。'),  # Dangling.
+        (func_pos, end_pos + 4, ''),  # Removes a whole statement.
+        (end_pos, end_pos, '嘎讪胡：“组好了。”。'),  # In a 套路.
+        (0, 0, '\n  \n'),  # Moves everything down.
+        ):
+      self.AssertReparses(parsed, start, end, new_text)
+
+  def testEditChangingLaterTokens(self):
+    code = '嘎讪胡：1。嘎讪胡：2。嘎讪胡：“3。”。'
+    parsed = shanghai.ParseSource(code)
+    # Opening a string literal makes the rest of the code part of it.
+    new_parsed = self.AssertReparses(parsed, 6, 10, '嘎讪胡：“')
+    self.assertEqual(len(new_parsed.statements), 2)
+    # Moving the start of a block.
+    parsed = shanghai.ParseSource('嘎讪胡：1。一道组特：嘎讪胡：2。组好了。')
+    self.assertEqual(len(parsed.statements), 2)
+    new_parsed = self.AssertReparses(parsed, 0, 11, '一道组特：嘎讪胡：1。')
+    self.assertEqual(len(new_parsed.statements), 1)
+
+class shanghaiOptimizeTest(unittest.TestCase):
+  def Optimize(self, expr_str):
+    return shanghai.OptimizeExpr(ParseExprFromStr(expr_str)[0])
+
+  def OptimizeProgram(self, code):
+    return shanghai.OptimizeStatements(ParseToAst(code))
+
+  def testFoldArithmetic(self):
+    self.assertEqual(self.Optimize('1加2乘3'), IntegerLiteralExpr(7))
+    self.assertEqual(self.Optimize('（五减（四减三））乘二'),
+                     IntegerLiteralExpr(8))
+    self.assertEqual(self.Optimize('阿庆加（1加2）'),
+                     ArithmeticExpr(VariableExpr('阿庆'), Keyword('加'),
+                                    IntegerLiteralExpr(3)))
+
+  def testLeavesRunTimeBehaviorAlone(self):
+    for expr_str in ['1除以2', '1除以得毕挺0', '“a”加1', '“ab”乘100000',
+                     '“a”比1老卵']:
+      self.assertNotIsInstance(self.Optimize(expr_str), LiteralExpr)
+
+  def testFoldConcat(self):
+    self.assertEqual(self.Optimize('“a”、1加1、阿庆、2、“b”'),
+                     ConcatExpr([StringLiteralExpr('a2'),
+                                 VariableExpr('阿庆'),
+                                 StringLiteralExpr('2b')]))
+    self.assertEqual(self.Optimize('“是”、1比2推板'),
+                     StringLiteralExpr('是对额'))
+
+  def testFoldComparison(self):
+    self.assertEqual(self.Optimize('1比2老卵'),
+                     LiteralExpr(Token(shanghai.TK_BOOL_LITERAL, False)))
+    self.assertEqual(Run('嘎讪胡：1比2推板。嘎讪胡：1脑子瓦特了。'),
+                     '对额\n勿对\n')
+
+  def testPruneConditional(self):
+    self.assertEqual(
+        self.OptimizeProgram(
+            '轧苗头：1帮1一色一样？要来赛就嘎讪胡：1。勿来赛就嘎讪胡：2。'),
+        [Statement(STMT_SAY, IntegerLiteralExpr(1))])
+    self.assertEqual(
+        self.OptimizeProgram('轧苗头：1帮2一色一样？要来赛就嘎讪胡：1。'),
+        [])
+    self.assertEqual(
+        self.OptimizeProgram(
+            '轧苗头：阿庆？要来赛就一道组特：组好了。勿来赛就一道组特：组好了。'),
+        [Statement(STMT_CONDITIONAL, (VariableExpr('阿庆'),
+                                      Statement(shanghai.STMT_COMPOUND, []),
+                                      None))])
+
+  def testDropEmptyCompound(self):
+    self.assertEqual(
+        self.OptimizeProgram(
+            '一道组特：一道组特：组好了。组好了。嘎讪胡：1。'),
+        [Statement(STMT_SAY, IntegerLiteralExpr(1))])
+    self.assertEqual(
+        Run('【套路】哪能组：一道组特：组好了。组好了。白相【套路】。'), '')
+
+  def testDemoOutputUnchanged(self):
+    demo_dir = os.path.join(os.path.dirname(__file__), '..', 'demo')
+    for filename in sorted(os.listdir(demo_dir)):
+      if not filename.endswith('.shanghai'):
+        continue
+      with open(os.path.join(demo_dir, filename), encoding='utf-8') as f:
+        code = f.read()
+      outputs = []
+      for optimize in (True, False):
+        options = shanghai.CompileOptions(optimize=optimize)
+        _, code_object = shanghai.CompileToPython(code, options=options)
+        sink = io.StringIO()
+        shanghai.ExecutePython(code_object, sink)
+        outputs.append(sink.getvalue())
+      self.assertEqual(outputs[0], outputs[1], filename)
+
+  def testOptionsArePartOfCacheKey(self):
+    self.assertNotEqual(
+        shanghai.GetCacheKey('嘎讪胡：1。'),
+        shanghai.GetCacheKey('嘎讪胡：1。',
+                             shanghai.CompileOptions(optimize=False)))
+
+class shanghaiMemoizeTest(unittest.TestCase):
+  FIB = ('【斐波那契】（阿庆）哪能组：\n'
+         '  轧苗头：阿庆比2推板？要来赛就再会阿庆。\n'
+         '  再会白相【斐波那契】（阿庆减1）加白相【斐波那契】（阿庆减2）。\n'
+         '组好了。\n')
+
+  def FindPure(self, code):
+    return shanghai.FindPureFunctions(ParseToAst(code))
+
+  def testPureFunctions(self):
+    self.assertEqual(self.FindPure(self.FIB), {'斐波那契'})
+    self.assertEqual(self.FindPure(
+        '【阿德】（阿庆）哪能组：\n'
+        '  阿三是则赤佬。阿三毛估估是阿庆乘阿庆。\n'
+        '  阿三从1到阿庆搞七捻三：阿三扎两趟。搞好了。\n'
+        '  再会白相【abs】（阿三）。\n'
+        '组好了。\n'), {'阿德'})
+
+  def testImpureFunctions(self):
+    # 嘎讪胡 is a side effect.
+    self.assertEqual(self.FindPure(
+        '【阿德】（阿庆）哪能组：嘎讪胡：阿庆。再会阿庆。组好了。'), set())
+    # Reads a global.
+    self.assertEqual(self.FindPure(
+        '阿三是则赤佬。阿三毛估估是1。\n'
+        '【阿德】（阿庆）哪能组：再会阿庆加阿三。组好了。'), set())
+    # Calls an impure 套路.
+    self.assertEqual(self.FindPure(
+        '【阿三】哪能组：嘎讪胡：1。组好了。\n'
+        '【阿德】（阿庆）哪能组：白相【阿三】。再会阿庆。组好了。'), set())
+    # Redefined, so calls may go to different 套路.
+    self.assertEqual(self.FindPure(
+        '【阿德】（阿庆）哪能组：再会阿庆。组好了。\n'
+        '轧苗头：1比2推板？要来赛就一道组特：\n'
+        '  【阿德】（阿庆）哪能组：再会1。组好了。\n'
+        '组好了。'), set())
+    # Calls a Python function that isn't known to be pure.
+    self.assertEqual(self.FindPure(
+        '【阿德】（阿庆）哪能组：再会白相【print】（阿庆）。组好了。'), set())
+
+  def testMemoize(self):
+    code = self.FIB + '嘎讪胡：白相【斐波那契】（100）。'
+    options = shanghai.CompileOptions(memoize=True)
+    py_code, _ = shanghai.CompileToPython(code, options=options)
+    self.assertIn('@_shanghai_memoize(%d)' % (shanghai.DEFAULT_MEMOIZE_SIZE,),
+                  py_code)
+    self.assertEqual(shanghai.Run(code, capture=True, options=options),
+                     '354224848179261915075\n')
+
+  def testMemoizeIncludeAndExclude(self):
+    code = (self.FIB +
+            '【阿德】（阿庆）哪能组：再会阿庆加1。组好了。\n'
+            '嘎讪胡：白相【斐波那契】（10）、白相【阿德】（1）。')
+    statements = ParseToAst(code)
+    self.assertEqual(shanghai.FindMemoizedFunctions(
+        statements, shanghai.CompileOptions()), set())
+    self.assertEqual(shanghai.FindMemoizedFunctions(
+        statements, shanghai.CompileOptions(memoize=True)),
+                     {'斐波那契', '阿德'})
+    self.assertEqual(shanghai.FindMemoizedFunctions(
+        statements, shanghai.CompileOptions(memoize_include=['阿德'])),
+                     {'阿德'})
+    self.assertEqual(shanghai.FindMemoizedFunctions(
+        statements, shanghai.CompileOptions(
+            memoize=True, memoize_exclude=['斐波那契'])),
+                     {'阿德'})
+    for options in (shanghai.CompileOptions(),
+                    shanghai.CompileOptions(memoize=True),
+                    shanghai.CompileOptions(memoize_include=['阿德'])):
+      self.assertEqual(shanghai.Run(code, capture=True, options=options),
+                       '552\n')
+
+  def testMemoizeSizeBound(self):
+    calls = []
+    @shanghai._shanghai_memoize(2)
+    def Square(x):
+      calls.append(x)
+      return x * x
+    for x in (1, 2, 1, 3, 1, 2):
+      Square(x)
+    self.assertEqual(calls, [1, 2, 3, 2])
+    self.assertEqual(Square.cache_info().currsize, 2)
+
+  def testUnhashableArgumentsAreNotMemoized(self):
+    calls = []
+    @shanghai._shanghai_memoize(8)
+    def Length(x):
+      calls.append(x)
+      return len(x)
+    self.assertEqual(Length([1, 2]), 2)
+    self.assertEqual(Length([1, 2]), 2)
+    self.assertEqual(len(calls), 2)
+
+  def testMemoizeOptionsArePartOfCacheKey(self):
+    self.assertNotEqual(
+        shanghai.GetCacheKey('嘎讪胡：1。'),
+        shanghai.GetCacheKey('嘎讪胡：1。',
+                             shanghai.CompileOptions(memoize=True)))
+
+class shanghaiTailCallTest(unittest.TestCase):
+  SUM = ('【加加】（阿庆，阿三）哪能组：\n'
+         '  轧苗头：阿庆比0推板？要来赛就再会阿三。\n'
+         '  勿来赛就一道组特：\n'
+         '    再会白相【加加】（阿庆减1，阿三加阿庆）。\n'
+         '  组好了。\n'
+         '组好了。\n')
+
+  def testDeepTailRecursion(self):
+    code = self.SUM + '嘎讪胡：白相【加加】（100000，0）。'
+    py_code, _ = shanghai.CompileToPython(code)
+    self.assertIn('while True:', py_code)
+    self.assertIn('continue', py_code)
+    # Every pass ends with 再会, so the loop can't be left at the bottom.
+    self.assertNotIn('return None', py_code)
+    self.assertEqual(shanghai.Run(code, capture=True), '5000050000\n')
+
+  def testFallingOffTheEnd(self):
+    code = ('【阿德】（阿庆）哪能组：\n'
+            '  轧苗头：阿庆比0老卵？要来赛就再会白相【阿德】（阿庆减1）。\n'
+            '组好了。\n'
+            '嘎讪胡：白相【阿德】（3）。')
+    py_code, _ = shanghai.CompileToPython(code)
+    self.assertIn('return None', py_code)
+    self.assertEqual(shanghai.Run(code, capture=True), '脑子瓦特了\n')
+
+  def testArgumentsAreEvaluatedBeforeRebinding(self):
+    code = ('【调】（阿庆，阿三，次数）哪能组：\n'
+            '  轧苗头：次数比0推板？要来赛就再会阿庆乘10加阿三。\n'
+            '  再会白相【调】（阿三，阿庆，次数减1）。\n'
+            '组好了。\n'
+            '嘎讪胡：白相【调】（1，2，2）。')
+    self.assertEqual(shanghai.Run(code, capture=True), '21\n')
+
+  def testNoTailCallElimination(self):
+    def HasLoop(code, options=None):
+      statements = ParseToAst(code)
+      return shanghai.EliminateTailCalls(statements) != statements
+
+    self.assertTrue(HasLoop(self.SUM))
+    # Not a tail call.
+    self.assertFalse(HasLoop(
+        '【阶乘】（阿庆）哪能组：\n'
+        '  轧苗头：阿庆比1推板？要来赛就再会1。\n'
+        '  再会阿庆乘白相【阶乘】（阿庆减1）。\n'
+        '组好了。'))
+    # Inside a 搞七捻三.
+    self.assertFalse(HasLoop(
+        '【阿德】（阿庆）哪能组：\n'
+        '  阿三从1到2搞七捻三：再会白相【阿德】（阿三）。搞好了。\n'
+        '组好了。'))
+    # 阿德 may be another 套路 by the time it's called.
+    self.assertFalse(HasLoop(
+        '【阿德】（阿庆）哪能组：再会白相【阿德】（阿庆）。组好了。\n'
+        '阿德是则赤佬。'))
+    # 阿三 would still have its value from the pass before.
+    code = ('【阿德】（阿庆）哪能组：\n'
+            '  轧苗头：阿庆帮2一色一样？要来赛就再会阿三。\n'
+            '  阿三是则赤佬。阿三毛估估是阿庆。\n'
+            '  再会白相【阿德】（阿庆减1）。\n'
+            '组好了。')
+    self.assertFalse(HasLoop(code))
+    with self.assertRaises(UnboundLocalError):
+      shanghai.Run(code + '嘎讪胡：白相【阿德】（5）。', capture=True)
+    # Assigned before it's read.
+    self.assertTrue(HasLoop(
+        '【阿德】（阿庆）哪能组：\n'
+        '  阿三是则赤佬。阿三毛估估是阿庆减1。\n'
+        '  轧苗头：阿三比0推板？要来赛就再会阿三。\n'
+        '  再会白相【阿德】（阿三）。\n'
+        '组好了。'))
+
+  def testNoOptimizeKeepsRecursion(self):
+    py_code, _ = shanghai.CompileToPython(
+        self.SUM, options=shanghai.CompileOptions(optimize=False))
+    self.assertNotIn('while True:', py_code)
+
+class shanghaiAffineLoopTest(unittest.TestCase):
+  def IsAffine(self, code):
+    statement = shanghai.OptimizeStatements(ParseToAst(code))[-1]
+    return statement.kind == shanghai.STMT_AFFINE_LOOP
+
+  def AssertSameOutput(self, code):
+    """Asserts that code gives the same output with and without closed-form
+    summing."""
+    self.assertEqual(
+        shanghai.Run(code, capture=True),
+        shanghai.Run(code, capture=True,
+                     options=shanghai.CompileOptions(optimize=False)))
+
+  def testAffineLoops(self):
+    self.assertTrue(self.IsAffine(
+        '阿德从1到10搞七捻三：阿三扎阿德趟。搞好了。'))
+    self.assertTrue(self.IsAffine(
+        '阿德从1到10搞七捻三：\n'
+        '  阿三扎（阿德加1）乘阿五减2趟。阿四混阿五除以2趟。\n'
+        '搞好了。'))
+    # Quadratic.
+    self.assertFalse(self.IsAffine(
+        '阿德从1到10搞七捻三：阿三扎阿德乘阿德趟。搞好了。'))
+    # Depends on another accumulator.
+    self.assertFalse(self.IsAffine(
+        '阿德从1到10搞七捻三：阿三扎阿四趟。阿四扎1趟。搞好了。'))
+    # Does something else too.
+    self.assertFalse(self.IsAffine(
+        '阿德从1到10搞七捻三：阿三扎阿德趟。嘎讪胡：阿三。搞好了。'))
+    self.assertFalse(self.IsAffine(
+        '阿德从1到10搞七捻三：阿三扎白相【阿五】（阿德）趟。搞好了。'))
+    # Changes the loop variable.
+    self.assertFalse(self.IsAffine(
+        '阿德从1到10搞七捻三：阿德扎1趟。搞好了。'))
+
+  def testClosedFormGivesSameOutput(self):
+    decls = ('阿三是则赤佬。阿三毛估估是0。阿四是则赤佬。阿四毛估估是5。'
+             '阿五是则赤佬。阿五毛估估是%s。阿德是则赤佬。阿德毛估估是%s。\n')
+    loop = ('阿德从%s到%s搞七捻三：\n'
+            '  阿三扎（阿德加1）乘阿五减2趟。阿四混阿德趟。阿三混阿德趟。\n'
+            '搞好了。\n'
+            '嘎讪胡：阿三、“ ”、阿四、“ ”、阿德。')
+    for factor, start, end in (('7', '1', '100'), ('7', '0减5', '5'),
+                               ('7', '3', '2'), ('3除以2', '1', '10')):
+      self.AssertSameOutput(decls % (factor, '“勿搭界”') +
+                            loop % (start, end))
+
+  def testFallbackReportsSameError(self):
+    code = ('阿三是则赤佬。阿三毛估估是“侬好”。\n'
+            '阿德从1到10搞七捻三：阿三扎阿德趟。搞好了。')
+    with self.assertRaises(TypeError):
+      shanghai.Run(code, capture=True)
+
+  def testHugeLoopInFunction(self):
+    code = ('【加加】（阿庆）哪能组：\n'
+            '  阿三是则赤佬。阿三毛估估是0。\n'
+            '  阿德从1到阿庆搞七捻三：阿三扎阿德趟。搞好了。\n'
+            '  再会阿三。\n'
+            '组好了。\n'
+            '嘎讪胡：白相【加加】（100000000）。')
+    self.assertEqual(shanghai.Run(code, capture=True), '5000000050000000\n')
+
+class shanghaiResourceLimitTest(unittest.TestCase):
+  RECURSIVE = ('【阿三】（阿庆）哪能组：\n'
+               '  轧苗头：阿庆比1推板？要来赛就再会0。\n'
+               '  再会白相【阿三】（阿庆减1）加1。\n'
+               '组好了。\n'
+               '嘎讪胡：白相【阿三】（50）。\n'
+               '嘎讪胡：白相【阿三】（50）。\n')
+
+  def RunLimited(self, code, **limits):
+    """Returns the output of code run with the limits, or the
+    ResourceLimitExceeded it was stopped with."""
+    sink = io.StringIO()
+    _, code_object = shanghai.CompileToPython(
+        code, options=shanghai.CompileOptions(instrument=True))
+    try:
+      shanghai.ExecutePython(code_object, sink,
+                             limits=shanghai.ResourceLimits(**limits))
+    except shanghai.ResourceLimitExceeded as e:
+      return e
+    return sink.getvalue()
+
+  def assertExceeds(self, resource, code, **limits):
+    error = self.RunLimited(code, **limits)
+    self.assertIsInstance(error, shanghai.ResourceLimitExceeded)
+    self.assertEqual(error.resource, resource)
+
+  def testOnlyInstrumentedWhenAsked(self):
+    code = '阿德从1到3搞七捻三：嘎讪胡：阿德。搞好了。'
+    self.assertNotIn('_db_fuel', shanghai.CompileToPython(code)[0])
+    py_code, _ = shanghai.CompileToPython(
+        code, options=shanghai.CompileOptions(instrument=True))
+    # Loops take their steps without a call into Python.
+    self.assertIn('zip(range(1, 3 + 1), _db_fuel)', py_code)
+    self.assertNotIn('next(_db_fuel)', py_code)
+    # Run() instruments the code itself when given limits.
+    with self.assertRaises(shanghai.ResourceLimitExceeded):
+      shanghai.Run(code, capture=True,
+                   limits=shanghai.ResourceLimits(max_steps=2))
+
+  def testMaxSteps(self):
+    code = ('阿德是则赤佬。阿庆从1到%d搞七捻三：阿德毛估估是阿庆。搞好了。'
+            '嘎讪胡：阿德。')
+    self.assertEqual(self.RunLimited(code % (1000,), max_steps=1000),
+                     '1000\n')
+    self.assertExceeds('max_steps', code % (1001,), max_steps=1000)
+    # Self tail calls become loops, which are counted too.
+    self.assertExceeds(
+        'max_steps',
+        '【阿三】（阿庆）哪能组：再会白相【阿三】（阿庆加1）。组好了。'
+        '白相【阿三】（1）。', max_steps=10000)
+
+  def testAffineLoopDoesNotGoRound(self):
+    self.assertEqual(self.RunLimited(
+        '阿三是则赤佬。阿三毛估估是0。'
+        '阿德从1到1000000000000搞七捻三：阿三扎阿德趟。搞好了。'
+        '嘎讪胡：阿三。', max_steps=10), '500000000000500000000000\n')
+
+  def testMaxCallDepth(self):
+    # 白相【阿三】（50） goes 51 deep, and returning makes room again.
+    self.assertEqual(self.RunLimited(self.RECURSIVE, max_call_depth=51),
+                     '50\n50\n')
+    self.assertExceeds('max_call_depth', self.RECURSIVE, max_call_depth=50)
+
+  def testTime(self):
+    code = '阿德是则赤佬。阿庆从1到1000000000搞七捻三：阿德毛估估是阿庆。搞好了。'
+    self.assertExceeds('wall_seconds', code, wall_seconds=0.05)
+    self.assertExceeds('cpu_seconds', code, cpu_seconds=0.05)
+
+  def testMaxMemory(self):
+    self.assertExceeds(
+        'max_memory',
+        '阿德是则赤佬。阿德毛估估是“对”。'
+        '阿庆从1到100搞七捻三：阿德毛估估是阿德、阿德。搞好了。',
+        max_memory=1 << 20)
+    self.assertFalse(tracemalloc.is_tracing())
+
+  def testDisplayedCodeRunsTheSame(self):
+    py_code, _ = shanghai.CompileToPython(
+        self.RECURSIVE, options=shanghai.CompileOptions(instrument=True))
+    output = shanghai.OutputSink(io.StringIO(), 1)
+    governor = shanghai.ResourceGovernor(
+        shanghai.ResourceLimits(max_call_depth=50))
+    namespace = shanghai.NewRuntimeNamespace(output, governor)
+    with self.assertRaises(shanghai.ResourceLimitExceeded):
+      exec(compile(str(py_code), '<string>', 'exec'), namespace, namespace)
+    # The 51st call didn't get to take its step.
+    self.assertEqual(governor.GetSteps(), 50)
+
+  def testKeepsStopping(self):
+    _, code_object = shanghai.CompileToPython(
+        '阿德从1到100搞七捻三：搞好了。',
+        options=shanghai.CompileOptions(instrument=True))
+    governor = shanghai.ResourceGovernor(
+        shanghai.ResourceLimits(max_steps=10))
+    namespace = shanghai.NewRuntimeNamespace(
+        shanghai.OutputSink(io.StringIO(), 1), governor)
+    governor.Start()
+    for _ in range(3):
+      # Later steps, e.g. by code that caught the error, don't get through.
+      with self.assertRaises(shanghai.ResourceLimitExceeded) as stopped:
+        exec(code_object, namespace, namespace)
+      self.assertEqual(stopped.exception.resource, 'max_steps')
+      with self.assertRaises(shanghai.ResourceLimitExceeded):
+        next(namespace['_db_fuel'])
+    self.assertEqual(governor.GetSteps(), 10)
+
+  def testCancel(self):
+    _, code_object = shanghai.CompileToPython(
+        '阿德从1到100000000搞七捻三：搞好了。',
+        options=shanghai.CompileOptions(instrument=True))
+    governor = shanghai.ResourceGovernor(shanghai.NO_RESOURCE_LIMITS)
+    namespace = shanghai.NewRuntimeNamespace(
+        shanghai.OutputSink(io.StringIO(), 1), governor)
+    governor.Start()
+    timer = threading.Timer(0.05, governor.Cancel)
+    timer.start()
+    self.addCleanup(timer.cancel)
+    for _ in range(2):
+      with self.assertRaises(shanghai.RunCancelled):
+        exec(code_object, namespace, namespace)
+
+  def testBatchReportsLimit(self):
+    with tempfile.TemporaryDirectory() as dirname:
+      filepath = os.path.join(dirname, 'loop.shanghai')
+      with open(filepath, 'w', encoding='utf-8') as src_file:
+        src_file.write('嘎讪胡：1。阿德从1到100搞七捻三：嘎讪胡：阿德。搞好了。')
+      result = shanghai.RunFileForBatch(
+          filepath, limits=shanghai.ResourceLimits(max_steps=3))
+    self.assertEqual(result.output, '1\n1\n2\n3\n')
+    self.assertNotIn('Traceback', result.error)
+    self.assertIn('步数', result.error)
+
+class shanghaiStatsTest(unittest.TestCase):
+  def RunWithStats(self, code):
+    collected = []
+    with contextlib.redirect_stdout(io.StringIO()):
+      output = shanghai.Run(code, capture=True, on_stats=collected.append)
+    self.assertEqual(len(collected), 1)
+    return output, collected[0]
+
+  def testRunStats(self):
+    code = '阿德是则赤佬。阿德毛估估是1加2。嘎讪胡：“侬好”、阿德。'
+    output, stats = self.RunWithStats(code)
+    self.assertEqual(list(stats.wall_seconds),
+                     ['tokenize', 'parse', 'optimize', 'translate', 'compile',
+                      'exec'])
+    self.assertEqual(list(stats.cpu_seconds), list(stats.wall_seconds))
+    self.assertFalse(stats.cache_hit)
+    self.assertEqual(stats.num_tokens, len(list(Tokenize(code))))
+    # 3 statements, 1加2 folded to 3, ConcatExpr + 2 operands.
+    self.assertEqual(stats.num_ast_nodes, 7)
+    self.assertGreater(stats.py_code_size, 0)
+    self.assertEqual(stats.output_bytes, len(output.encode('utf-8')))
+    self.assertEqual(json.loads(json.dumps(stats.ToDict()))['output_bytes'],
+                     stats.output_bytes)
+
+  def testShowStats(self):
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      shanghai.Run('嘎讪胡：1。', capture=True, show_stats=True)
+    self.assertIn('统计：', stdout.getvalue())
+    self.assertIn('输出 2 字节', stdout.getvalue())
+
+  def testStatsOfCachedFile(self):
+    with tempfile.TemporaryDirectory() as dirname, \
+         mock.patch.object(sys, 'dont_write_bytecode', False):
+      path = os.path.join(dirname, 'hello.shanghai')
+      with open(path, 'w', encoding='utf-8') as src_file:
+        src_file.write('嘎讪胡：1。')
+      collected = []
+      with contextlib.redirect_stdout(io.StringIO()):
+        shanghai.RunFile(path, capture=True, on_stats=collected.append)
+        shanghai.RunFile(path, capture=True, on_stats=collected.append)
+    self.assertFalse(collected[0].cache_hit)
+    self.assertTrue(collected[1].cache_hit)
+    self.assertEqual(list(collected[1].wall_seconds), ['load', 'exec'])
+    self.assertEqual(collected[1].py_code_size, collected[0].py_code_size)
+
+  def testWalkAst(self):
+    stmt = ParseStmtFromStr('嘎讪胡：阿庆加1。')[0]
+    self.assertEqual([type(node) for node in shanghai.WalkAst([stmt])],
+                     [Statement, ArithmeticExpr, VariableExpr, LiteralExpr])
+
+class shanghaiCacheTest(SourceFileTestCase):
+  def setUp(self):
+    super().setUp()
+    patcher = mock.patch.object(sys, 'dont_write_bytecode', False)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.path = os.path.join(self.dir.name, 'hello.shanghai')
+
+  def testCacheHitSkipsTokenize(self):
+    self.WriteSource('hello.shanghai', '嘎讪胡：“申花老卵！”。')
+    self.assertEqual(RunFile(self.path), '申花老卵！\n')
+    self.assertTrue(os.path.exists(shanghai.GetCachePath(self.path)))
+    with mock.patch.object(shanghai, 'Tokenize',
+                           side_effect=AssertionError('recompiled')):
+      self.assertEqual(RunFile(self.path), '申花老卵！\n')
+
+  def testSourceChangeInvalidatesCache(self):
+    self.WriteSource('hello.shanghai', '嘎讪胡：1。')
+    self.assertEqual(RunFile(self.path), '1\n')
+    self.WriteSource('hello.shanghai', '嘎讪胡：2。')
+    self.assertEqual(RunFile(self.path), '2\n')
+
+  def testTranslatorChangeInvalidatesCache(self):
+    self.WriteSource('hello.shanghai', '嘎讪胡：1。')
+    self.assertEqual(RunFile(self.path), '1\n')
+    with mock.patch.object(shanghai, '_translator_fingerprint', b'new'):
+      with mock.patch.object(shanghai, 'Tokenize',
+                             wraps=shanghai.Tokenize) as tokenize:
+        self.assertEqual(RunFile(self.path), '1\n')
+        tokenize.assert_called_once()
+
+  def testCorruptedCacheIsIgnored(self):
+    self.WriteSource('hello.shanghai', '嘎讪胡：1。')
+    RunFile(self.path)
+    cache_path = shanghai.GetCachePath(self.path)
+    with open(cache_path, 'r+b') as cache_file:
+      data = cache_file.read()
+      cache_file.seek(0)
+      cache_file.write(data[:len(data) // 2 + 20])
+      cache_file.truncate()
+    self.assertEqual(RunFile(self.path), '1\n')
+
+class shanghaiSessionTest(unittest.TestCase):
+  def testKeepsDefinitions(self):
+    sink = io.StringIO()
+    session = shanghai.Session(sink=sink)
+    session.Run('阿德是则赤佬。阿德毛估估是1。')
+    session.Run('【加加】（阿庆）哪能组：再会阿庆加阿德。组好了。')
+    stats = session.Run('嘎讪胡：白相【加加】（41）。')
+    self.assertEqual(sink.getvalue(), '42\n')
+    self.assertEqual(stats.output_bytes, 3)
+    self.assertIn('compile', stats.wall_seconds)
+    self.assertIn('exec', stats.wall_seconds)
+
+  def testNoWholeProgramOptimizations(self):
+    # A later piece may rebind 阿德, so the self call must stay a call.
+    session = shanghai.Session(
+        sink=io.StringIO(), options=shanghai.CompileOptions(memoize=True))
+    with mock.patch.object(shanghai, 'TranslateToPython',
+                           wraps=shanghai.TranslateToPython) as translate:
+      session.Run('【阿德】（阿庆）哪能组：再会白相【阿德】（阿庆）。组好了。')
+    statements = translate.call_args[0][0]
+    self.assertEqual(statements[0].value[2][0].kind, shanghai.STMT_RETURN)
+    self.assertFalse(hasattr(session.namespace[
+        session.symbols.GetPythonVarName('阿德')], 'cache_info'))
+
+  def testNeedsMoreInput(self):
+    self.assertFalse(shanghai.NeedsMoreInput(''))
+    self.assertFalse(shanghai.NeedsMoreInput('嘎讪胡：1。\n'))
+    self.assertTrue(shanghai.NeedsMoreInput('嘎讪胡：1\n'))
+    self.assertTrue(shanghai.NeedsMoreInput('嘎讪胡：“1。\n'))
+    self.assertTrue(shanghai.NeedsMoreInput('一道组特：嘎讪胡：1。\n'))
+    self.assertFalse(shanghai.NeedsMoreInput(
+        '一道组特：嘎讪胡：1。组好了。\n'))
+    self.assertTrue(shanghai.NeedsMoreInput(
+        '轧苗头：1比0老卵？要来赛就嘎讪胡：1。\n'))
+    self.assertFalse(shanghai.NeedsMoreInput(
+        '轧苗头：1比0老卵？要来赛就嘎讪胡：1。勿来赛就嘎讪胡：2。\n'))
+
+  def testRepl(self):
+    lines = iter(['阿德是则赤佬。阿德毛估估是', '1。',
+                  ':time',
+                  '轧苗头：阿德比0老卵？要来赛就嘎讪胡：“大”。',
+                  '勿来赛就嘎讪胡：“小”。', '',
+                  ':time',
+                  '嘎讪胡：阿三。',
+                  '嘎讪胡：阿德',
+                  ])
+    def Input(prompt):
+      try:
+        return next(lines)
+      except StopIteration:
+        raise EOFError()
+
+    sink = io.StringIO()
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout), \
+         contextlib.redirect_stderr(io.StringIO()) as stderr:
+      shanghai.Repl(shanghai.Session(sink=sink), input_func=Input)
+    self.assertEqual(sink.getvalue(), '大\n')
+    # Only the 轧苗头 was timed.
+    self.assertEqual(stdout.getvalue().count('（编译'), 1)
+    self.assertIn('NameError', stderr.getvalue())
+
+class shanghaiProgramTest(unittest.TestCase):
+  SEEDED = ('【阿三】（阿庆）哪能组：'
+            '  轧苗头：阿庆比2推板？要来赛就再会阿庆。'
+            '  再会白相【阿三】（阿庆减1）加白相【阿三】（阿庆减2）。'
+            '组好了。'
+            '嘎讪胡：种子、“：”、白相【阿三】（种子）。')
+
+  def testRunsManyTimesQuietly(self):
+    with mock.patch.object(
+        shanghai, 'TranslateStatementToPython',
+        wraps=shanghai.TranslateStatementToPython) as translate:
+      program = shanghai.Compile(self.SEEDED,
+                                 shanghai.CompileOptions(memoize=True))
+      self.assertIn('compile', program.stats.wall_seconds)
+      self.assertGreater(program.stats.py_code_size, 0)
+      # The Python code is only translated once it's used.
+      translate.assert_not_called()
+      # It's compiled as a whole program, so 阿三 can be memoized.
+      self.assertIn('_shanghai_memoize', program.py_code)
+      translate.assert_called()
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout), \
+         mock.patch.object(shanghai, 'CompileToPython') as compile_to_python:
+      outputs = [program.Run(env={'种子': seed}) for seed in range(1, 7)]
+    compile_to_python.assert_not_called()
+    self.assertEqual(stdout.getvalue(), '')
+    self.assertEqual(outputs, ['1：1\n', '2：1\n', '3：2\n', '4：3\n',
+                               '5：5\n', '6：8\n'])
+
+  def testRunToSink(self):
+    program = shanghai.Compile('嘎讪胡：1。嘎讪胡：x。')
+    sink = io.StringIO()
+    stats = shanghai.RunStats()
+    self.assertIsNone(program.Run(sink=sink, env={'x': 2}, stats=stats))
+    self.assertEqual(sink.getvalue(), '1\n2\n')
+    self.assertEqual(stats.output_bytes, 4)
+    with self.assertRaises(NameError):
+      program.Run()
+
+  def testCompileError(self):
+    with self.assertRaises(shanghai.CompileError):
+      shanghai.Compile('嘎讪胡：1比。')
+    with self.assertRaises(shanghai.CompileError):
+      shanghai.Compile('嘎讪胡：1。组好了。')
+
+  def testLimits(self):
+    code = '阿德从1到100搞七捻三：搞好了。'
+    limits = shanghai.ResourceLimits(max_steps=10)
+    with self.assertRaises(ValueError):
+      shanghai.Compile(code).Run(limits=limits)
+    program = shanghai.Compile(
+        code, shanghai.CompileOptions(instrument=True))
+    with self.assertRaises(shanghai.ResourceLimitExceeded):
+      program.Run(limits=limits)
+    self.assertEqual(program.Run(), '')
+
+class shanghaiStreamingTest(SourceFileTestCase):
+  CODE = ('阿德是则赤佬。阿德毛估估是0。# 注释里向的。勿算\n'
+          '【阿。庆】是则赤佬。【阿。庆】毛估估是“一。二！”。\n'
+          '【加加】（阿三）哪能组：\n'
+          '  再会阿三加1。\n'
+          '组好了。\n'
+          '阿三从1到3搞七捻三：阿德毛估估是白相【加加】（阿德）。搞好了。\n'
+          '轧苗头：阿德比2老卵？要来赛就嘎讪胡：【阿。庆】。\n'
+          '勿来赛就嘎讪胡：阿德。\n'
+          '轧苗头：阿德比5老卵？要来赛就嘎讪胡：“大”。')
+
+  def testReadSentences(self):
+    ends = list(shanghai.FindSentenceEnds(self.CODE))
+    expected = [self.CODE[start:end]
+                for start, end in zip([0] + ends, ends)]
+    for chunk_size in range(1, len(self.CODE) + 2):
+      self.assertEqual(list(shanghai.ReadSentences(io.StringIO(self.CODE),
+                                                   chunk_size)),
+                       expected, chunk_size)
+
+  def testParseStatementsStreaming(self):
+    expected = ParseToAst(self.CODE)
+    for chunk_size in (1, 5, 1 << 16):
+      statements = list(shanghai.ParseStatementsStreaming(
+          shanghai.ReadSentences(io.StringIO(self.CODE), chunk_size)))
+      self.assertEqual(statements, expected)
+      self.assertEqual(Locations(statements), Locations(expected))
+    # The 勿来赛就 on the next line went with the first 轧苗头.
+    self.assertEqual(statements[-2].value[2].kind, STMT_SAY)
+
+  def testRunFileStreaming(self):
+    sink = io.StringIO()
+    stats = shanghai.RunStats()
+    with contextlib.redirect_stdout(io.StringIO()) as stdout:
+      shanghai.RunFileStreaming(self.WriteSource('stream.shanghai', self.CODE),
+                                sink=sink, stats=stats)
+    self.assertEqual(stdout.getvalue(), '')
+    self.assertEqual(sink.getvalue(), '一。二！\n')
+    self.assertEqual(stats.output_bytes, len('一。二！\n'.encode('utf-8')))
+    self.assertIn('parse', stats.wall_seconds)
+
+  def testRunsStatementsBeforeSyntaxError(self):
+    sink = io.StringIO()
+    with self.assertRaises(SystemExit):
+      shanghai.RunFileStreaming(
+          self.WriteSource('stream.shanghai',
+                           '嘎讪胡：1。\n' * 100 + '嘎讪胡：1比。'),
+          sink=sink)
+    self.assertEqual(sink.getvalue(), '1\n' * 100)
+
+  def testMemoryDoesNotGrowWithFileSize(self):
+    def PeakBytes(num_lines):
+      code = shanghai_bench.StraightLineProgram(num_lines)
+      src_file = io.StringIO(code)
+      tracemalloc.start()
+      try:
+        for _ in shanghai.ParseStatementsStreaming(
+            shanghai.ReadSentences(src_file, 1024)):
+          pass
+        return tracemalloc.get_traced_memory()[1]
+      finally:
+        tracemalloc.stop()
+
+    self.assertLess(PeakBytes(5000), PeakBytes(500) * 2)
+
+class shanghaiBatchTest(SourceFileTestCase):
+  def testRunFileForBatch(self):
+    result = shanghai.RunFileForBatch(
+        self.WriteSource('ok.shanghai', '嘎讪胡：1。嘎讪胡：2。'))
+    self.assertEqual(result.output, '1\n2\n')
+    self.assertIsNone(result.error)
+    self.assertEqual(result.ExitStatus(), 0)
+
+    result = shanghai.RunFileForBatch(
+        self.WriteSource('bad.shanghai', '嘎讪胡：1。白相 int（“x”）。'))
+    self.assertEqual(result.output, '1\n')
+    self.assertIn('ValueError', result.error)
+    self.assertEqual(result.ExitStatus(), 1)
+
+  def testTracebackPointsAtSource(self):
+    path = self.WriteSource('bad.shanghai',
+                            '嘎讪胡：1。\n阿德是则赤佬。\n  白相 int（“x”）。\n')
+    result = shanghai.RunFileForBatch(path)
+    self.assertIn('File "%s", line 3' % (os.path.abspath(path),),
+                  result.error)
+    self.assertIn('白相 int（“x”）。', result.error)
+
+  def testTracebackPointsAtNestedSource(self):
+    for code, line in (
+        ('一道组特：\n  嘎讪胡：1。\n  白相 int（“x”）。\n组好了。\n', 3),
+        ('嘎讪胡：0。\n轧苗头：1比0老卵？要来赛就一道组特：\n'
+         '  嘎讪胡：2。\n  白相 int（“x”）。\n组好了。\n', 4),
+        ):
+      path = self.WriteSource('bad.shanghai', code)
+      result = shanghai.RunFileForBatch(path)
+      self.assertIn('File "%s", line %d, in <module>\n    白相 int（“x”）。' % (
+          os.path.abspath(path), line), result.error)
+
+  def testWorkerDying(self):
+    paths = [self.WriteSource('ok.shanghai', '嘎讪胡：1。'),
+             self.WriteSource('exit.shanghai',
+                              '阿庆，上 os。白相 os._exit（1）。'),
+             self.WriteSource('after.shanghai', '嘎讪胡：2。')]
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      status = shanghai.RunBatch(paths, 1, sink=io.StringIO())
+    self.assertEqual(status, 1)
+    # The files the worker took with it fail, and all are reported.
+    report = stdout.getvalue()
+    self.assertIn('出错了：工作进程死脱了', report)
+    self.assertIn('好  %s' % (paths[0],), report)
+    for path in paths[1:]:
+      self.assertIn('坏  %s' % (path,), report)
+
+  def testJobsMustBePositive(self):
+    path = self.WriteSource('ok.shanghai', '嘎讪胡：1。')
+    for jobs in ('0', '-2'):
+      with contextlib.redirect_stderr(io.StringIO()) as stderr, \
+           self.assertRaises(SystemExit) as exited:
+        shanghai.Main(['shanghai.py', '-j', jobs, path])
+      self.assertEqual(exited.exception.code, 2)
+      self.assertIn('-j 要比 0 大', stderr.getvalue())
+
+  def testRunBatchKeepsInputOrder(self):
+    paths = [self.WriteSource('%d.shanghai' % (i,),
+                              '阿德从1到%d搞七捻三：搞好了。嘎讪胡：%d。' % (
+                                  (5 - i) * 10000, i))
+             for i in range(5)]
+    paths.insert(2, self.WriteSource('bad.shanghai', '阿德扎台型。'))
+    stdout = io.StringIO()
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      self.assertEqual(shanghai.RunBatch(paths, 3, sink=sink), 1)
+    self.assertEqual(sink.getvalue(), '0\n1\n2\n3\n4\n')
+    stdout = stdout.getvalue()
+    self.assertIn('NameError', stdout)
+    positions = [stdout.index('执行 %s ...' % (path,)) for path in paths]
+    self.assertEqual(positions, sorted(positions))
+    self.assertIn('执行 6 只文件', stdout)
+
+class shanghaiBenchTest(unittest.TestCase):
+  def testTimeStages(self):
+    seconds = shanghai_bench.TimeStages(
+        shanghai_bench.RecursiveProgram(n=5))
+    self.assertEqual(list(seconds), shanghai_bench.STAGES)
+
+  def testMeasureMemory(self):
+    memory = shanghai_bench.MeasureMemory(
+        shanghai_bench.StraightLineProgram(num_stmts=100))
+    self.assertEqual(memory['num_statements'], 102)
+    self.assertGreater(memory['retained_blocks'], memory['num_statements'])
+    self.assertGreaterEqual(memory['peak_bytes'], memory['retained_bytes'])
+
+  def testWorkloads(self):
+    workloads = dict(shanghai_bench.GetWorkloads(r'\bdemo1\.|synthetic'))
+    self.assertEqual(len(workloads), 5)
+    self.assertEqual(Run(shanghai_bench.DeepNestingProgram(depth=3)),
+                     '100\n')
+    self.assertEqual(Run(shanghai_bench.HotLoopProgram(num_iterations=7)),
+                     '-1\n')
+
+  def testCompare(self):
+    def Results(**medians):
+      return {'benchmarks': {'demo': {
+          stage: shanghai_bench.Summarize([median, median * 1.01])
+          for stage, median in medians.items()}}}
+    rows = shanghai_bench.Compare(
+        Results(parse=1.0, compile=1.0, exec=1.0),
+        Results(parse=1.5, compile=1.005, exec=0.5), threshold=0.1)
+    self.assertEqual([(stage, flag) for _, stage, _, _, flag in rows],
+                     [('parse', '变慢'), ('compile', ''), ('exec', '变快')])
+
+class shanghaiImportTest(SourceFileTestCase):
+  def setUp(self):
+    super().setUp()
+    patcher = mock.patch.object(shanghai, 'SHANGHAI_PATH', [self.dir.name])
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.addCleanup(sys.modules.pop, '套路库', None)
+
+  def testImportShanghaiModule(self):
+    self.WriteSource('套路库.shanghai',
+                     '嘎讪胡：“装好了”。'
+                     '常数是则赤佬。常数毛估估是100。'
+                     '【加一】（那啥）哪能组：嘎讪胡：那啥。再会那啥加一。组好了。')
+    # The module runs once, and writes to the output of the running program.
+    self.assertEqual(
+        Run('阿庆，上【套路库】。阿庆，上【套路库】。'
+            '嘎讪胡：白相【加一】（常数）。'),
+        '装好了\n100\n101\n')
+    self.assertEqual(Run('阿庆，上【套路库】。嘎讪胡：白相【加一】（1）。'),
+                     '1\n2\n')
+
+  def testModuleIsCachedOnDisk(self):
+    path = self.WriteSource('套路库.shanghai', '常数是则赤佬。常数毛估估是7。')
+    with mock.patch.object(sys, 'dont_write_bytecode', False):
+      self.assertEqual(Run('阿庆，上【套路库】。嘎讪胡：常数。'), '7\n')
+    self.assertTrue(os.path.exists(shanghai.GetCachePath(path)))
+
+    # Only the importing program is compiled the second time.
+    del sys.modules['套路库']
+    with mock.patch.object(shanghai, 'CompileToPython',
+                           wraps=shanghai.CompileToPython) as compile_mock:
+      self.assertEqual(Run('阿庆，上【套路库】。嘎讪胡：常数。'), '7\n')
+    self.assertEqual(compile_mock.call_count, 1)
+
+  def testImportCanRebindFunctions(self):
+    self.WriteSource('套路库.shanghai', '【阿三】（阿庆）哪能组：再会阿庆乘100。组好了。')
+    code = ('【阿三】（阿庆）哪能组：\n'
+            '  轧苗头：阿庆比1推板？要来赛就再会0。\n'
+            '  再会白相【阿三】（阿庆减1）。\n'
+            '组好了。\n'
+            '【阿四】（阿庆）哪能组：再会白相【阿三】（阿庆）。组好了。\n'
+            '嘎讪胡：白相【阿四】（3）。\n'
+            '阿庆，上【套路库】。\n'
+            '嘎讪胡：白相【阿四】（3）。\n')
+    options = shanghai.CompileOptions(memoize=True)
+    py_code, _ = shanghai.CompileToPython(code, options=options)
+    # Neither memoized nor turned into a loop.
+    self.assertNotIn('_shanghai_memoize', py_code)
+    self.assertNotIn('while True', py_code)
+    self.assertEqual(shanghai.Run(code, capture=True, options=options),
+                     '0\n300\n')
+
+  def testImportInsideFunction(self):
+    self.assertEqual(Run('【阿德】哪能组：阿庆，上math。再会白相【math.sqrt】（4）。组好了。'
+                         '嘎讪胡：白相【阿德】。'), '2.0\n')
+    self.WriteSource('套路库.shanghai', '【加一】（那啥）哪能组：再会那啥加一。组好了。')
+    # Globals can be read before and after the import, and what the module
+    # defines is bound in the 套路 only.
+    code = ('常数是则赤佬。常数毛估估是100。'
+            '【阿三】（阿庆）哪能组：'
+            '  嘎讪胡：常数。阿庆，上【套路库】。再会白相【加一】（阿庆加常数）。'
+            '组好了。'
+            '嘎讪胡：白相【阿三】（1）。'
+            '【阿四】（阿庆）哪能组：'
+            '  【阿五】哪能组：阿庆，上 math。再会阿庆。组好了。再会白相【阿五】。'
+            '组好了。'
+            '嘎讪胡：白相【阿四】（5）。')
+    py_code, code_object = shanghai.CompileToPython(code)
+    for compiled in (code_object, compile(str(py_code), '<string>', 'exec')):
+      output = io.StringIO()
+      namespace = shanghai.NewRuntimeNamespace(shanghai.OutputSink(output, 1))
+      exec(compiled, namespace, namespace)
+      self.assertEqual(output.getvalue(), '100\n102\n5\n')
+      self.assertNotIn('math', namespace)
+      self.assertEqual(
+          [name for name, value in namespace.items()
+           if value is sys.modules['套路库'] or
+           getattr(value, '__module__', None) == '套路库'], [])
+
+  def testImportMissingModule(self):
+    with self.assertRaises(ImportError):
+      Run('阿庆，上【呒没介只库】。')
+
+@unittest.skipUnless(hasattr(shanghai, 'ShanghaiServer'),
+                     'Unix sockets are not supported')
+class shanghaiServerTest(SourceFileTestCase):
+  def setUp(self):
+    super().setUp()
+    self.socket_path = os.path.join(self.dir.name, 'shanghai.sock')
+    self.server = shanghai.ShanghaiServer(self.socket_path)
+    self.addCleanup(self.server.server_close)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.start()
+    self.addCleanup(thread.join)
+    self.addCleanup(self.server.shutdown)
+
+  def RunFileOnServer(self, filepath, socket_path=None):
+    stdout = io.StringIO()
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      status, error = shanghai.RunFileOnServer(
+          socket_path or self.socket_path, filepath, sink=sink)
+    return status, error, stdout.getvalue(), sink.getvalue()
+
+  def testRunFileOnServer(self):
+    path = self.WriteSource('ok.shanghai', '嘎讪胡：“侬好”。嘎讪胡：2。')
+    status, error, stdout, output = self.RunFileOnServer(path)
+    self.assertEqual((status, error), (0, None))
+    self.assertEqual(output, '侬好\n2\n')
+    self.assertIn('Python 代码：', stdout)
+    self.assertTrue(stdout.endswith('运行结果：\n\n'))
+
+    # The second run is served from the in-memory cache.
+    self.assertEqual(self.RunFileOnServer(path)[3], '侬好\n2\n')
+    self.assertEqual(self.server.compile_cache.hits, 1)
+    self.assertEqual(self.server.compile_cache.misses, 1)
+
+  def testErrors(self):
+    status, error, _, output = self.RunFileOnServer(
+        self.WriteSource('bad.shanghai', '嘎讪胡：1。白相 int（“x”）。'))
+    self.assertEqual(status, 1)
+    self.assertIn('ValueError', error)
+    self.assertEqual(output, '1\n')
+
+    status, error, _, _ = self.RunFileOnServer(
+        self.WriteSource('syntax.shanghai', '嘎讪胡 1。'))
+    self.assertEqual(status, 1)
+    self.assertIn('期望符号', error)
+
+  def testFallsBackToLocalRun(self):
+    path = self.WriteSource('ok.shanghai', '嘎讪胡：3。')
+    status, error, _, output = self.RunFileOnServer(
+        path, os.path.join(self.dir.name, 'nobody.sock'))
+    self.assertEqual((status, error), (0, None))
+    self.assertEqual(output, '3\n')
+    self.assertEqual(self.server.compile_cache.misses, 0)
+
+  def testCompileCacheEvictsLeastRecentlyUsed(self):
+    cache = shanghai.CompileCache(max_entries=2)
+    for code in ['嘎讪胡：1。', '嘎讪胡：2。', '嘎讪胡：1。', '嘎讪胡：3。',
+                 '嘎讪胡：1。', '嘎讪胡：2。']:
+      cache.Compile(code)
+    self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+class shanghaiAsyncTest(unittest.TestCase):
+  LONG_LOOP = ('阿德是则赤佬。'
+               '阿庆从1到1000000000搞七捻三：阿德毛估估是阿庆。搞好了。')
+
+  def setUp(self):
+    self.runner = shanghai.AsyncRunner(max_in_flight=2)
+
+  def tearDown(self):
+    self.runner.executor.shutdown()
+
+  def testRunAsync(self):
+    self.assertEqual(asyncio.run(shanghai.RunAsync('嘎讪胡：1。嘎讪胡：2。')),
+                     '1\n2\n')
+    with self.assertRaises(shanghai.CompileError):
+      asyncio.run(shanghai.RunAsync('嘎讪胡：1比。'))
+    with self.assertRaises(ZeroDivisionError):
+      asyncio.run(shanghai.RunAsync('嘎讪胡：1除以0。'))
+
+  def testStreamsOutput(self):
+    runner = shanghai.AsyncRunner(flush_threshold=1)
+    self.addCleanup(runner.executor.shutdown)
+    async def Main():
+      run = runner.Start('阿德从1到5搞七捻三：嘎讪胡：阿德。搞好了。')
+      chunks = [chunk async for chunk in run]
+      return chunks, await run
+    chunks, output = asyncio.run(Main())
+    self.assertEqual(chunks, ['1\n', '2\n', '3\n', '4\n', '5\n'])
+    self.assertEqual(output, '1\n2\n3\n4\n5\n')
+
+  def testMaxInFlight(self):
+    lock = threading.Lock()
+    running = [0]
+    most_running = [0]
+    execute = shanghai.CompileAndExecute
+    def CountingExecute(*args):
+      with lock:
+        running[0] += 1
+        most_running[0] = max(most_running[0], running[0])
+      try:
+        execute(*args)
+      finally:
+        with lock:
+          running[0] -= 1
+    async def Main():
+      runs = [self.runner.Start(
+                  '阿德从1到20000搞七捻三：搞好了。嘎讪胡：%d。' % (i,))
+              for i in range(6)]
+      return await asyncio.gather(*runs)
+    with mock.patch.object(shanghai, 'CompileAndExecute', CountingExecute):
+      outputs = asyncio.run(Main())
+    self.assertEqual(outputs, ['%d\n' % (i,) for i in range(6)])
+    self.assertEqual(most_running[0], 2)
+
+  def testTimeoutStopsProgram(self):
+    async def Main():
+      run = self.runner.Start(self.LONG_LOOP, timeout=0.1)
+      with self.assertRaises(asyncio.TimeoutError):
+        await run
+      return run
+    run = asyncio.run(Main())
+    self.assertTrue(run.governor.cancelled)
+    # The worker thread isn't left running the loop.
+    start = time.perf_counter()
+    self.runner.executor.shutdown()
+    self.assertLess(time.perf_counter() - start, 5)
+
+  def testCancel(self):
+    runner = shanghai.AsyncRunner(max_in_flight=1)
+    self.addCleanup(runner.executor.shutdown)
+    async def Main():
+      run = runner.Start(self.LONG_LOOP)
+      waiting = runner.Start('嘎讪胡：1。')
+      third = runner.Start('嘎讪胡：2。')
+      await asyncio.sleep(0.05)
+      run.Cancel()
+      waiting.Cancel()
+      with self.assertRaises(asyncio.CancelledError):
+        await run
+      with self.assertRaises(asyncio.CancelledError):
+        await waiting
+      # The program stopped with RunCancelled, and the one waiting for a
+      # slot never started.
+      self.assertIsInstance(run.future.exception(timeout=5),
+                            shanghai.RunCancelled)
+      self.assertIsNone(waiting.future)
+      # The slots are given back.
+      return await asyncio.wait_for(third, 5)
+    self.assertEqual(asyncio.run(Main()), '2\n')
+
+  def testProcessExecutor(self):
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+      runner = shanghai.AsyncRunner(
+          executor, limits=shanghai.ResourceLimits(max_steps=100))
+      self.assertEqual(asyncio.run(shanghai.RunAsync(
+          '阿德从1到3搞七捻三：嘎讪胡：阿德。搞好了。', runner=runner)),
+          '1\n2\n3\n')
+      with self.assertRaises(shanghai.ResourceLimitExceeded) as e:
+        asyncio.run(shanghai.RunAsync(self.LONG_LOOP, runner=runner))
+      self.assertEqual(e.exception.resource, 'max_steps')
+      with self.assertRaises(asyncio.TimeoutError):
+        asyncio.run(shanghai.RunAsync(
+            self.LONG_LOOP, timeout=0.2, runner=shanghai.AsyncRunner(
+                executor)))
+
 if __name__ == '__main__':
   unittest.main()